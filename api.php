@@ -4,7 +4,57 @@ $_method = $_SERVER['REQUEST_METHOD'];
 $data = json_decode(file_get_contents('php://input'), true);
 $base = '/volcado_web';
 
+// Servicio residente de sync.py (python3 sync.py --modo servicio); si no responde se usa exec
+$service_url = getenv('SYNC_SERVICE_URL') ?: 'http://127.0.0.1:8765';
+
+// Petición al servicio; devuelve [código HTTP, cuerpo] o null si no está disponible
+function service_request($service_url, $method, $path, $body = null, $timeout = 5) {
+    if (!function_exists('curl_init')) {
+        return null;
+    }
+    if (strpos($service_url, 'unix:') === 0) {
+        $curl = curl_init('http://localhost' . $path);
+        curl_setopt($curl, CURLOPT_UNIX_SOCKET_PATH, substr($service_url, 5));
+    } else {
+        $curl = curl_init($service_url . $path);
+    }
+    curl_setopt($curl, CURLOPT_RETURNTRANSFER, true);
+    curl_setopt($curl, CURLOPT_CONNECTTIMEOUT, 1);
+    curl_setopt($curl, CURLOPT_TIMEOUT, $timeout);
+    curl_setopt($curl, CURLOPT_CUSTOMREQUEST, $method);
+    if ($body !== null) {
+        curl_setopt($curl, CURLOPT_POSTFIELDS, json_encode($body));
+        curl_setopt($curl, CURLOPT_HTTPHEADER, ['Content-Type: application/json']);
+    }
+    $response = curl_exec($curl);
+    $code = curl_getinfo($curl, CURLINFO_HTTP_CODE);
+    curl_close($curl);
+    if ($response === false || $code === 0) {
+        return null;
+    }
+    return [$code, $response];
+}
+
 switch ($_method) {
+    case 'GET':
+        // Progreso de un trabajo del servicio: ?job=<id>&desde=<eventos ya recibidos>
+        if (!isset($_GET['job'])) {
+            http_response_code(400);
+            echo json_encode(["status" => "error", "message" => 'El parámetro "job" es requerido']);
+            exit;
+        }
+        $desde = isset($_GET['desde']) ? intval($_GET['desde']) : 0;
+        $result = service_request($service_url, 'GET',
+            '/jobs/' . rawurlencode($_GET['job']) . "?desde=$desde&espera=10", null, 15);
+        if ($result === null) {
+            http_response_code(503);
+            echo json_encode(["status" => "error", "message" => "El servicio de consolidación no está disponible"]);
+            exit;
+        }
+        http_response_code($result[0]);
+        echo $result[1];
+        exit;
+
     case 'POST':
         if (!isset($data['modo'])) {
             http_response_code(400);
@@ -35,6 +85,34 @@ switch ($_method) {
         $db_destino_database = $db_destino['database'];
 
 
+        // Con el servicio activo se encola el trabajo y se responde de inmediato con su id
+        $target = [
+            "host" => $db_destino_host,
+            "user" => $db_destino_user,
+            "password" => $db_destino_password,
+            "database" => $db_destino_database
+        ];
+        $source = [
+            "alias" => $db_origen_alias,
+            "host" => $db_origen_host,
+            "user" => $db_origen_user,
+            "password" => $db_origen_password,
+            "database" => $db_origen_database
+        ];
+        if (!empty($db_destino['port'])) {
+            $target['port'] = $db_destino['port'];
+        }
+        if (!empty($db_origen['port'])) {
+            $source['port'] = $db_origen['port'];
+        }
+        $result = service_request($service_url, 'POST', '/jobs',
+            ["modo" => $modo, "target" => $target, "sources" => [$source]]);
+        if ($result !== null) {
+            http_response_code($result[0]);
+            echo $result[1];
+            exit;
+        }
+
         //argumentos del modo
         $modo_arg = escapeshellarg($modo);
 
@@ -54,21 +132,25 @@ switch ($_method) {
         $db_destino_database_arg = escapeshellarg($db_destino_database);
 
         // Ejecutar con argumentos
-        $cmd = "python3 sync.py $db_destino_host_arg:$db_destino_user_arg:$db_destino_password_arg:$db_destino_database_arg --sources $db_origen_alias_arg=$db_origen_host_arg:$db_origen_user_arg:$db_origen_password_arg:$db_origen_database_arg --modo $modo_arg";
+        $cmd = "python3 sync.py $db_destino_host_arg:$db_destino_user_arg:$db_destino_password_arg:$db_destino_database_arg --sources $db_origen_alias_arg=$db_origen_host_arg:$db_origen_user_arg:$db_origen_password_arg:$db_origen_database_arg --modo $modo_arg --json";
         $return_var = 0;
-        exec($cmd . " 2>&1", $output, $return_var);
+        // Con --json el log va a stderr (y a db_consolidation.log) y stdout trae solo el resultado
+        exec($cmd . " 2>/dev/null", $output, $return_var);
 
-        if ($return_var !== 0) {
+        $result = json_decode(implode("\n", $output), true);
+        if ($result === null) {
             http_response_code(500);
             echo json_encode([
                 "status" => "error",
-                "message" => implode("\n", $output)
+                "message" => "sync.py terminó con código $return_var sin resultado JSON; revise db_consolidation.log"
             ]);
             exit;
         }
 
-        // La salida de Python ya es JSON
-        echo implode("\n", $output);
+        if ($return_var !== 0) {
+            http_response_code(500);
+        }
+        echo json_encode($result);
         exit;
 
         break;
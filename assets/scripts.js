@@ -36,50 +36,42 @@ const get_destino = async () => {
     return data.db_destino;
 }
 
-const apertura = async () => {
-    try {
-        console.log("Starting apertura...");
-        const origen = await get_origen_by_alias(dropdown.value);
-        const destino = await get_destino();
-        
-        if (!origen) {
-            alert("Error: No se pudo encontrar la base de datos de origen seleccionada");
-            return;
+const progreso = document.getElementById("progreso");
+
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+const mostrar_evento = (evento) => {
+    console.log("Evento:", evento);
+    if (evento.evento === "tabla") {
+        progreso.textContent = `${evento.fuente}: ${evento.tabla} (${evento.completadas}/${evento.total})`;
+    } else if (evento.evento === "fuente") {
+        progreso.textContent = `${evento.fuente}: terminada en ${evento.resultado.segundos} s`;
+    } else if (evento.evento === "inicio") {
+        progreso.textContent = `Iniciando ${evento.modo} de ${evento.fuentes.join(", ")}...`;
+    }
+}
+
+// Consulta el progreso del trabajo hasta que termina (api.php espera hasta 10 s por eventos nuevos)
+const esperar_trabajo = async (job_id) => {
+    let desde = 0;
+    while (true) {
+        const response = await fetch(`api.php?job=${encodeURIComponent(job_id)}&desde=${desde}`);
+        const trabajo = await response.json();
+        if (!response.ok) {
+            throw new Error(trabajo.message || "No se pudo consultar el trabajo");
         }
-        
-        const post_json = {
-            "modo": "apertura",
-            "db_password_origen": input_origen.value,
-            "db_password_destino": input_destino.value,
-            "db_origen": origen,
-            "db_destino": destino
-        };
-        
-        console.log("Sending apertura request:", post_json);
-        
-        const response = await fetch("api.php", {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify(post_json)
-        });
-        
-        const result = await response.text();
-        console.log("Apertura response:", result);
-        
-        if (response.ok) {
-            alert("Apertura completada exitosamente");
-        } else {
-            alert("Error en apertura: " + result);
+        (trabajo.eventos || []).forEach(mostrar_evento);
+        desde = trabajo.total_eventos;
+        if (trabajo.estado === "completado" || trabajo.estado === "error") {
+            return trabajo;
         }
-    } catch (error) {
-        console.error("Error en apertura:", error);
-        alert("Error en apertura: " + error.message);
+        await sleep(500);
     }
 }
 
-const cierre = async () => {
+const ejecutar = async (modo, titulo) => {
     try {
-        console.log("Starting cierre...");
+        console.log(`Starting ${modo}...`);
         const origen = await get_origen_by_alias(dropdown.value);
         const destino = await get_destino();
         
@@ -89,14 +81,15 @@ const cierre = async () => {
         }
         
         const post_json = {
-            "modo": "cierre",
+            "modo": modo,
             "db_password_origen": input_origen.value,
             "db_password_destino": input_destino.value,
             "db_origen": origen,
             "db_destino": destino
         };
         
-        console.log("Sending cierre request:", post_json);
+        console.log(`Sending ${modo} request:`, { ...post_json, db_password_origen: "***", db_password_destino: "***" });
+        progreso.textContent = `${titulo} en curso...`;
         
         const response = await fetch("api.php", {
             method: "POST",
@@ -104,16 +97,37 @@ const cierre = async () => {
             body: JSON.stringify(post_json)
         });
         
-        const result = await response.text();
-        console.log("Cierre response:", result);
+        const text = await response.text();
+        console.log(`${titulo} response:`, text);
+        let result;
+        try {
+            result = JSON.parse(text);
+        } catch (e) {
+            result = { status: "error", message: text };
+        }
         
-        if (response.ok) {
-            alert("Cierre completado exitosamente");
+        if (response.ok && result.job_id) {
+            // Servicio residente: el trabajo corre en segundo plano
+            const trabajo = await esperar_trabajo(result.job_id);
+            result = trabajo.estado === "completado"
+                ? { status: "ok", resumen: trabajo.resumen }
+                : { status: "error", message: trabajo.error };
+        }
+        
+        if (response.ok && result.status === "ok") {
+            progreso.textContent = `${titulo} completada`;
+            alert(`${titulo} completada exitosamente`);
         } else {
-            alert("Error en cierre: " + result);
+            progreso.textContent = `Error en ${modo}`;
+            alert(`Error en ${modo}: ` + (result.message || text));
         }
     } catch (error) {
-        console.error("Error en cierre:", error);
-        alert("Error en cierre: " + error.message);
+        console.error(`Error en ${modo}:`, error);
+        progreso.textContent = `Error en ${modo}`;
+        alert(`Error en ${modo}: ` + error.message);
     }
-}
\ No newline at end of file
+}
+
+const apertura = () => ejecutar("apertura", "Apertura");
+
+const cierre = () => ejecutar("cierre", "Cierre");
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Benchmark de extremo a extremo: carga el esquema de db/restaurante.sql en K
+sucursales de un servidor MySQL/MariaDB local, genera datos sintéticos, ejecuta
+apertura (take_snapshot), aplica altas/modificaciones/bajas y ejecuta cierre
+(consolidate_changes). Reporta filas/s, tiempo por fase, pico de RSS y tamaño
+del snapshot en JSON para comparar entre commits.
+
+Ejemplo:
+    python3 benchmarks/bench_consolidation.py root:secret --sucursales 3 --rows 100000
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from pathlib import Path
+from typing import Dict, List
+
+import mysql.connector
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from sync import MySQLDBConsolidator, SnapshotStore  # noqa: E402
+
+SCHEMA_FILE = ROOT / 'db' / 'restaurante.sql'
+HOT_TABLES = ['ventas', 'venta_detalles', 'tickets', 'ticket_detalles', 'log_mesas', 'movimientos_caja']
+WORDS = ['mesa', 'orden', 'taco', 'salsa', 'cliente', 'caja', 'corte', 'cocina', 'barra', 'sucursal']
+BASE_DATE = datetime(2025, 9, 1, 8, 0, 0)
+
+
+def load_schema_statements(path: Path) -> List[str]:
+    """CREATE TABLE y ALTER TABLE del volcado; omite datos, vistas, procedimientos y triggers"""
+    statements = []
+    delimiter = ';'
+    buffer = []
+    for line in path.read_text(encoding='utf-8').splitlines():
+        stripped = line.strip()
+        if stripped.startswith('DELIMITER '):
+            delimiter = stripped.split()[1]
+            continue
+        if not buffer and (not stripped or stripped.startswith('--')):
+            continue
+        buffer.append(line)
+        if stripped.endswith(delimiter):
+            statement = '\n'.join(buffer)
+            statements.append(statement[:statement.rstrip().rfind(delimiter)].strip())
+            buffer = []
+
+    tables = {}
+    alters = []
+    for statement in statements:
+        match = re.match(r'(CREATE TABLE|DROP TABLE IF EXISTS|ALTER TABLE) `(\w+)`', statement)
+        if not match:
+            continue
+        kind, name = match.groups()
+        if kind == 'CREATE TABLE':
+            tables[name] = statement
+        elif kind == 'DROP TABLE IF EXISTS':
+            # Los volcados crean tablas provisionales para las vistas y luego las eliminan
+            tables.pop(name, None)
+        else:
+            alters.append((name, statement))
+    return list(tables.values()) + [statement for name, statement in alters if name in tables]
+
+
+def connect(server: Dict, database: str = None):
+    return mysql.connector.connect(host=server['host'], user=server['user'], password=server['password'],
+                                   port=server['port'], database=database, charset='utf8mb4',
+                                   collation='utf8mb4_unicode_ci', autocommit=False)
+
+
+def create_database(server: Dict, database: str, schema: List[str] = None):
+    conn = connect(server)
+    cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS `{database}`")
+    cursor.execute(f"CREATE DATABASE `{database}` DEFAULT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
+    cursor.execute(f"USE `{database}`")
+    cursor.execute("SET foreign_key_checks = 0")
+    cursor.execute("SET sql_mode = 'NO_AUTO_VALUE_ON_ZERO'")
+    for statement in schema or []:
+        cursor.execute(statement)
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def column_plan(conn, database: str) -> Dict[str, List[Dict]]:
+    """Columnas insertables de cada tabla base con lo necesario para generar valores"""
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute("""
+        SELECT c.TABLE_NAME, c.COLUMN_NAME, c.DATA_TYPE, c.COLUMN_TYPE, c.IS_NULLABLE, c.COLUMN_KEY,
+               c.EXTRA, c.CHARACTER_MAXIMUM_LENGTH, c.NUMERIC_PRECISION, c.NUMERIC_SCALE
+        FROM INFORMATION_SCHEMA.COLUMNS c
+        JOIN INFORMATION_SCHEMA.TABLES t
+          ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+        WHERE c.TABLE_SCHEMA = %s AND t.TABLE_TYPE = 'BASE TABLE'
+        ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION
+    """, (database,))
+    plan = {}
+    for column in cursor.fetchall():
+        if 'GENERATED' in (column['EXTRA'] or '').upper():
+            continue
+        plan.setdefault(column['TABLE_NAME'], []).append(column)
+    cursor.close()
+    return plan
+
+
+def generate_value(column: Dict, row_id: int, rng: random.Random):
+    """Valor sintético según el tipo; las columnas de PK reciben el número de fila"""
+    data_type = column['DATA_TYPE'].lower()
+    if column['COLUMN_KEY'] == 'PRI':
+        if data_type in ('char', 'varchar'):
+            return str(row_id)
+        if data_type not in ('date', 'datetime', 'timestamp'):
+            return row_id
+    if column['IS_NULLABLE'] == 'YES' and rng.random() < 0.15:
+        return None
+    if data_type == 'tinyint':
+        return rng.randint(0, 1)
+    if data_type in ('smallint', 'mediumint', 'int', 'integer', 'bigint'):
+        return rng.randint(1, 1000)
+    if data_type in ('decimal', 'float', 'double'):
+        scale = column['NUMERIC_SCALE'] or 0
+        digits = min((column['NUMERIC_PRECISION'] or 10) - scale, 6)
+        return Decimal(rng.randint(0, 10 ** digits * 10 ** scale - 1)) / (10 ** scale)
+    if data_type in ('datetime', 'timestamp'):
+        return BASE_DATE + timedelta(seconds=row_id * 37 + rng.randint(0, 30))
+    if data_type == 'date':
+        return (BASE_DATE + timedelta(days=row_id % 365)).date()
+    if data_type == 'time':
+        return timedelta(seconds=rng.randint(0, 86399))
+    if data_type == 'year':
+        return 2025
+    if data_type in ('enum', 'set'):
+        return rng.choice(re.findall(r"'((?:[^']|'')*)'", column['COLUMN_TYPE'])).replace("''", "'")
+    if data_type == 'json':
+        return json.dumps({'n': row_id})
+    if data_type in ('binary', 'varbinary', 'blob', 'tinyblob', 'mediumblob', 'longblob'):
+        return rng.randbytes(min(column['CHARACTER_MAXIMUM_LENGTH'] or 16, 16))
+    text = f"{rng.choice(WORDS)} {rng.choice(WORDS)} {row_id}"
+    return text[:column['CHARACTER_MAXIMUM_LENGTH'] or len(text)]
+
+
+def insert_rows(conn, table_name: str, columns: List[Dict], first_id: int, count: int,
+                rng: random.Random, batch_size: int = 5000) -> int:
+    """Inserta filas sintéticas por lotes; las que chocan con claves únicas se descartan"""
+    names = [column['COLUMN_NAME'] for column in columns]
+    query = (f"INSERT IGNORE INTO `{table_name}` (`{'`, `'.join(names)}`) "
+             f"VALUES ({', '.join(['%s'] * len(names))})")
+    cursor = conn.cursor()
+    inserted = 0
+    for start in range(first_id, first_id + count, batch_size):
+        stop = min(start + batch_size, first_id + count)
+        cursor.executemany(query, [[generate_value(column, row_id, rng) for column in columns]
+                                   for row_id in range(start, stop)])
+        inserted += cursor.rowcount
+        conn.commit()
+    cursor.close()
+    return inserted
+
+
+def populate_source(server: Dict, database: str, hot_rows: int, cold_rows: int, seed: int) -> Dict[str, int]:
+    conn = connect(server, database)
+    conn.cmd_query("SET foreign_key_checks = 0")
+    rng = random.Random(seed)
+    counts = {}
+    for table_name, columns in column_plan(conn, database).items():
+        rows = hot_rows if table_name in HOT_TABLES else cold_rows
+        counts[table_name] = insert_rows(conn, table_name, columns, 1, rows, rng)
+    conn.close()
+    return counts
+
+
+def mutate_source(server: Dict, database: str, counts: Dict[str, int], insert_ratio: float,
+                  update_ratio: float, delete_ratio: float, seed: int) -> Dict[str, int]:
+    """Altas, modificaciones y bajas entre apertura y cierre sobre las tablas calientes"""
+    conn = connect(server, database)
+    conn.cmd_query("SET foreign_key_checks = 0")
+    rng = random.Random(seed + 1000)
+    plan = column_plan(conn, database)
+    changes = {'altas': 0, 'modificaciones': 0, 'bajas': 0}
+    cursor = conn.cursor()
+    for table_name in HOT_TABLES:
+        columns = plan.get(table_name)
+        if not columns:
+            continue
+        existing = counts[table_name]
+        changes['altas'] += insert_rows(conn, table_name, columns, existing + 1,
+                                        int(existing * insert_ratio), rng)
+
+        primary_key = [column for column in columns if column['COLUMN_KEY'] == 'PRI']
+        mutable = [column for column in columns if column['COLUMN_KEY'] != 'PRI']
+        if len(primary_key) != 1 or not mutable or not existing:
+            continue
+        key_name = primary_key[0]['COLUMN_NAME']
+
+        updated_ids = rng.sample(range(1, existing + 1), int(existing * update_ratio))
+        for start in range(0, len(updated_ids), 5000):
+            batch = []
+            for row_id in updated_ids[start:start + 5000]:
+                column = rng.choice(mutable)
+                batch.append((column['COLUMN_NAME'], generate_value(column, row_id, rng), row_id))
+            for column_name in {column_name for column_name, _, _ in batch}:
+                cursor.executemany(f"UPDATE `{table_name}` SET `{column_name}` = %s WHERE `{key_name}` = %s",
+                                   [(value, row_id) for name, value, row_id in batch if name == column_name])
+                changes['modificaciones'] += cursor.rowcount
+            conn.commit()
+
+        deleted_ids = rng.sample(range(1, existing + 1), int(existing * delete_ratio))
+        for start in range(0, len(deleted_ids), 5000):
+            batch = deleted_ids[start:start + 5000]
+            cursor.execute(f"DELETE FROM `{table_name}` WHERE `{key_name}` IN ({', '.join(['%s'] * len(batch))})",
+                           tuple(batch))
+            changes['bajas'] += cursor.rowcount
+            conn.commit()
+    cursor.close()
+    conn.close()
+    return changes
+
+
+def peak_rss_bytes() -> int:
+    # En Linux ru_maxrss está en KiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def phase_worker(options: Dict, phase: str, verbose: bool, queue):
+    try:
+        consolidator = MySQLDBConsolidator(**options)
+        if not verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        start = time.perf_counter()
+        if phase == 'apertura':
+            summary = consolidator.take_snapshot()
+        else:
+            summary = consolidator.consolidate_changes()
+        seconds = time.perf_counter() - start
+        consolidator.connections.close_all()
+        consolidator.dead_letters.close()
+        queue.put({'segundos': round(seconds, 3), 'peak_rss_bytes': peak_rss_bytes(), 'resumen': summary})
+    except Exception as e:
+        queue.put({'error': str(e)})
+
+
+def run_phase(options: Dict, phase: str, verbose: bool = False) -> Dict:
+    """Ejecuta una fase en un proceso propio para medir su pico de RSS por separado"""
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=phase_worker, args=(options, phase, verbose, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if 'error' in result:
+        raise RuntimeError(f"Error en la fase {phase}: {result['error']}")
+    return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de apertura/cierre sobre el esquema de restaurante.sql')
+    parser.add_argument('server', help='Servidor local: user:password[@host[:port]]')
+    parser.add_argument('--sucursales', type=int, default=2, help='Bases de datos fuente a generar')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='Filas por tabla caliente en cada sucursal (10k a 10M)')
+    parser.add_argument('--cold-rows', type=int, default=200, help='Filas por tabla de catálogo')
+    parser.add_argument('--insert-ratio', type=float, default=0.05, help='Altas entre apertura y cierre (fracción)')
+    parser.add_argument('--update-ratio', type=float, default=0.02, help='Modificaciones (fracción)')
+    parser.add_argument('--delete-ratio', type=float, default=0.0, help='Bajas (fracción)')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--prefix', default='bench', help='Prefijo de las bases de datos creadas')
+    parser.add_argument('--keep', action='store_true', help='No borrar las bases de datos al terminar')
+    parser.add_argument('--output', help='Archivo JSON de resultados (por defecto stdout)')
+    parser.add_argument('--verbose', action='store_true', help='Mostrar el log del consolidador')
+    # Opciones que se pasan tal cual a MySQLDBConsolidator
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--bulk-load-threshold', type=int, default=0)
+    parser.add_argument('--server-hash', action='store_true')
+    parser.add_argument('--hash-algorithm', default='sha256-v1')
+    parser.add_argument('--diff-engine', choices=['hash', 'checksum'], default='hash')
+    parser.add_argument('--write-mode', choices=['append', 'idempotent', 'changeset'], default='append')
+    parser.add_argument('--incremental', action='store_true')
+    args = parser.parse_args()
+
+    credentials, _, location = args.server.partition('@')
+    user, _, password = credentials.partition(':')
+    host, _, port = (location or 'localhost').partition(':')
+    server = {'host': host, 'user': user, 'password': password, 'port': int(port or 3306)}
+
+    schema = load_schema_statements(SCHEMA_FILE)
+    source_names = [f"{args.prefix}_sucursal_{i + 1}" for i in range(args.sucursales)]
+    target_name = f"{args.prefix}_central"
+
+    workdir = tempfile.mkdtemp(prefix='bench_consolidation_')
+    cwd = os.getcwd()
+    results = {
+        'commit': git_revision(),
+        'fecha': datetime.now().isoformat(),
+        'parametros': {key: value for key, value in vars(args).items() if key not in ('server', 'output')},
+        'fases': {}
+    }
+    try:
+        start = time.perf_counter()
+        counts = {}
+        for i, database in enumerate(source_names):
+            create_database(server, database, schema)
+            counts[database] = populate_source(server, database, args.rows, args.cold_rows, args.seed + i)
+        create_database(server, target_name)
+        source_rows = sum(sum(table_counts.values()) for table_counts in counts.values())
+        results['fases']['carga'] = {'segundos': round(time.perf_counter() - start, 3), 'filas': source_rows}
+
+        # El snapshot, el log de fallos y la caché de esquemas quedan en un directorio temporal
+        os.chdir(workdir)
+        options = {
+            'source_databases': [dict(server, database=database, alias=database) for database in source_names],
+            'target_config': dict(server, database=target_name),
+            'chunk_size': args.chunk_size,
+            'batch_size': args.batch_size,
+            'bulk_load_threshold': args.bulk_load_threshold,
+            'workers': args.workers,
+            'incremental': args.incremental,
+            'server_hash': args.server_hash,
+            'diff_engine': args.diff_engine,
+            'hash_algorithm': args.hash_algorithm,
+            'write_mode': args.write_mode,
+        }
+
+        apertura = run_phase(options, 'apertura', args.verbose)
+        apertura['filas'] = source_rows
+        apertura['filas_por_segundo'] = round(source_rows / apertura['segundos'], 1) if apertura['segundos'] else None
+        apertura['snapshot_bytes'] = SnapshotStore('consolidation_snapshot').total_bytes()
+        results['fases']['apertura'] = apertura
+
+        start = time.perf_counter()
+        changes = {}
+        for i, database in enumerate(source_names):
+            for key, value in mutate_source(server, database, counts[database], args.insert_ratio,
+                                            args.update_ratio, args.delete_ratio, args.seed + i).items():
+                changes[key] = changes.get(key, 0) + value
+        results['fases']['cambios'] = dict(changes, segundos=round(time.perf_counter() - start, 3))
+
+        cierre = run_phase(options, 'cierre', args.verbose)
+        scanned = source_rows + changes['altas'] - changes['bajas']
+        cierre['filas'] = scanned
+        cierre['filas_por_segundo'] = round(scanned / cierre['segundos'], 1) if cierre['segundos'] else None
+        cierre['snapshot_bytes'] = SnapshotStore('consolidation_snapshot').total_bytes()
+        results['fases']['cierre'] = cierre
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        if not args.keep:
+            conn = connect(server)
+            cursor = conn.cursor()
+            for database in source_names + [target_name]:
+                cursor.execute(f"DROP DATABASE IF EXISTS `{database}`")
+            cursor.close()
+            conn.close()
+
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        Path(args.output).write_text(output + '\n', encoding='utf-8')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
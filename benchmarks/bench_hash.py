@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark del hash de filas: función original (conversión por valor +
+generate_record_hash) contra RowHasher con cada algoritmo disponible.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sync import HASH_ALGORITHMS, MySQLDBConsolidator, RowHasher  # noqa: E402
+
+# Columnas parecidas a venta_detalles de db/restaurante.sql
+COLUMN_TYPES = {
+    'id': 'int',
+    'venta_id': 'int',
+    'producto_id': 'int',
+    'cantidad': 'int',
+    'precio_unitario': 'decimal',
+    'insumos_descargados': 'tinyint',
+    'created_at': 'datetime',
+    'entregado_hr': 'datetime',
+    'estado_producto': 'varchar',
+    'observaciones': 'text',
+    'descuento': 'decimal',
+}
+
+
+def generate_rows(count: int, seed: int = 7):
+    random.seed(seed)
+    base = datetime(2025, 9, 1, 8, 0, 0)
+    rows = []
+    for i in range(count):
+        rows.append({
+            'id': i + 1,
+            'venta_id': random.randint(1, count // 4 + 1),
+            'producto_id': random.randint(1, 500),
+            'cantidad': random.randint(1, 6),
+            'precio_unitario': Decimal(random.randint(1000, 90000)) / 100,
+            'insumos_descargados': random.randint(0, 1),
+            'created_at': base + timedelta(seconds=i * 7),
+            'entregado_hr': None if random.random() < 0.3 else base + timedelta(seconds=i * 7 + 600),
+            'estado_producto': random.choice(['pendiente', 'en_preparacion', 'listo', 'entregado']),
+            'observaciones': None if random.random() < 0.8 else 'sin cebolla',
+            'descuento': Decimal('0.00'),
+        })
+    return rows
+
+
+def original_hash(consolidator, rows, all_columns, alias):
+    """Camino anterior: conversión isinstance por valor y generate_record_hash"""
+    hashes = []
+    for row in rows:
+        processed_row = {}
+        for column in all_columns:
+            value = row.get(column)
+            if isinstance(value, datetime):
+                processed_row[column] = value.isoformat()
+            elif value is None:
+                processed_row[column] = None
+            else:
+                processed_row[column] = str(value) if not isinstance(value, (int, float, str, bool)) else value
+        hashes.append(consolidator.generate_record_hash(processed_row, alias))
+    return hashes
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark del hash de filas')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    
+    alias = 'Sucursal 0'
+    all_columns = list(COLUMN_TYPES)
+    rows = generate_rows(args.rows)
+    consolidator = MySQLDBConsolidator([], {})
+    
+    # El motor nuevo con sha256-v1 debe producir exactamente los hashes anteriores
+    legacy = original_hash(consolidator, rows[:1000], all_columns, alias)
+    engine = RowHasher(all_columns, COLUMN_TYPES, alias, 'sha256-v1').hash_rows(rows[:1000])
+    if legacy != [digest.hex() for digest in engine]:
+        raise SystemExit("sha256-v1 no coincide con generate_record_hash")
+    
+    baseline = best_of(args.repeat, lambda: original_hash(consolidator, rows, all_columns, alias))
+    results = {
+        'rows': args.rows,
+        'original': {'seconds': round(baseline, 4), 'rows_per_second': round(args.rows / baseline)},
+        'engine': {}
+    }
+    
+    for version in sorted(HASH_ALGORITHMS):
+        hasher = RowHasher(all_columns, COLUMN_TYPES, alias, version)
+        
+        def hash_in_chunks():
+            for start in range(0, len(rows), 1000):
+                hasher.hash_rows(rows[start:start + 1000])
+        
+        seconds = best_of(args.repeat, hash_in_chunks)
+        results['engine'][version] = {
+            'seconds': round(seconds, 4),
+            'rows_per_second': round(args.rows / seconds),
+            'speedup': round(baseline / seconds, 2)
+        }
+    
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,28 @@ Toma una DB origen y sincroniza estructura con una DB destino.
 import mysql.connector
 from mysql.connector import Error
 import argparse
+import re
 import sys
-from typing import Dict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+# Compartido con sync.py; como script (python db/estructura.py) el directorio db/ ya está en sys.path
+try:
+    from .tipos import parse_column_type, merge_column_types, format_column_type, fit_row_size
+except ImportError:
+    from tipos import parse_column_type, merge_column_types, format_column_type, fit_row_size
 
 class SimpleStructureSync:
-    def __init__(self, source_config: Dict, target_config: Dict):
+    def __init__(self, source_config: Dict, target_config: Dict, write_mode: str = 'append',
+                 dry_run: bool = False, workers: int = 1, rebuild_rate: float = 50.0):
         self.source_config = source_config
         self.target_config = target_config
+        self.write_mode = write_mode  # 'idempotent' / 'changeset': claves únicas que usa sync.py en ese modo
+        self.dry_run = dry_run  # Solo calcular y mostrar el plan
+        self.workers = workers  # Tablas alteradas en paralelo
+        self.rebuild_rate = rebuild_rate  # MB/s supuestos al estimar el costo de reconstruir una tabla
+        self.connections = {}  # (endpoint, hilo) -> conexión abierta
         
         # Columnas de metadatos estándar
         self.metadata_columns = {
@@ -21,11 +36,22 @@ class SimpleStructureSync:
             '_source_database': 'VARCHAR(255) NOT NULL',
             '_source_alias': 'VARCHAR(100) NOT NULL',
             '_sync_timestamp': 'DATETIME DEFAULT CURRENT_TIMESTAMP',
-            '_record_hash': 'VARCHAR(64) NOT NULL'
+            '_record_hash': 'VARCHAR(64) NOT NULL',
+            '_source_key': 'VARCHAR(64) NULL',
+            '_deleted_at': 'DATETIME NULL'
         }
     
     def get_db_connection(self, db_config: Dict) -> mysql.connector.MySQLConnection:
-        """Obtiene conexión a la base de datos MySQL"""
+        """Obtiene conexión a la base de datos MySQL, reutilizando la abierta para el mismo endpoint e hilo"""
+        key = (db_config['host'], db_config.get('port', 3306), db_config['user'], db_config['database'],
+               threading.get_ident())
+        conn = self.connections.get(key)
+        if conn is not None:
+            # is_connected() hace ping; si el servidor cerró la sesión se reconecta
+            if not conn.is_connected():
+                conn.reconnect(attempts=2, delay=1)
+            return conn
+        
         conn = mysql.connector.connect(
             host=db_config['host'],
             user=db_config['user'],
@@ -36,8 +62,15 @@ class SimpleStructureSync:
             collation='utf8mb4_unicode_ci',
             autocommit=False
         )
+        self.connections[key] = conn
         return conn
     
+    def close_connections(self):
+        """Cierra las conexiones reutilizadas"""
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+    
     def get_table_structure(self, conn: mysql.connector.MySQLConnection, database: str) -> Dict[str, Dict]:
         """Obtiene estructura completa de todas las tablas"""
         cursor = conn.cursor(dictionary=True)
@@ -79,52 +112,52 @@ class SimpleStructureSync:
         cursor.close()
         return table_structure
     
-    def convert_to_flexible_mysql_type(self, column_info: Dict) -> str:
-        """Convierte definición de columna a tipo MySQL flexible"""
-        data_type = column_info['DATA_TYPE'].lower()
+    def get_server_capabilities(self, conn: mysql.connector.MySQLConnection) -> Dict:
+        """Versión del servidor y si admite ADD COLUMN con ALGORITHM=INSTANT (MySQL 8.0.12+, MariaDB 10.3.2+)"""
+        cursor = conn.cursor()
+        cursor.execute("SELECT VERSION()")
+        version = cursor.fetchone()[0]
+        cursor.close()
         
-        type_mapping = {
-            'tinyint': 'TINYINT',
-            'smallint': 'SMALLINT', 
-            'mediumint': 'MEDIUMINT',
-            'int': 'INT',
-            'integer': 'INT',
-            'bigint': 'BIGINT',
-            'float': 'FLOAT',
-            'double': 'DOUBLE',
-            'decimal': 'DECIMAL(15,4)',
-            'date': 'DATE',
-            'time': 'TIME',
-            'datetime': 'DATETIME',
-            'timestamp': 'TIMESTAMP',
-            'year': 'YEAR',
-            'char': 'TEXT',
-            'varchar': 'TEXT',
-            'text': 'TEXT',
-            'tinytext': 'TEXT',
-            'mediumtext': 'MEDIUMTEXT',
-            'longtext': 'LONGTEXT',
-            'binary': 'VARBINARY(255)',
-            'varbinary': 'VARBINARY(255)', 
-            'blob': 'BLOB',
-            'tinyblob': 'BLOB',
-            'mediumblob': 'MEDIUMBLOB',
-            'longblob': 'LONGBLOB',
-            'json': 'JSON',
-            'boolean': 'BOOLEAN',
-            'bool': 'BOOLEAN'
+        mariadb = 'mariadb' in version.lower()
+        numbers = tuple(int(part) for part in re.findall(r'\d+', version)[:3])
+        return {
+            'version': version,
+            'instant_add_column': numbers >= ((10, 3, 2) if mariadb else (8, 0, 12))
+        }
+    
+    def get_table_stats(self, conn: mysql.connector.MySQLConnection, database: str) -> Dict[str, Dict]:
+        """Filas y bytes estimados de cada tabla e índices existentes, con dos consultas para todo el esquema"""
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("""
+            SELECT TABLE_NAME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH
+            FROM INFORMATION_SCHEMA.TABLES
+            WHERE TABLE_SCHEMA = %s AND TABLE_TYPE = 'BASE TABLE'
+        """, (database,))
+        stats = {
+            row['TABLE_NAME']: {
+                'rows': int(row['TABLE_ROWS'] or 0),
+                'bytes': int(row['DATA_LENGTH'] or 0) + int(row['INDEX_LENGTH'] or 0),
+                'data_bytes': int(row['DATA_LENGTH'] or 0),
+                'indexes': set()
+            }
+            for row in cursor.fetchall()
         }
         
-        mysql_type = 'TEXT'  # Fallback
-        for key, value in type_mapping.items():
-            if key in data_type:
-                mysql_type = value
-                break
+        cursor.execute("""
+            SELECT DISTINCT TABLE_NAME, INDEX_NAME
+            FROM INFORMATION_SCHEMA.STATISTICS
+            WHERE TABLE_SCHEMA = %s
+        """, (database,))
+        for row in cursor.fetchall():
+            if row['TABLE_NAME'] in stats:
+                stats[row['TABLE_NAME']]['indexes'].add(row['INDEX_NAME'])
         
-        return f"{mysql_type} NULL"
+        cursor.close()
+        return stats
     
-    def sync(self):
-        """Sincroniza estructura de base de datos"""
+    def sync(self) -> List[Dict]:
+        """Sincroniza estructura de base de datos; con dry_run solo calcula y devuelve el plan"""
         # Conectar a ambas bases
         source_conn = self.get_db_connection(self.source_config)
         target_conn = self.get_db_connection(self.target_config)
@@ -132,26 +165,34 @@ class SimpleStructureSync:
         # Obtener estructuras
         source_structure = self.get_table_structure(source_conn, self.source_config['database'])
         target_structure = self.get_table_structure(target_conn, self.target_config['database'])
+        target_stats = self.get_table_stats(target_conn, self.target_config['database'])
+        capabilities = self.get_server_capabilities(target_conn)
         
-        cursor = target_conn.cursor()
-        
-        # Procesar cada tabla de origen
+        # Un plan por tabla con todos sus cambios en una sola sentencia
+        plans = []
         for table_name, table_schema in source_structure.items():
-            
             if table_name not in target_structure:
-                # Crear tabla completa
-                self.create_table_with_metadata(cursor, table_name, table_schema, target_conn)
+                plan = self.plan_create_table(table_name, table_schema)
             else:
-                # Actualizar tabla existente
-                self.update_table_structure(cursor, table_name, table_schema, 
-                                          target_structure[table_name], target_conn)
+                plan = self.plan_table_update(table_name, table_schema, target_structure[table_name],
+                                              target_stats.get(table_name), capabilities)
+            if plan is not None:
+                plans.append(plan)
         
-        cursor.close()
-        source_conn.close()
-        target_conn.close()
+        if self.dry_run:
+            return plans
+        
+        # Las tablas son independientes entre sí: cada worker usa su propia conexión de destino
+        if self.workers > 1 and len(plans) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(self.apply_plan, plans))
+        else:
+            for plan in plans:
+                self.apply_plan(plan)
+        return plans
     
-    def create_table_with_metadata(self, cursor, table_name: str, table_schema: Dict, conn):
-        """Crea una nueva tabla con metadatos"""
+    def plan_create_table(self, table_name: str, table_schema: Dict) -> Dict:
+        """Plan de creación de una tabla nueva con metadatos"""
         columns_sql = []
         
         # Columnas de metadatos primero
@@ -159,11 +200,10 @@ class SimpleStructureSync:
             columns_sql.append(f"`{meta_col}` {meta_type}")
         
         # Columnas originales
+        column_types = fit_row_size({col_name: parse_column_type(table_schema['columns'][col_name]['COLUMN_TYPE'])
+                                     for col_name in table_schema['column_order']})
         for col_name in table_schema['column_order']:
-            if col_name in table_schema['columns']:
-                col_info = table_schema['columns'][col_name]
-                mysql_type = self.convert_to_flexible_mysql_type(col_info)
-                columns_sql.append(f"`{col_name}` {mysql_type}")
+            columns_sql.append(f"`{col_name}` {format_column_type(column_types[col_name])} NULL")
         
         # Índices
         indexes_sql = [
@@ -171,6 +211,10 @@ class SimpleStructureSync:
             "INDEX `idx_sync_timestamp` (`_sync_timestamp`)", 
             "INDEX `idx_record_hash` (`_record_hash`)"
         ]
+        if self.write_mode == 'idempotent':
+            indexes_sql.append("UNIQUE KEY `uk_source_record` (`_source_alias`, `_record_hash`)")
+        elif self.write_mode == 'changeset':
+            indexes_sql.append("UNIQUE KEY `uk_source_key` (`_source_alias`, `_source_key`)")
         
         create_sql = f"""
             CREATE TABLE `{table_name}` (
@@ -178,54 +222,147 @@ class SimpleStructureSync:
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
         """
         
-        cursor.execute(create_sql)
-        conn.commit()
+        return {
+            'table': table_name,
+            'action': 'crear',
+            'statement': create_sql,
+            'before': [],
+            'algorithms': [None],
+            'rebuild': False,
+            'rows': 0,
+            'bytes': 0
+        }
     
-    def update_table_structure(self, cursor, table_name: str, source_schema: Dict, 
-                             target_structure: Dict, conn):
-        """Actualiza estructura de tabla existente"""
+    def plan_table_update(self, table_name: str, source_schema: Dict, target_structure: Dict,
+                          stats: Dict, capabilities: Dict):
+        """Plan de una tabla existente: un único ALTER con todas las columnas e índices que faltan"""
         current_columns = set(target_structure['columns'].keys())
-        source_columns = set(source_schema['columns'].keys())
-        metadata_columns = set(self.metadata_columns.keys())
+        stats = stats or {'rows': 0, 'bytes': 0, 'data_bytes': 0, 'indexes': set()}
+        existing_indexes = stats['indexes']
+        column_operations, index_operations, before = [], [], []
         
-        # Agregar columnas de metadatos faltantes
-        missing_metadata = metadata_columns - current_columns
-        for meta_col in missing_metadata:
-            meta_type = self.metadata_columns[meta_col]
-            alter_sql = f"ALTER TABLE `{table_name}` ADD COLUMN `{meta_col}` {meta_type}"
-            cursor.execute(alter_sql)
-            conn.commit()
-        
-        # Agregar columnas originales faltantes
-        missing_source = source_columns - current_columns
-        for col_name in missing_source:
-            col_info = source_schema['columns'][col_name]
-            mysql_type = self.convert_to_flexible_mysql_type(col_info)
-            alter_sql = f"ALTER TABLE `{table_name}` ADD COLUMN `{col_name}` {mysql_type}"
-            cursor.execute(alter_sql)
-            conn.commit()
+        # Columnas de metadatos faltantes (en su orden habitual)
+        for meta_col, meta_type in self.metadata_columns.items():
+            if meta_col not in current_columns:
+                column_operations.append(f"ADD COLUMN `{meta_col}` {meta_type}")
         
-        # Asegurar índices de metadatos
-        self.ensure_metadata_indexes(cursor, table_name, conn)
-    
-    def ensure_metadata_indexes(self, cursor, table_name: str, conn):
-        """Crea índices de metadatos si no existen"""
-        cursor.execute(f"SHOW INDEX FROM `{table_name}`")
-        existing_indexes = set(row['Key_name'] for row in cursor.fetchall())
+        # Columnas originales faltantes y las que crecieron en la fuente, en el orden de la fuente;
+        # una columna del destino nunca se angosta
+        current_types = {col_name: parse_column_type(info['COLUMN_TYPE'])
+                         for col_name, info in target_structure['columns'].items()}
+        widened = fit_row_size({
+            col_name: merge_column_types(current_types.get(col_name),
+                                         parse_column_type(source_schema['columns'][col_name]['COLUMN_TYPE']))
+            for col_name in source_schema['column_order']
+        })
+        for col_name in source_schema['column_order']:
+            mysql_type = format_column_type(widened[col_name])
+            if col_name not in current_columns:
+                column_operations.append(f"ADD COLUMN `{col_name}` {mysql_type} NULL")
+            elif widened[col_name] != current_types[col_name]:
+                column_operations.append(f"MODIFY COLUMN `{col_name}` {mysql_type} NULL")
         
+        # Índices de metadatos
         required_indexes = {
-            'idx_source_alias': f'CREATE INDEX `idx_source_alias` ON `{table_name}` (`_source_alias`)',
-            'idx_sync_timestamp': f'CREATE INDEX `idx_sync_timestamp` ON `{table_name}` (`_sync_timestamp`)',
-            'idx_record_hash': f'CREATE INDEX `idx_record_hash` ON `{table_name}` (`_record_hash`)'
+            'idx_source_alias': "ADD INDEX `idx_source_alias` (`_source_alias`)",
+            'idx_sync_timestamp': "ADD INDEX `idx_sync_timestamp` (`_sync_timestamp`)",
+            'idx_record_hash': "ADD INDEX `idx_record_hash` (`_record_hash`)"
         }
-        
-        for index_name, index_sql in required_indexes.items():
+        if self.write_mode == 'idempotent':
+            required_indexes['uk_source_record'] = "ADD UNIQUE KEY `uk_source_record` (`_source_alias`, `_record_hash`)"
+            if 'uk_source_record' not in existing_indexes and '_record_hash' in current_columns:
+                # Los duplicados ya consolidados impedirían crear la clave única
+                before.append(self.dedupe_records_sql(table_name))
+        elif self.write_mode == 'changeset':
+            # Las filas previas tienen _source_key NULL y no chocan entre sí
+            required_indexes['uk_source_key'] = "ADD UNIQUE KEY `uk_source_key` (`_source_alias`, `_source_key`)"
+        for index_name, operation in required_indexes.items():
             if index_name not in existing_indexes:
+                index_operations.append(operation)
+        
+        if not column_operations and not index_operations:
+            return None
+        
+        # INSTANT solo aplica si todo son columnas nuevas sin AUTO_INCREMENT; si el servidor rechaza un
+        # algoritmo se prueba el siguiente y, al final, el que elija el servidor
+        instant = (capabilities['instant_add_column'] and not index_operations
+                   and all(operation.startswith('ADD COLUMN') and 'AUTO_INCREMENT' not in operation
+                           for operation in column_operations))
+        algorithms = ['ALGORITHM=INSTANT'] if instant else []
+        algorithms += ['ALGORITHM=INPLACE, LOCK=NONE', None]
+        
+        return {
+            'table': table_name,
+            'action': 'alterar',
+            'statement': f"ALTER TABLE `{table_name}` " + ', '.join(column_operations + index_operations),
+            'before': before,
+            'algorithms': algorithms,
+            # Sin INSTANT, agregar o ensanchar columnas reconstruye la tabla; los índices solo la recorren
+            'rebuild': bool(column_operations) and not instant,
+            'rows': stats['rows'],
+            'bytes': stats['bytes'] if column_operations else stats['data_bytes']
+        }
+    
+    def dedupe_records_sql(self, table_name: str) -> str:
+        """Elimina registros duplicados por (alias, hash) antes de agregar la clave única"""
+        return f"""
+            DELETE duplicate FROM `{table_name}` duplicate
+            JOIN `{table_name}` original
+              ON original.`_source_alias` = duplicate.`_source_alias`
+             AND original.`_record_hash` = duplicate.`_record_hash`
+             AND original.`_consolidation_id` < duplicate.`_consolidation_id`
+        """
+    
+    def apply_plan(self, plan: Dict):
+        """Ejecuta el plan de una tabla probando los algoritmos de más a menos en línea"""
+        conn = self.get_db_connection(self.target_config)
+        cursor = conn.cursor()
+        try:
+            for statement in plan['before']:
+                cursor.execute(statement)
+            
+            for position, algorithm in enumerate(plan['algorithms']):
+                statement = plan['statement'] + (f", {algorithm}" if algorithm else '')
                 try:
-                    cursor.execute(index_sql)
-                    conn.commit()
-                except mysql.connector.Error:
-                    pass  # Ignorar errores de índices duplicados
+                    cursor.execute(statement)
+                    break
+                except mysql.connector.Error as e:
+                    # 1845/1846: el algoritmo o el nivel de bloqueo no se admite para estos cambios
+                    if e.errno not in (1845, 1846) or position == len(plan['algorithms']) - 1:
+                        raise
+            conn.commit()
+        finally:
+            cursor.close()
+    
+    def estimate_cost(self, plan: Dict) -> str:
+        """Costo estimado de un plan a partir del tamaño de la tabla"""
+        if plan['action'] == 'crear':
+            return "tabla nueva"
+        if plan['algorithms'][0] == 'ALGORITHM=INSTANT':
+            return "instantáneo (solo metadatos)"
+        seconds = plan['bytes'] / (self.rebuild_rate * 1024 * 1024)
+        work = "reconstruye la tabla" if plan['rebuild'] else "recorre la tabla para crear índices"
+        return (f"{work}: ~{plan['rows']} filas, {plan['bytes'] / (1024 * 1024):.1f} MB, "
+                f"~{seconds:.0f} s a {self.rebuild_rate:g} MB/s")
+    
+    def format_plan(self, plans: List[Dict]) -> str:
+        """Texto del plan para --dry-run"""
+        if not plans:
+            return "Sin cambios de estructura"
+        lines = []
+        for plan in plans:
+            algorithm = plan['algorithms'][0]
+            statement = ' '.join(plan['statement'].split())
+            lines.append(f"{plan['table']}: {statement}" + (f", {algorithm}" if algorithm else ''))
+            for statement in plan['before']:
+                lines.append(f"  antes: {' '.join(statement.split())}")
+            lines.append(f"  costo: {self.estimate_cost(plan)}")
+        rebuilt = [plan for plan in plans if plan['rebuild']]
+        total_bytes = sum(plan['bytes'] for plan in plans if plan['action'] == 'alterar'
+                          and plan['algorithms'][0] != 'ALGORITHM=INSTANT')
+        lines.append(f"Total: {len(plans)} tablas, {len(rebuilt)} reconstrucciones, "
+                     f"{total_bytes / (1024 * 1024):.1f} MB a procesar")
+        return '\n'.join(lines)
 
 def parse_mysql_config(config_string: str) -> Dict:
     """Parsea configuración MySQL: host:user:password:database[:port]"""
@@ -249,6 +386,14 @@ def main():
     parser = argparse.ArgumentParser(description='Sincronización simple de estructura MySQL')
     parser.add_argument('source', help='DB origen: host:user:password:database[:port]')
     parser.add_argument('target', help='DB destino: host:user:password:database[:port]')
+    parser.add_argument('--write-mode', choices=['append', 'idempotent', 'changeset'], default='append',
+                       help='Mantener la clave única que usa sync.py con el mismo --write-mode')
+    parser.add_argument('--dry-run', action='store_true',
+                       help='Mostrar el plan por tabla y su costo estimado sin modificar el destino')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Tablas alteradas en paralelo, cada una con su propia conexión')
+    parser.add_argument('--rebuild-rate', type=float, default=50.0,
+                       help='MB/s supuestos para estimar el costo de reconstruir una tabla')
     
     args = parser.parse_args()
     
@@ -256,10 +401,17 @@ def main():
         source_config = parse_mysql_config(args.source)
         target_config = parse_mysql_config(args.target)
         
-        syncer = SimpleStructureSync(source_config, target_config)
-        syncer.sync()
+        syncer = SimpleStructureSync(source_config, target_config, args.write_mode,
+                                     dry_run=args.dry_run, workers=args.workers, rebuild_rate=args.rebuild_rate)
+        try:
+            plans = syncer.sync()
+        finally:
+            syncer.close_connections()
         
-        print("Estructura sincronizada exitosamente")
+        if args.dry_run:
+            print(syncer.format_plan(plans))
+        else:
+            print(f"Estructura sincronizada exitosamente ({len(plans)} tablas modificadas)")
         
     except Exception as e:
         print(f"Error: {e}")
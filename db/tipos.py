@@ -0,0 +1,204 @@
+"""
+Motor de tipos compartido por sync.py y db/estructura.py: une los COLUMN_TYPE de varias fuentes en el
+tipo MySQL más angosto que admite a todos, para que ambos scripts generen las mismas columnas.
+"""
+
+import re
+from typing import Dict
+
+INTEGER_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'bigint')  # De menor a mayor
+INTEGER_DIGITS = {'tinyint': 3, 'smallint': 5, 'mediumint': 8, 'int': 10, 'bigint': 20}
+TEXT_TYPES = {'tinytext': 255, 'text': 65535, 'mediumtext': 16777215, 'longtext': 4294967295}  # Capacidad en bytes
+BLOB_TYPES = {'tinyblob': 255, 'blob': 65535, 'mediumblob': 16777215, 'longblob': 4294967295}
+TYPE_ALIASES = {'integer': 'int', 'bool': 'tinyint', 'boolean': 'tinyint', 'numeric': 'decimal', 'dec': 'decimal',
+                'fixed': 'decimal', 'real': 'double', 'double precision': 'double'}
+MAX_DECIMAL_PRECISION = 65
+MAX_DECIMAL_SCALE = 30
+MAX_ROW_VARCHAR_BYTES = 60000  # Margen bajo el límite de 65535 bytes por fila de InnoDB
+
+
+def parse_column_type(column_type: str) -> Dict:
+    """Descompone un COLUMN_TYPE (varchar(80), int(10) unsigned, decimal(12,3), enum('a','b'), ...)"""
+    text = column_type.strip().lower()
+    match = re.match(r"(double precision|[a-z]+)\s*(?:\((.*)\))?\s*([a-z ]*)$", text)
+    if not match:
+        return {'kind': 'other', 'base': text}
+    base = TYPE_ALIASES.get(match.group(1), match.group(1))
+    args = match.group(2)
+    unsigned = 'unsigned' in match.group(3)
+    numbers = [int(number) for number in re.findall(r'\d+', args or '')]
+    
+    if base in INTEGER_TYPES:
+        if match.group(1) in ('bool', 'boolean'):
+            return {'kind': 'integer', 'base': 'tinyint', 'unsigned': False}
+        return {'kind': 'integer', 'base': base, 'unsigned': unsigned}
+    if base == 'decimal':
+        precision = numbers[0] if numbers else 10
+        return {'kind': 'decimal', 'precision': precision, 'scale': numbers[1] if len(numbers) > 1 else 0,
+                'unsigned': unsigned}
+    if base in ('float', 'double'):
+        return {'kind': 'float', 'base': base}
+    if base in ('char', 'varchar'):
+        # Sin longitud (DATA_TYPE de un caché anterior) no hay forma de acotar el tamaño
+        return {'kind': 'string', 'base': base, 'size': numbers[0] if numbers else None}
+    if base in TEXT_TYPES:
+        return {'kind': 'text', 'base': base}
+    if base in ('binary', 'varbinary'):
+        return {'kind': 'binary', 'base': base, 'size': numbers[0] if numbers else None}
+    if base in BLOB_TYPES:
+        return {'kind': 'blob', 'base': base}
+    if base in ('enum', 'set'):
+        return {'kind': base, 'values': re.findall(r"'((?:[^']|'')*)'", args or '')}
+    if base in ('date', 'time', 'datetime', 'timestamp', 'year'):
+        return {'kind': 'temporal', 'base': base, 'fsp': numbers[0] if numbers and base != 'year' else 0}
+    if base == 'json':
+        return {'kind': 'json'}
+    if base == 'bit':
+        return {'kind': 'bit', 'size': numbers[0] if numbers else 1}
+    return {'kind': 'other', 'base': text}
+
+def character_length(column: Dict):
+    """Caracteres necesarios para guardar como texto cualquier valor del tipo (None = sin límite conocido)"""
+    kind = column['kind']
+    if kind == 'string':
+        return column['size']
+    if kind == 'integer':
+        return INTEGER_DIGITS[column['base']] + 1
+    if kind == 'decimal':
+        return column['precision'] + 2
+    if kind == 'float':
+        return 24
+    if kind == 'temporal':
+        return 26
+    if kind == 'enum':
+        return max((len(value) for value in column['values']), default=1)
+    if kind == 'set':
+        return max(sum(len(value) + 1 for value in column['values']), 1)
+    if kind == 'bit':
+        return column['size']
+    return None
+
+def text_type_for(length) -> Dict:
+    """TEXT más chico que admite length caracteres en utf8mb4"""
+    if length is not None:
+        for base, capacity in TEXT_TYPES.items():
+            if length * 4 <= capacity:
+                return {'kind': 'text', 'base': base}
+    return {'kind': 'text', 'base': 'longtext'}
+
+def merge_column_types(current: Dict, other: Dict) -> Dict:
+    """Tipo más angosto que admite los valores de ambos tipos"""
+    if current is None or current == other:
+        return other
+    if other is None:
+        return current
+    kinds = {current['kind'], other['kind']}
+    
+    if kinds == {'integer'}:
+        signed = [column for column in (current, other) if not column['unsigned']]
+        unsigned = [column for column in (current, other) if column['unsigned']]
+        rank = max(INTEGER_TYPES.index(column['base']) for column in signed + unsigned)
+        if signed and unsigned:
+            # Un rango sin signo solo entra en el siguiente tamaño con signo
+            rank = max([INTEGER_TYPES.index(column['base']) for column in signed] +
+                       [INTEGER_TYPES.index(column['base']) + 1 for column in unsigned])
+            if rank >= len(INTEGER_TYPES):
+                return {'kind': 'decimal', 'precision': 20, 'scale': 0, 'unsigned': False}
+        return {'kind': 'integer', 'base': INTEGER_TYPES[rank], 'unsigned': not signed}
+    
+    if kinds <= {'integer', 'decimal'}:
+        decimals = [column if column['kind'] == 'decimal' else
+                    {'precision': INTEGER_DIGITS[column['base']], 'scale': 0, 'unsigned': column['unsigned']}
+                    for column in (current, other)]
+        scale = min(max(column['scale'] for column in decimals), MAX_DECIMAL_SCALE)
+        integer_digits = max(column['precision'] - column['scale'] for column in decimals)
+        if integer_digits + scale > MAX_DECIMAL_PRECISION:
+            return {'kind': 'float', 'base': 'double'}
+        return {'kind': 'decimal', 'precision': integer_digits + scale, 'scale': scale,
+                'unsigned': all(column['unsigned'] for column in decimals)}
+    
+    if kinds <= {'integer', 'decimal', 'float'}:
+        if kinds == {'float'} and current['base'] == other['base'] == 'float':
+            return current
+        return {'kind': 'float', 'base': 'double'}
+    
+    if kinds == {'temporal'}:
+        fsp = max(current['fsp'], other['fsp'])
+        if current['base'] == other['base']:
+            return dict(current, fsp=fsp)
+        if {current['base'], other['base']} <= {'date', 'datetime', 'timestamp'}:
+            # DATETIME cubre el rango de DATE y de TIMESTAMP
+            return {'kind': 'temporal', 'base': 'datetime', 'fsp': fsp}
+    
+    if kinds in ({'enum'}, {'set'}):
+        values = current['values'] + [value for value in other['values'] if value not in current['values']]
+        if len(values) <= (64 if kinds == {'set'} else 65535):
+            return {'kind': current['kind'], 'values': values}
+    
+    if kinds == {'bit'}:
+        return {'kind': 'bit', 'size': max(current['size'], other['size'])}
+    
+    if kinds <= {'binary', 'blob'}:
+        if kinds == {'binary'} and current['size'] and other['size']:
+            base = 'binary' if current['base'] == other['base'] == 'binary' else 'varbinary'
+            return {'kind': 'binary', 'base': base, 'size': max(current['size'], other['size'])}
+        capacity = max(BLOB_TYPES.get(column.get('base'), column.get('size') or BLOB_TYPES['longblob'])
+                       for column in (current, other))
+        return {'kind': 'blob', 'base': next(base for base, size in BLOB_TYPES.items() if size >= capacity)}
+    
+    if kinds & {'binary', 'blob', 'json', 'other'}:
+        return {'kind': 'text', 'base': 'longtext'}
+    
+    # Tipos distintos: se guardan como texto con la longitud que necesite el más largo
+    lengths = [character_length(column) for column in (current, other)]
+    if 'text' in kinds or None in lengths:
+        # Un VARCHAR sin longitud conocida se trata como TEXT, igual que antes
+        capacity = max(TEXT_TYPES[column['base']] if column['kind'] == 'text' else
+                       TEXT_TYPES[text_type_for(length)['base']] if length is not None else TEXT_TYPES['text']
+                       for column, length in zip((current, other), lengths))
+        return {'kind': 'text', 'base': next(base for base, size in TEXT_TYPES.items() if size >= capacity)}
+    base = 'char' if current.get('base') == other.get('base') == 'char' else 'varchar'
+    return {'kind': 'string', 'base': base, 'size': max(lengths)}
+
+def format_column_type(column: Dict) -> str:
+    """Definición SQL del tipo (sin NULL/NOT NULL)"""
+    kind = column['kind']
+    if kind == 'integer':
+        return column['base'].upper() + (' UNSIGNED' if column['unsigned'] else '')
+    if kind == 'decimal':
+        return f"DECIMAL({column['precision']},{column['scale']})" + (' UNSIGNED' if column['unsigned'] else '')
+    if kind == 'string':
+        return f"{column['base'].upper()}({column['size']})" if column['size'] else 'TEXT'
+    if kind == 'binary':
+        return f"{column['base'].upper()}({column['size']})" if column['size'] else 'BLOB'
+    if kind in ('enum', 'set'):
+        # Los valores conservan el escape de COLUMN_TYPE (comillas duplicadas)
+        values = ', '.join("'" + value + "'" for value in column['values'])
+        return f"{kind.upper()}({values})"
+    if kind == 'temporal':
+        return column['base'].upper() + (f"({column['fsp']})" if column['fsp'] else '')
+    if kind == 'bit':
+        return f"BIT({column['size']})"
+    if kind == 'other':
+        return column['base'].upper()
+    return column.get('base', kind).upper()
+
+def fit_row_size(columns: Dict[str, Dict]) -> Dict[str, Dict]:
+    """Pasa a TEXT/BLOB los VARCHAR más largos mientras la fila supere el límite de InnoDB"""
+    columns = dict(columns)
+    
+    def row_bytes(column: Dict) -> int:
+        if column['kind'] == 'string' and column['size']:
+            return column['size'] * 4
+        if column['kind'] == 'binary' and column['size']:
+            return column['size']
+        return 0
+    
+    while sum(row_bytes(column) for column in columns.values()) > MAX_ROW_VARCHAR_BYTES:
+        name = max(columns, key=lambda column_name: row_bytes(columns[column_name]))
+        column = columns[name]
+        if column['kind'] == 'string':
+            columns[name] = text_type_for(column['size'])
+        else:
+            columns[name] = {'kind': 'blob', 'base': 'blob' if column['size'] <= 65535 else 'mediumblob'}
+    return columns
@@ -4,19 +4,1589 @@ import json
 import logging
 import argparse
 import sys
-from datetime import datetime
-from typing import Dict, List, Tuple, Set, Any
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple, Set, Any, Iterator, Iterable
 from pathlib import Path
 import time
 import hashlib
+import re
+import os
+import mmap
+import struct
+import heapq
+import tempfile
+import threading
+import sqlite3
+import base64
+import queue
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlparse, parse_qs
+from itertools import chain, groupby
+from collections import Counter, deque
+from bisect import bisect_left, bisect_right
+from db.tipos import parse_column_type, merge_column_types, format_column_type, fit_row_size
+
+# Formato binario del snapshot: cabecera fija + bloques de digests ordenados + índice JSON
+SNAPSHOT_MAGIC = b'VWSNAP01'
+SNAPSHOT_HEADER = struct.Struct('<8sQQ')  # magic, offset del índice, longitud del índice
+HASH_VERSION = 'sha256-v1'  # Hash calculado en Python sobre la fila convertida (formato original)
+SERVER_HASH_VERSION = 'sql-sha256-v1'  # Hash calculado por MySQL (SHA2 sobre la expresión canónica)
+DIGEST_SIZE = 32
+KEY_SIZE = 16  # Hash de la clave primaria en las entradas (clave, digest) del modo changeset
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    # Opcional: solo lo usa el modo cdc (paquete mysql-replication)
+    from pymysqlreplication import BinLogStreamReader
+    from pymysqlreplication.row_event import DeleteRowsEvent, UpdateRowsEvent, WriteRowsEvent
+except ImportError:
+    BinLogStreamReader = None
+
+try:
+    import fcntl  # Bloqueo de archivos entre procesos (no existe en Windows)
+except ImportError:
+    fcntl = None
+
+# Versión de hash -> (función sobre bytes, tamaño del digest). Todas usan la misma cadena canónica
+HASH_ALGORITHMS = {
+    'sha256-v1': (lambda data: hashlib.sha256(data).digest(), 32),
+    'blake2b-v2': (lambda data: hashlib.blake2b(data, digest_size=32).digest(), 32),
+}
+XXH3_HASH_VERSION = 'xxh3-v2'  # Opcional: requiere xxhash donde corran la apertura y el cierre
+if xxhash is not None:
+    HASH_ALGORITHMS[XXH3_HASH_VERSION] = (xxhash.xxh3_128_digest, 16)
+HASH_VERSIONS = sorted(set(HASH_ALGORITHMS) | {XXH3_HASH_VERSION})
+
+
+def require_hash_version(version: str) -> str:
+    """Falla con un mensaje claro si la versión de hash no se puede calcular en este entorno"""
+    if version in HASH_ALGORITHMS or version == SERVER_HASH_VERSION:
+        return version
+    if version == XXH3_HASH_VERSION:
+        raise ValueError(f"La versión de hash {version} requiere el paquete xxhash (pip install xxhash)")
+    raise ValueError(f"Versión de hash no soportada: {version}")
+
+
+class RowHasher:
+    """Hash de filas de una tabla con el orden de columnas y los serializadores precalculados"""
+    
+    def __init__(self, all_columns: List[str], column_types: Dict[str, str], source_alias: str,
+                 hash_version: str = HASH_VERSION):
+        self.hash_version = hash_version
+        self.hash_function, self.digest_size = HASH_ALGORITHMS[hash_version]
+        self.prefix = f"{source_alias}:"
+        
+        # Misma cadena que generate_record_hash: "alias:col:valor|col:NULL|..." con columnas ordenadas
+        self.plan = []
+        for column in sorted(all_columns):
+            data_type = (column_types.get(column) or '').lower()
+            if data_type in ('datetime', 'timestamp'):
+                serializer = self._serialize_datetime
+            else:
+                serializer = str
+            self.plan.append((column, f"{column}:", serializer))
+    
+    @staticmethod
+    def _serialize_datetime(value) -> str:
+        return value.isoformat() if isinstance(value, datetime) else str(value)
+    
+    def canonical(self, row: Dict) -> bytes:
+        parts = [self.prefix]
+        append = parts.append
+        for column, label, serializer in self.plan:
+            value = row.get(column)
+            append(label)
+            append('NULL' if value is None else serializer(value))
+            append('|')
+        return ''.join(parts).encode('utf-8')
+    
+    def hash_row(self, row: Dict) -> bytes:
+        return self.hash_function(self.canonical(row))
+    
+    def hash_rows(self, rows: List[Dict]) -> List[bytes]:
+        """Digests de un bloque de filas"""
+        hash_function = self.hash_function
+        canonical = self.canonical
+        return [hash_function(canonical(row)) for row in rows]
+
+
+class KeyHasher(RowHasher):
+    """Hash de 16 bytes de la clave primaria: identifica una fila aunque cambien sus demás columnas"""
+    
+    def __init__(self, primary_key: List[str], column_types: Dict[str, str], source_alias: str):
+        super().__init__(primary_key, column_types, source_alias)
+        self.hash_function = lambda data: hashlib.blake2b(data, digest_size=KEY_SIZE).digest()
+        self.digest_size = KEY_SIZE
+
+TARGET_SCHEMA_VERSION = 4  # Incrementar al cambiar el DDL de las tablas consolidadas
+
+
+def iter_fixed_records(f, record_size: int, block_records: int = 65536) -> Iterator[bytes]:
+    """Lee registros de tamaño fijo de un archivo binario por bloques"""
+    while True:
+        block = f.read(record_size * block_records)
+        if not block:
+            break
+        for i in range(0, len(block), record_size):
+            yield block[i:i + record_size]
+
+
+def iter_sorted_digests(digests: Iterable[bytes], digest_size: int = DIGEST_SIZE,
+                        run_size: int = 1000000) -> Iterator[bytes]:
+    """Ordena digests con memoria acotada: runs ordenados en disco + merge"""
+    runs = []
+    buffer = []
+    try:
+        for digest in digests:
+            buffer.append(digest)
+            if len(buffer) >= run_size:
+                buffer.sort()
+                run = tempfile.TemporaryFile()
+                run.write(b''.join(buffer))
+                run.seek(0)
+                runs.append(run)
+                buffer = []
+        buffer.sort()
+        
+        if not runs:
+            yield from buffer
+            return
+        
+        streams = [iter_fixed_records(run, digest_size) for run in runs]
+        streams.append(iter(buffer))
+        yield from heapq.merge(*streams)
+    finally:
+        for run in runs:
+            run.close()
+
+
+class SortedSpool:
+    """Entradas (digest, clave) que se leen ordenadas por digest con memoria acotada: al superar el
+    presupuesto el tramo en memoria se ordena y se vuelca a un archivo temporal, y al leer se hace un merge"""
+    
+    MERGE_FAN_IN = 16  # Tramos del mismo nivel que se funden en uno: los archivos abiertos crecen con el logaritmo
+    
+    def __init__(self, budget: int = 0):
+        self.budget = budget  # Bytes en memoria antes de volcar un tramo (0 = sin límite)
+        self.buffer = []
+        self.buffered = 0
+        self.runs = []
+        self.levels = []  # Nivel de cada tramo (0 = volcado de memoria); no crece a lo largo de la lista
+        self.count = 0
+    
+    def add(self, digest: bytes, key: str = ''):
+        line = f"{digest.hex()}\t{key}\n"
+        self.buffer.append(line)
+        self.buffered += sys.getsizeof(line) + 8
+        self.count += 1
+        if self.budget and self.buffered >= self.budget:
+            self._spill()
+    
+    def _spill(self):
+        self.buffer.sort()
+        run = tempfile.TemporaryFile('w+', encoding='utf-8')
+        run.writelines(self.buffer)
+        self.runs.append(run)
+        self.levels.append(0)
+        self.buffer = []
+        self.buffered = 0
+        
+        fan_in = self.MERGE_FAN_IN
+        while len(self.levels) >= fan_in and len(set(self.levels[-fan_in:])) == 1:
+            runs = self.runs[-fan_in:]
+            merged = tempfile.TemporaryFile('w+', encoding='utf-8')
+            for run in runs:
+                run.seek(0)
+            merged.writelines(heapq.merge(*runs))
+            for run in runs:
+                run.close()
+            self.runs[-fan_in:] = [merged]
+            self.levels[-fan_in:] = [self.levels[-1] + 1]
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def __iter__(self) -> Iterator[Tuple[bytes, str]]:
+        self.buffer.sort()
+        for run in self.runs:
+            run.seek(0)
+        for line in heapq.merge(*self.runs, self.buffer):
+            digest, key = line.rstrip('\n').split('\t', 1)
+            yield bytes.fromhex(digest), key
+    
+    def digests(self) -> Iterator[bytes]:
+        for digest, _ in self:
+            yield digest
+    
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.levels = []
+        self.buffer = []
+    
+    def __enter__(self) -> 'SortedSpool':
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DigestMultiset:
+    """Multiconjunto de digests ordenado en un archivo temporal mapeado: take() consume una aparición.
+    En memoria solo queda un byte por entrada que marca las ya consumidas"""
+    
+    def __init__(self, digests: Iterable[bytes], budget: int = 0):
+        self.file = tempfile.TemporaryFile()
+        try:
+            with SortedSpool(budget) as spool:
+                for digest in digests:
+                    spool.add(digest)
+                digest_size = 0
+                for digest in spool.digests():
+                    digest_size = len(digest)
+                    self.file.write(digest)
+                self.file.flush()
+            count = len(spool)
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if count else b''
+        except BaseException:
+            self.file.close()
+            raise
+        self.index = DigestIndex(self.buffer, 0, count, digest_size or DIGEST_SIZE)
+        self.taken = bytearray(count)
+    
+    def __len__(self) -> int:
+        return len(self.index)
+    
+    def take(self, digest: bytes) -> bool:
+        """Consume una aparición del digest; False si no quedan"""
+        lo, hi = 0, len(self.index)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.index[mid] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < len(self.index) and self.index[lo] == digest:
+            if not self.taken[lo]:
+                self.taken[lo] = 1
+                return True
+            lo += 1
+        return False
+    
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+    
+    def __enter__(self) -> 'DigestMultiset':
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def close_spools(updates: Iterable[Dict]):
+    """Cierra los digests en disco (SortedSpool) de avances de snapshot que ya no se van a aplicar"""
+    for update in updates:
+        if isinstance(update.get('digests'), SortedSpool):
+            update['digests'].close()
+
+
+def merge_new_entries(entries: Iterable[Tuple[bytes, str]], snapshot_digests: Iterable[bytes]) -> Iterator[Tuple[bytes, str]]:
+    """Entradas (digest, clave) ordenadas cuyo digest no está en los digests ordenados del snapshot;
+    ambos lados se recorren una sola vez en orden"""
+    snapshot_iter = iter(snapshot_digests)
+    current = next(snapshot_iter, None)
+    for digest, key in entries:
+        while current is not None and current < digest:
+            current = next(snapshot_iter, None)
+        if current != digest:
+            yield digest, key
+
+
+def record_key(record: Dict, primary_key: List[str]) -> str:
+    """PK de una fila como JSON (misma forma al volcarla y al buscarla)"""
+    return json.dumps([record.get(column) for column in primary_key], default=encode_record_value)
+
+
+class DigestIndex:
+    """Conjunto ordenado de digests sobre un buffer (mmap) con búsqueda binaria"""
+    
+    def __init__(self, buffer, offset: int, count: int, digest_size: int = DIGEST_SIZE):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+        self.digest_size = digest_size
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def __getitem__(self, i: int) -> bytes:
+        start = self.offset + i * self.digest_size
+        return self.buffer[start:start + self.digest_size]
+    
+    def __contains__(self, digest: bytes) -> bool:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self[mid]
+            if value < digest:
+                lo = mid + 1
+            elif value > digest:
+                hi = mid
+            else:
+                return True
+        return False
+    
+    def __iter__(self) -> Iterator[bytes]:
+        for i in range(self.count):
+            yield self[i]
+
+
+class KeyedDigestIndex:
+    """Entradas (hash de clave, digest) ordenadas por clave sobre un buffer (mmap)"""
+    
+    def __init__(self, buffer, offset: int, count: int, key_size: int = KEY_SIZE, digest_size: int = DIGEST_SIZE):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+        self.key_size = key_size
+        self.record_size = key_size + digest_size
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def key(self, i: int) -> bytes:
+        start = self.offset + i * self.record_size
+        return self.buffer[start:start + self.key_size]
+    
+    def digest(self, i: int) -> bytes:
+        start = self.offset + i * self.record_size + self.key_size
+        return self.buffer[start:start + self.record_size - self.key_size]
+    
+    def find(self, key: bytes) -> int:
+        """Posición de la clave o -1 si no estaba en el snapshot"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self.key(mid)
+            if value < key:
+                lo = mid + 1
+            elif value > key:
+                hi = mid
+            else:
+                return mid
+        return -1
+    
+    def __iter__(self) -> Iterator[bytes]:
+        for i in range(self.count):
+            start = self.offset + i * self.record_size
+            yield self.buffer[start:start + self.record_size]
+
+
+def merge_keyed_records(existing: Iterable[bytes], changed: List[bytes], deleted: Set[bytes],
+                        key_size: int = KEY_SIZE) -> Iterator[bytes]:
+    """Une entradas (clave, digest) ordenadas: las cambiadas reemplazan a las previas y las eliminadas se omiten"""
+    changed_keys = {record[:key_size] for record in changed}
+    for record in heapq.merge((record for record in existing if record[:key_size] not in changed_keys), changed):
+        if record[:key_size] not in deleted:
+            yield record
+
+
+class BinarySnapshotWriter:
+    """Escribe el snapshot binario de forma incremental, tabla por tabla"""
+    
+    def __init__(self, path: str, hash_version: str = HASH_VERSION, digest_size: int = DIGEST_SIZE):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.digest_size = digest_size
+        self.index = {
+            'format': 1,
+            'hash_version': hash_version,
+            'digest_size': digest_size,
+            'timestamp': None,
+            'sources': {}
+        }
+        self.f = open(self.tmp_path, 'wb')
+        self.f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, 0, 0))
+    
+    def add_table(self, alias: str, database: str, table_name: str, all_columns: List[str],
+                  digests: Iterable[bytes], meta: Dict = None, presorted: bool = False, key_size: int = 0) -> int:
+        """Escribe el bloque ordenado de digests (o de entradas clave + digest) de una tabla y lo registra en el índice"""
+        if not presorted:
+            digests = iter_sorted_digests(digests, key_size + self.digest_size)
+        offset = self.f.tell()
+        count = self._write_blocks(digests, self.f)
+        self._register(alias, database, table_name, all_columns, offset, count, meta, key_size)
+        return count
+    
+    def _write_blocks(self, digests: Iterable[bytes], f) -> int:
+        count = 0
+        block = []
+        for digest in digests:
+            block.append(digest)
+            if len(block) >= 65536:
+                f.write(b''.join(block))
+                count += len(block)
+                block = []
+        f.write(b''.join(block))
+        return count + len(block)
+    
+    def _register(self, alias: str, database: str, table_name: str, all_columns: List[str], offset: int,
+                  count: int, meta: Dict, key_size: int):
+        source = self.index['sources'].setdefault(alias, {'database': database, 'alias': alias, 'tables': {}})
+        source['tables'][table_name] = {
+            'all_columns': all_columns,
+            'offset': offset,
+            'count': count
+        }
+        if key_size:
+            source['tables'][table_name]['key_size'] = key_size
+        # Metadatos calculados mientras se consumían los digests (p. ej. watermark)
+        source['tables'][table_name].update(meta or {})
+    
+    def close(self, timestamp: str):
+        """Escribe el índice, completa la cabecera y reemplaza el archivo de forma atómica"""
+        self.index['timestamp'] = timestamp
+        index_bytes = json.dumps(self.index).encode('utf-8')
+        index_offset = self.f.tell()
+        self.f.write(index_bytes)
+        self.f.seek(0)
+        self.f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, index_offset, len(index_bytes)))
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+    
+    def abort(self):
+        """Descarta el archivo temporal tras un error"""
+        self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class BinarySnapshot:
+    """Snapshot binario mapeado en memoria; solo lee los digests que se consultan"""
+    
+    def __init__(self, path: str):
+        self.f = open(path, 'rb')
+        self.buffer = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = SNAPSHOT_HEADER.unpack_from(self.buffer, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} no es un snapshot binario válido")
+        self.index = json.loads(self.buffer[index_offset:index_offset + index_length].decode('utf-8'))
+        self.hash_version = self.index['hash_version']
+        self.digest_size = self.index['digest_size']
+        self.timestamp = self.index['timestamp']
+        self.sources = self.index['sources']
+    
+    def table(self, alias: str, table_name: str):
+        """Devuelve el índice de digests de una tabla o None si no está en el snapshot"""
+        table = self.sources.get(alias, {}).get('tables', {}).get(table_name)
+        if table is None:
+            return None
+        if table.get('key_size'):
+            return KeyedDigestIndex(self.buffer, table['offset'], table['count'], table['key_size'],
+                                    self.index['digest_size'])
+        return DigestIndex(self.buffer, table['offset'], table['count'], self.index['digest_size'])
+    
+    def table_meta(self, alias: str, table_name: str) -> Dict:
+        """Metadatos guardados junto a la tabla (watermark, columnas)"""
+        return self.sources.get(alias, {}).get('tables', {}).get(table_name) or {}
+    
+    def close(self):
+        self.buffer.close()
+        self.f.close()
+
+
+class LegacyJsonSnapshot:
+    """Lectura de snapshots JSON generados por versiones anteriores"""
+    
+    def __init__(self, path: str):
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        self.hash_version = HASH_VERSION
+        self.digest_size = DIGEST_SIZE
+        self.timestamp = snapshot.get('timestamp')
+        self.sources = snapshot['sources']
+    
+    def table(self, alias: str, table_name: str):
+        table = self.sources.get(alias, {}).get('tables', {}).get(table_name)
+        if table is None:
+            return None
+        return {bytes.fromhex(row['_record_hash']) for row in table['data'] if '_record_hash' in row}
+    
+    def table_meta(self, alias: str, table_name: str) -> Dict:
+        return {}
+    
+    def close(self):
+        pass
+
+
+def safe_file_name(name: str) -> str:
+    """Nombre utilizable como archivo (alias con espacios, tablas con caracteres especiales)"""
+    return re.sub(r'[^\w.-]', '_', name)
+
+
+def alias_file_name(alias: str) -> str:
+    """Nombre de archivo de una fuente; el hash evita que dos alias con los mismos caracteres
+    normalizados compartan archivo"""
+    return f"{safe_file_name(alias)}-{hashlib.md5(alias.encode('utf-8')).hexdigest()[:8]}"
+
+
+class SnapshotStore:
+    """Snapshot repartido por fuente y tabla: <directorio>/<alias>/manifest.json más un archivo por tabla.
+    Cada fuente se reemplaza de forma atómica sin tocar las demás"""
+    
+    MANIFEST = 'manifest.json'
+    
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+    
+    def source_dir(self, alias: str) -> Path:
+        return self.directory / alias_file_name(alias)
+    
+    def load_manifest(self, alias: str):
+        path = self.source_dir(alias) / self.MANIFEST
+        if not path.exists():
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def journal_path(self, alias: str) -> Path:
+        """Bitácora del cierre de una fuente, junto a su directorio (commit() limpia el directorio)"""
+        return self.directory / f"{self.source_dir(alias).name}.journal.jsonl"
+    
+    def begin_source(self, alias: str, database: str, hash_version: str, digest_size: int,
+                     timestamp: str, base: Dict = None) -> 'SourceSnapshotWriter':
+        """Writer de una fuente; con base conserva las tablas que no se reescriban"""
+        return SourceSnapshotWriter(self, alias, database, hash_version, digest_size, timestamp, base)
+    
+    def total_bytes(self) -> int:
+        if not self.directory.exists():
+            return 0
+        return sum(path.stat().st_size for path in self.directory.rglob('*') if path.is_file())
+
+
+class SourceSnapshotWriter:
+    """Escribe los archivos de tabla de una fuente y publica el manifiesto al final con os.replace"""
+    
+    def __init__(self, store: SnapshotStore, alias: str, database: str, hash_version: str, digest_size: int,
+                 timestamp: str, base: Dict = None):
+        self.store = store
+        self.alias = alias
+        self.directory = store.source_dir(alias)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.manifest = {
+            'format': 2,
+            'alias': alias,
+            'database': database,
+            'hash_version': hash_version,
+            'digest_size': digest_size,
+            'timestamp': timestamp,
+            'tables': dict(base['tables']) if base else {}
+        }
+        self.created = []  # Archivos de esta escritura, a borrar si se aborta
+    
+    def add_table(self, table_name: str, all_columns: List[str], digests: Iterable[bytes], meta: Dict = None,
+                  presorted: bool = False, key_size: int = 0) -> int:
+        """Escribe el archivo de una tabla con un nombre nuevo; el anterior sigue vigente hasta commit()"""
+        file_name = f"{safe_file_name(table_name)}-{uuid.uuid4().hex[:12]}.bin"
+        path = self.directory / file_name
+        self.created.append(path)
+        writer = BinarySnapshotWriter(str(path), self.manifest['hash_version'], self.manifest['digest_size'])
+        try:
+            count = writer.add_table(self.alias, self.manifest['database'], table_name, all_columns, digests, meta,
+                                     presorted=presorted, key_size=key_size)
+            writer.close(self.manifest['timestamp'])
+        except Exception:
+            writer.abort()
+            raise
+        
+        entry = {'file': file_name, 'all_columns': all_columns, 'count': count}
+        if key_size:
+            entry['key_size'] = key_size
+        entry.update(meta or {})
+        self.manifest['tables'][table_name] = entry
+        return count
+    
+    def commit(self):
+        """Publica el manifiesto de forma atómica y borra los archivos de tabla que ya no referencia"""
+        write_atomic(str(self.directory / SnapshotStore.MANIFEST), json.dumps(self.manifest))
+        referenced = {entry['file'] for entry in self.manifest['tables'].values()}
+        for path in self.directory.iterdir():
+            if path.name != SnapshotStore.MANIFEST and path.name not in referenced:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+    
+    def abort(self):
+        """Descarta los archivos escritos; el manifiesto anterior queda intacto"""
+        for path in self.created:
+            for candidate in (path, Path(f"{path}.tmp")):
+                if candidate.exists():
+                    candidate.unlink()
+
+
+class ShardedSnapshot:
+    """Vista de lectura del snapshot: los manifiestos de las fuentes pedidas y cada tabla mapeada
+    en memoria solo cuando se consulta"""
+    
+    def __init__(self, store: SnapshotStore, aliases: List[str], legacy=None):
+        self.store = store
+        self.sources = {}
+        self.open_tables = {}  # (alias, tabla) -> BinarySnapshot del archivo de la tabla
+        self.legacy = legacy  # Snapshot de un solo archivo de versiones anteriores
+        for alias in aliases:
+            manifest = store.load_manifest(alias)
+            if manifest is not None:
+                self.sources[alias] = manifest
+            elif legacy is not None and alias in legacy.sources:
+                source = legacy.sources[alias]
+                self.sources[alias] = {
+                    'alias': alias,
+                    'database': source.get('database', ''),
+                    'hash_version': legacy.hash_version,
+                    'digest_size': legacy.digest_size,
+                    'timestamp': legacy.timestamp,
+                    'tables': source.get('tables', {}),
+                    'legacy': True
+                }
+    
+    def table(self, alias: str, table_name: str):
+        """Índice de digests de una tabla o None si no está en el snapshot"""
+        source = self.sources.get(alias)
+        if source is None or table_name not in source['tables']:
+            return None
+        if source.get('legacy'):
+            return self.legacy.table(alias, table_name)
+        shard = self.open_tables.get((alias, table_name))
+        if shard is None:
+            shard = BinarySnapshot(str(self.store.source_dir(alias) / source['tables'][table_name]['file']))
+            self.open_tables[(alias, table_name)] = shard
+        return shard.table(alias, table_name)
+    
+    def table_meta(self, alias: str, table_name: str) -> Dict:
+        """Metadatos guardados junto a la tabla (watermark, checksums, columnas)"""
+        source = self.sources.get(alias)
+        if source is None:
+            return {}
+        if source.get('legacy'):
+            return self.legacy.table_meta(alias, table_name)
+        return source['tables'].get(table_name) or {}
+    
+    def release(self, alias: str, table_name: str):
+        """Desmapea el archivo de una tabla que ya no se va a consultar"""
+        shard = self.open_tables.pop((alias, table_name), None)
+        if shard is not None:
+            shard.close()
+    
+    def close(self):
+        for shard in self.open_tables.values():
+            shard.close()
+        self.open_tables = {}
+        if self.legacy is not None:
+            self.legacy.close()
+
+
+class PooledConnection:
+    """Conexión prestada por ConnectionManager: close() la devuelve al pool"""
+    
+    def __init__(self, manager: 'ConnectionManager', key: str, conn: mysql.connector.MySQLConnection):
+        self._manager = manager
+        self._key = key
+        self._conn = conn
+    
+    def __getattr__(self, name: str):
+        return getattr(self._conn, name)
+    
+    def close(self):
+        if self._conn is not None:
+            self._manager.release(self._key, self._conn)
+            self._conn = None
+
+
+class ConnectionManager:
+    """Pools de conexiones por endpoint, reutilizadas entre las fases de una ejecución"""
+    
+    def __init__(self, pool_size: int = 5, acquire_timeout: float = 60.0, health_check_interval: float = 30.0):
+        self.pool_size = max(pool_size, 1)
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval  # Segundos inactiva antes de verificarla con ping
+        self.idle = {}  # endpoint -> [(conexión, instante de devolución)]
+        self.created = {}  # endpoint -> conexiones abiertas (prestadas + inactivas)
+        self.condition = threading.Condition()
+    
+    def connection_kwargs(self, db_config: Dict) -> Dict:
+        return {
+            'host': db_config['host'],
+            'user': db_config['user'],
+            'password': db_config['password'],
+            'database': db_config['database'],
+            'port': db_config.get('port', 3306),
+            'charset': 'utf8mb4',
+            'collation': 'utf8mb4_unicode_ci',
+            'autocommit': False,
+            'allow_local_infile': db_config.get('allow_local_infile', False)
+        }
+    
+    def get_connection(self, db_config: Dict) -> PooledConnection:
+        """Conexión del pool del endpoint; las nuevas se abren solo cuando no hay inactivas"""
+        kwargs = self.connection_kwargs(db_config)
+        key = json.dumps(kwargs, sort_keys=True)
+        deadline = time.time() + self.acquire_timeout
+        
+        with self.condition:
+            while True:
+                idle = self.idle.setdefault(key, [])
+                if idle:
+                    conn, released_at = idle.pop()
+                    break
+                if self.created.get(key, 0) < self.pool_size:
+                    self.created[key] = self.created.get(key, 0) + 1
+                    conn, released_at = None, None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Error(msg=f"Pool de conexiones agotado para {db_config['host']}")
+                self.condition.wait(remaining)
+        
+        try:
+            if conn is None:
+                # El handshake se hace fuera del lock para no bloquear otros endpoints
+                conn = mysql.connector.connect(**kwargs)
+            elif time.time() - released_at > self.health_check_interval and not conn.is_connected():
+                conn.reconnect(attempts=2, delay=1)
+        except Exception:
+            with self.condition:
+                self.created[key] -= 1
+                self.condition.notify()
+            raise
+        
+        return PooledConnection(self, key, conn)
+    
+    def release(self, key: str, conn: mysql.connector.MySQLConnection):
+        """Devuelve una conexión al pool con la sesión limpia"""
+        try:
+            conn.rollback()
+            conn.reset_session()
+        except Exception:
+            # Conexión inutilizable: se descarta y se libera su lugar en el pool
+            try:
+                conn.close()
+            except Exception:
+                pass
+            with self.condition:
+                self.created[key] -= 1
+                self.condition.notify()
+            return
+        
+        with self.condition:
+            self.idle.setdefault(key, []).append((conn, time.time()))
+            self.condition.notify()
+    
+    def close_all(self):
+        """Cierra todas las conexiones inactivas de los pools"""
+        with self.condition:
+            for key, idle in self.idle.items():
+                for conn, _ in idle:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                self.created[key] = self.created.get(key, 0) - len(idle)
+            self.idle = {}
+
+
+def encode_record_value(value: Any):
+    """Serializa valores de un registro para JSON; los binarios se conservan en base64"""
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(bytes(value)).decode('ascii')}
+    return str(value)
+
+
+def decode_record_object(obj: Dict):
+    if set(obj) == {'__bytes__'}:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
+
+
+class DeadLetterStore:
+    """Inserts fallidos en SQLite: altas append-only, índices por tabla/fuente y reintentos con backoff.
+    Los que agotan sus reintentos pasan a failed_inserts_exhausted para revisarlos a mano"""
+    
+    def __init__(self, path: str, legacy_path: str = None, base_delay: float = 60.0, max_delay: float = 86400.0,
+                 max_attempts: int = 20):
+        self.path = path
+        self.legacy_path = legacy_path  # Log JSON anterior, se migra en la primera apertura
+        self.base_delay = base_delay  # Segundos hasta el primer reintento tras un fallo
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts  # Reintentos fallidos tras los que el registro ya no se reintenta
+        self.conn = None
+        self.lock = threading.Lock()
+    
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute("PRAGMA synchronous = NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS failed_inserts ("
+                " id INTEGER PRIMARY KEY,"
+                " table_name TEXT NOT NULL,"
+                " source_alias TEXT NOT NULL,"
+                " source_database TEXT NOT NULL,"
+                " record TEXT NOT NULL,"
+                " error TEXT,"
+                " created_at TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_retry_at REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_failed_due ON failed_inserts (next_retry_at)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_failed_table_source "
+                              "ON failed_inserts (table_name, source_alias, next_retry_at)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS failed_inserts_exhausted ("
+                " id INTEGER PRIMARY KEY,"
+                " table_name TEXT NOT NULL,"
+                " source_alias TEXT NOT NULL,"
+                " source_database TEXT NOT NULL,"
+                " record TEXT NOT NULL,"
+                " error TEXT,"
+                " created_at TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL,"
+                " exhausted_at TEXT NOT NULL)"
+            )
+            self.conn.commit()
+            self.migrate_legacy()
+        return self.conn
+    
+    def migrate_legacy(self):
+        """Importa el log JSON anterior sin las credenciales que contenía"""
+        if not self.legacy_path or not Path(self.legacy_path).exists():
+            return
+        with open(self.legacy_path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        now = time.time()
+        self.conn.executemany(
+            "INSERT INTO failed_inserts (table_name, source_alias, source_database, record, error, created_at, next_retry_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(entry['table'], entry['source_config']['alias'], entry['source_config']['database'],
+              json.dumps(entry['record'], default=encode_record_value), entry.get('error'),
+              entry.get('timestamp') or datetime.now().isoformat(), now)
+             for entry in entries]
+        )
+        self.conn.commit()
+        os.replace(self.legacy_path, self.legacy_path + '.migrated')
+    
+    def add(self, table_name: str, record: Dict, source_config: Dict, error: str):
+        """Agrega un registro fallido (seguro entre workers); se puede reintentar en la próxima ejecución"""
+        with self.lock:
+            conn = self.connect()
+            conn.execute(
+                "INSERT INTO failed_inserts (table_name, source_alias, source_database, record, error, created_at, next_retry_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (table_name, source_config['alias'], source_config['database'],
+                 json.dumps(record, default=encode_record_value), error, datetime.now().isoformat(), time.time())
+            )
+            conn.commit()
+    
+    def count(self, due_only: bool = False, exhausted: bool = False) -> int:
+        with self.lock:
+            if exhausted:
+                row = self.connect().execute("SELECT COUNT(*) FROM failed_inserts_exhausted").fetchone()
+            elif due_only:
+                row = self.connect().execute("SELECT COUNT(*) FROM failed_inserts WHERE next_retry_at <= ?",
+                                             (time.time(),)).fetchone()
+            else:
+                row = self.connect().execute("SELECT COUNT(*) FROM failed_inserts").fetchone()
+        return row[0]
+    
+    def record_hashes(self, table_name: str, source_alias: str, since: str) -> List[str]:
+        """_record_hash de los registros de una tabla y fuente que fallaron desde since (ISO)"""
+        with self.lock:
+            return [row[0] for row in self.connect().execute(
+                "SELECT json_extract(record, '$._record_hash') FROM failed_inserts "
+                "WHERE table_name = ? AND source_alias = ? AND created_at >= ? "
+                "UNION ALL "
+                "SELECT json_extract(record, '$._record_hash') FROM failed_inserts_exhausted "
+                "WHERE table_name = ? AND source_alias = ? AND created_at >= ?",
+                (table_name, source_alias, since) * 2
+            )]
+    
+    def due_groups(self) -> List[Tuple[str, str, str]]:
+        """(tabla, alias, base de datos) con registros cuyo reintento ya venció"""
+        with self.lock:
+            return self.connect().execute(
+                "SELECT DISTINCT table_name, source_alias, source_database FROM failed_inserts WHERE next_retry_at <= ?",
+                (time.time(),)
+            ).fetchall()
+    
+    def iter_due(self, table_name: str, source_alias: str, limit: int) -> Iterator[List[Tuple[int, Dict]]]:
+        """Bloques de (id, registro) vencidos de una tabla y fuente, en orden de alta"""
+        now = time.time()
+        last_id = 0
+        while True:
+            with self.lock:
+                rows = self.connect().execute(
+                    "SELECT id, record FROM failed_inserts "
+                    "WHERE table_name = ? AND source_alias = ? AND next_retry_at <= ? AND id > ? "
+                    "ORDER BY id LIMIT ?",
+                    (table_name, source_alias, now, last_id, limit)
+                ).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [(entry_id, json.loads(record, object_hook=decode_record_object)) for entry_id, record in rows]
+    
+    def resolve(self, ids: List[int]):
+        """Elimina los registros reintentados con éxito"""
+        if not ids:
+            return
+        with self.lock:
+            conn = self.connect()
+            conn.executemany("DELETE FROM failed_inserts WHERE id = ?", [(entry_id,) for entry_id in ids])
+            conn.commit()
+    
+    def reschedule(self, failures: List[Tuple[int, str]]) -> int:
+        """Registra un reintento fallido y pospone el siguiente con backoff exponencial; los que llegan
+        a max_attempts pasan a failed_inserts_exhausted. Devuelve cuántos se apartaron"""
+        if not failures:
+            return 0
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            conn.executemany(
+                "UPDATE failed_inserts SET attempts = attempts + 1, error = ?, "
+                "next_retry_at = ? + MIN(? * (1 << MIN(attempts, 30)), ?) WHERE id = ?",
+                [(error, now, self.base_delay, self.max_delay, entry_id) for entry_id, error in failures]
+            )
+            conn.execute(
+                "INSERT INTO failed_inserts_exhausted (id, table_name, source_alias, source_database, record, error, "
+                "created_at, attempts, exhausted_at) "
+                "SELECT id, table_name, source_alias, source_database, record, error, created_at, attempts, ? "
+                "FROM failed_inserts WHERE attempts >= ?",
+                (datetime.now().isoformat(), self.max_attempts)
+            )
+            exhausted = conn.execute("DELETE FROM failed_inserts WHERE attempts >= ?", (self.max_attempts,)).rowcount
+            conn.commit()
+        return exhausted
+    
+    def compact(self, min_free_ratio: float = 0.25):
+        """Recupera el espacio de los registros eliminados cuando supera la proporción indicada"""
+        with self.lock:
+            conn = self.connect()
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if page_count and free_pages / page_count >= min_free_ratio:
+                conn.execute("VACUUM")
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+def binlog_coordinates(position: Dict) -> Tuple[int, int]:
+    """(número de archivo, posición) comparables entre archivos de binlog"""
+    return int(position['log_file'].rsplit('.', 1)[-1]), int(position['log_pos'])
+
+
+def set_members(column_definitions: Dict[str, str]) -> Dict[str, List[str]]:
+    """Miembros de cada columna SET en el orden de su definición"""
+    members = {}
+    for column, column_type in column_definitions.items():
+        parsed = parse_column_type(column_type) if column_type else {}
+        if parsed.get('kind') == 'set':
+            members[column] = [value.replace("''", "'") for value in parsed['values']]
+    return members
+
+
+def binlog_record(values: Dict, columns: List[str], members: Dict[str, List[str]] = None) -> Dict:
+    """Fila de un evento de binlog con las columnas de la tabla de origen. Sin binlog_row_metadata=FULL
+    las columnas pueden llegar sin nombre: se asignan por posición"""
+    if any(column not in values for column in columns):
+        values = dict(zip(columns, values.values()))
+    record = {}
+    for column in columns:
+        value = values.get(column)
+        if isinstance(value, (set, frozenset)):
+            # Mismo texto que devuelve MySQL al leer la columna: miembros en el orden de la definición
+            order = (members or {}).get(column)
+            value = ','.join([member for member in order if member in value] if order else sorted(value))
+        elif isinstance(value, (dict, list)):
+            value = json.dumps(value, ensure_ascii=False)  # Columnas JSON
+        record[column] = value
+    return record
+
+
+class BinlogCheckpoint:
+    """Posición del binlog hasta la que ya se consolidó cada fuente (modo cdc)"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+    
+    def load(self) -> Dict[str, Dict]:
+        if not Path(self.path).exists():
+            return {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def get(self, alias: str):
+        return self.load().get(alias)
+    
+    def save(self, alias: str, position: Dict):
+        """Guarda la posición de una fuente; el archivo se reemplaza de una vez. El lock entre procesos
+        evita que dos corridas cdc de sucursales distintas pierdan la posición de la otra"""
+        with self.lock, file_lock(self.path):
+            positions = self.load()
+            positions[alias] = dict(position, timestamp=datetime.now().isoformat())
+            write_atomic(self.path, json.dumps(positions, indent=2))
+
+
+class ConsolidationJournal:
+    """Bitácora del cierre en curso de una fuente: una línea JSON por paso confirmado en el destino, para
+    reanudarlo. Mientras está abierta la bloquea un lock del sistema, así que dos cierres de la misma
+    fuente no pueden pisarse"""
+    
+    def __init__(self, path: str, alias: str):
+        self.path = path
+        self.alias = alias
+        self.file = None  # Abierto solo durante un cierre
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Abre la bitácora sin truncarla y toma el lock; falla si otro cierre de la fuente la tiene"""
+        self.close()
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.close()
+                raise RuntimeError(f"Hay otro cierre de {self.alias} en curso (bitácora {self.path})")
+    
+    def load(self):
+        """Estado del cierre interrumpido ({'cabecera', 'tablas': {alias: {tabla: avance}}, 'binlog'}) o None"""
+        if not Path(self.path).exists():
+            return None
+        with open(self.path, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        header = None
+        tables = {}
+        binlog = None
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break  # Última línea a medio escribir
+            if header is None:
+                header = entry
+            elif entry['paso'] == 'binlog':
+                binlog = entry['posicion']
+            elif entry['paso'] == 'snapshot':
+                # Lo ya incorporado al snapshot no se vuelve a avanzar
+                for alias in entry['fuentes']:
+                    for progress in tables.get(alias, {}).values():
+                        progress.pop('update', None)
+            else:
+                progress = tables.setdefault(entry['alias'], {}).setdefault(entry['tabla'], {'filas': 0})
+                progress['estado'] = entry['paso']
+                progress['filas'] += entry.get('filas', 0)
+                if entry.get('update') is not None:
+                    progress['update'] = self.decode_update(entry['update'])
+        if header is None:
+            return None
+        return {'cabecera': header, 'tablas': tables, 'binlog': binlog}
+    
+    def start(self, header: Dict):
+        """Descarta el contenido anterior (con el lock ya tomado) y escribe la cabecera"""
+        self.file.truncate(0)
+        self.append(header)
+    
+    def append(self, entry: Dict):
+        """Agrega una línea y la lleva a disco antes de seguir"""
+        if self.file is None:
+            return
+        with self.lock:
+            self.file.write(json.dumps(entry, default=str) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+    
+    def finish(self):
+        """Cierre completo: la bitácora ya no hace falta (se borra antes de soltar el lock)"""
+        if Path(self.path).exists():
+            os.remove(self.path)
+        self.close()
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    
+    @staticmethod
+    def encode_update(update: Dict) -> Dict:
+        return {key: [item.hex() for item in value] if isinstance(value, (list, set)) else value
+                for key, value in update.items()}
+    
+    @staticmethod
+    def decode_update(update: Dict) -> Dict:
+        decoded = {key: [bytes.fromhex(item) for item in value] if isinstance(value, list) else value
+                   for key, value in update.items()}
+        if 'deleted' in decoded:
+            decoded['deleted'] = set(decoded['deleted'])
+        return decoded
+
+
+class PhaseClock:
+    """Reparte el tiempo de un bucle entre fases: cada lap() asigna lo transcurrido desde el anterior"""
+    
+    def __init__(self, metrics: 'ConsolidationMetrics', source_alias: str, table_name: str):
+        self.metrics = metrics
+        self.source_alias = source_alias
+        self.table_name = table_name
+        self.seconds = {}
+        self.rows_read = 0
+        self.last = time.perf_counter()
+    
+    def lap(self, phase: str):
+        now = time.perf_counter()
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + now - self.last
+        self.last = now
+    
+    def stop(self):
+        for phase, seconds in self.seconds.items():
+            self.metrics.add_time(self.source_alias, self.table_name, phase, seconds)
+        self.metrics.count(self.source_alias, self.table_name, filas_leidas=self.rows_read)
+        self.seconds = {}
+        self.rows_read = 0
+
+
+class SourceThrottle:
+    """Ritmo de extracción de una fuente en producción: el tamaño de bloque y la pausa entre bloques se
+    adaptan a la latencia de cada consulta y a Threads_running (crecen de a poco y se reducen a la mitad),
+    con un techo de filas/s y bytes/s"""
+    
+    PROBE_INTERVAL = 1.0  # Segundos entre lecturas de Threads_running
+    MAX_PAUSE = 5.0
+    
+    def __init__(self, chunk_size: int, target_latency: float = 0.25, max_threads_running: int = 0,
+                 rows_per_second: float = 0, bytes_per_second: float = 0,
+                 clock=time.perf_counter, sleep=time.sleep):
+        self.clock = clock  # Reloj y espera reemplazables (pruebas)
+        self.sleep = sleep
+        self.chunk_size = chunk_size
+        self.min_chunk = max(chunk_size // 20, 10)
+        self.max_chunk = chunk_size * 10
+        self.target_latency = target_latency  # Segundos por consulta de bloque que la fuente tolera
+        self.max_threads_running = max_threads_running  # 0 = no se consulta
+        self.rows_per_second = rows_per_second  # 0 = sin techo
+        self.bytes_per_second = bytes_per_second
+        self.pause = 0.0
+        self.started = self.clock()
+        self.rows = 0
+        self.bytes = 0
+        self.paused = 0.0  # Segundos de pausa acumulados
+        self.last_probe = 0.0
+    
+    def needs_probe(self) -> bool:
+        return self.max_threads_running > 0 and self.clock() - self.last_probe >= self.PROBE_INTERVAL
+    
+    def observe(self, rows: int, size: int, latency: float, threads_running: int = None):
+        """Ajusta el bloque y la pausa según el bloque recién leído y espera lo que corresponda"""
+        self.rows += rows
+        self.bytes += size
+        busy = latency > self.target_latency
+        if threads_running is not None:
+            self.last_probe = self.clock()
+            busy = busy or threads_running > self.max_threads_running
+        if busy:
+            self.chunk_size = max(self.min_chunk, self.chunk_size // 2)
+            self.pause = min(self.MAX_PAUSE, max(self.pause * 2, 0.05))
+        else:
+            self.chunk_size = min(self.max_chunk, self.chunk_size + max(self.chunk_size // 4, 1))
+            self.pause = self.pause / 2 if self.pause >= 0.01 else 0.0
+        
+        # Con techo, lo leído no puede adelantarse al tiempo transcurrido
+        wait = self.pause
+        elapsed = self.clock() - self.started
+        if self.rows_per_second:
+            wait = max(wait, self.rows / self.rows_per_second - elapsed)
+        if self.bytes_per_second:
+            wait = max(wait, self.bytes / self.bytes_per_second - elapsed)
+        if wait > 0:
+            self.sleep(wait)
+            self.paused += wait
+
+
+def prefetch(iterable: Iterable, depth: int, name: str) -> Iterator:
+    """Recorre un iterable en un hilo propio, hasta depth elementos por delante de quien lo consume"""
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+    
+    def offer(item) -> bool:
+        # Espera lugar en la cola salvo que el consumidor haya abandonado el recorrido
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def produce():
+        iterator = iter(iterable)
+        result = (done, None)
+        try:
+            for item in iterator:
+                if not offer((item, None)):
+                    break
+        except Exception as e:
+            result = (done, e)
+        finally:
+            # El generador (y su cursor) se cierra en el mismo hilo que lo usó
+            if hasattr(iterator, 'close'):
+                iterator.close()
+        offer(result)
+    
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def ordered_map(executor: ThreadPoolExecutor, function, iterable: Iterable, depth: int) -> Iterator[Tuple]:
+    """Pares (elemento, function(elemento)) en orden, con hasta depth tareas en el pool (executor.map
+    leería toda la entrada de una vez)"""
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append((item, executor.submit(function, item)))
+            if len(pending) >= depth:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+
+class BlockWriter:
+    """Escritura de los bloques de una tabla. Con depth > 0 escribe en un hilo propio alimentado por una
+    cola acotada: si el destino va más lento, put() frena a la lectura y al diff"""
+    
+    def __init__(self, write, depth: int = 0, name: str = 'escritura'):
+        self.write = write  # Función (registros) -> registros escritos
+        self.written = 0
+        self.error = None
+        self.cancelled = False
+        self.blocks = queue.Queue(maxsize=depth) if depth else None
+        self.thread = None
+        if depth:
+            self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+            self.thread.start()
+    
+    def _run(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                return
+            # Tras un error o una cancelación se sigue vaciando la cola para no bloquear al productor
+            if self.error is None and not self.cancelled:
+                try:
+                    self.written += self.write(block)
+                except Exception as e:
+                    self.error = e
+    
+    def put(self, records: List[Dict]):
+        if self.thread is None:
+            self.written += self.write(records)
+            return
+        if self.error is not None:
+            raise self.error
+        self.blocks.put(records)
+    
+    def close(self, cancel: bool = False):
+        """Espera a que se escriba lo encolado (o lo descarta con cancel)"""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.cancelled = cancel
+        self.blocks.put(None)
+        self.thread.join()
+    
+    def __enter__(self) -> 'BlockWriter':
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(cancel=exc_type is not None)
+        if exc_type is None and self.error is not None:
+            raise self.error
+
+
+class ConsolidationMetrics:
+    """Tiempos por fase, volúmenes y latencias de lotes por fuente y tabla (seguro entre workers)"""
+    
+    BATCH_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self, mode: str = ''):
+        self.mode = mode
+        self.started_at = datetime.now()
+        self.finished_at = None
+        self.sources = {}  # alias -> {'segundos': {fase: s}, 'tablas': {tabla: métricas}}
+        self.lock = threading.Lock()
+    
+    def _entry(self, source_alias: str, table_name: str = None) -> Dict:
+        source = self.sources.setdefault(source_alias, {'segundos': {}, 'tablas': {}})
+        if table_name is None:
+            return source
+        return source['tablas'].setdefault(table_name, {
+            'segundos': {},
+            'filas_leidas': 0,
+            'filas_escritas': 0,
+            'bytes_leidos': 0,
+            'bytes_escritos': 0,
+            'lotes': {'cantidad': 0, 'segundos': 0.0, 'maximo': 0.0, 'buckets': [0] * len(self.BATCH_BUCKETS)}
+        })
+    
+    def clock(self, source_alias: str, table_name: str) -> PhaseClock:
+        return PhaseClock(self, source_alias, table_name)
+    
+    @contextmanager
+    def timer(self, source_alias: str, phase: str, table_name: str = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(source_alias, table_name, phase, time.perf_counter() - start)
+    
+    def add_time(self, source_alias: str, table_name: str, phase: str, seconds: float):
+        with self.lock:
+            phases = self._entry(source_alias, table_name)['segundos']
+            phases[phase] = phases.get(phase, 0.0) + seconds
+    
+    def count(self, source_alias: str, table_name: str, **values: int):
+        with self.lock:
+            entry = self._entry(source_alias, table_name)
+            for key, value in values.items():
+                entry[key] += value or 0
+    
+    def observe_batch(self, source_alias: str, table_name: str, seconds: float):
+        with self.lock:
+            batches = self._entry(source_alias, table_name)['lotes']
+            batches['cantidad'] += 1
+            batches['segundos'] += seconds
+            batches['maximo'] = max(batches['maximo'], seconds)
+            for i, bound in enumerate(self.BATCH_BUCKETS):
+                if seconds <= bound:
+                    batches['buckets'][i] += 1
+    
+    def slowest_table(self, source_alias: str):
+        """(tabla, segundos) con más tiempo acumulado de una fuente"""
+        tables = self.sources.get(source_alias, {}).get('tablas', {})
+        if not tables:
+            return None
+        table_name = max(tables, key=lambda name: sum(tables[name]['segundos'].values()))
+        return table_name, round(sum(tables[table_name]['segundos'].values()), 3)
+    
+    def to_dict(self, source_alias: str = None) -> Dict:
+        """Métricas de la ejecución; con source_alias, solo las de esa fuente"""
+        with self.lock:
+            sources = self.sources if source_alias is None else {
+                source_alias: self.sources.get(source_alias, {'segundos': {}, 'tablas': {}})}
+            return json.loads(json.dumps({
+                'modo': self.mode,
+                'inicio': self.started_at.isoformat(),
+                'fin': (self.finished_at or datetime.now()).isoformat(),
+                'bucket_limites': list(self.BATCH_BUCKETS),
+                'fuentes': sources
+            }))
+    
+    def write_json(self, path: str, source_alias: str = None):
+        write_atomic(path, json.dumps(self.to_dict(source_alias), indent=2))
+    
+    def write_prometheus(self, path: str, source_alias: str = None):
+        """Archivo de texto para el textfile collector de node_exporter"""
+        data = self.to_dict(source_alias)
+        mode = data['modo']
+        
+        def labels(**values: str) -> str:
+            escaped = (key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                       for key, value in values.items())
+            return '{' + ','.join(escaped) + '}'
+        
+        series = {
+            'consolidation_phase_seconds': ('gauge', 'Segundos por fase, fuente y tabla', []),
+            'consolidation_rows_read': ('gauge', 'Filas leídas de la fuente', []),
+            'consolidation_rows_written': ('gauge', 'Filas escritas en el destino', []),
+            'consolidation_bytes_read': ('gauge', 'Bytes enviados por la fuente', []),
+            'consolidation_bytes_written': ('gauge', 'Bytes recibidos por el destino', []),
+            'consolidation_batch_seconds': ('histogram', 'Latencia de los lotes de escritura', []),
+        }
+        for alias, source in data['fuentes'].items():
+            for phase, seconds in source['segundos'].items():
+                series['consolidation_phase_seconds'][2].append(
+                    f"consolidation_phase_seconds{labels(mode=mode, source=alias, table='', phase=phase)} {seconds:.6f}")
+            for table_name, table in source['tablas'].items():
+                table_labels = dict(mode=mode, source=alias, table=table_name)
+                for phase, seconds in table['segundos'].items():
+                    series['consolidation_phase_seconds'][2].append(
+                        f"consolidation_phase_seconds{labels(phase=phase, **table_labels)} {seconds:.6f}")
+                for name, key in (('consolidation_rows_read', 'filas_leidas'),
+                                  ('consolidation_rows_written', 'filas_escritas'),
+                                  ('consolidation_bytes_read', 'bytes_leidos'),
+                                  ('consolidation_bytes_written', 'bytes_escritos')):
+                    series[name][2].append(f"{name}{labels(**table_labels)} {table[key]}")
+                batches = table['lotes']
+                if batches['cantidad']:
+                    lines = series['consolidation_batch_seconds'][2]
+                    for bound, bucket in zip(data['bucket_limites'], batches['buckets']):
+                        lines.append(f"consolidation_batch_seconds_bucket{labels(le=bound, **table_labels)} {bucket}")
+                    lines.append(f"consolidation_batch_seconds_bucket{labels(le='+Inf', **table_labels)} {batches['cantidad']}")
+                    lines.append(f"consolidation_batch_seconds_sum{labels(**table_labels)} {batches['segundos']:.6f}")
+                    lines.append(f"consolidation_batch_seconds_count{labels(**table_labels)} {batches['cantidad']}")
+        
+        output = []
+        for name, (metric_type, description, lines) in series.items():
+            output.append(f"# HELP {name} {description}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(lines)
+        output.append("# HELP consolidation_last_run_timestamp_seconds Fin de la última ejecución")
+        output.append("# TYPE consolidation_last_run_timestamp_seconds gauge")
+        finished_at = datetime.fromisoformat(data['fin']).timestamp()
+        for alias in data['fuentes']:
+            output.append(f"consolidation_last_run_timestamp_seconds{labels(mode=mode, source=alias)} {finished_at:.0f}")
+        write_atomic(path, '\n'.join(output) + '\n')
+
+
+def sql_text_literal(value: str) -> str:
+    """Literal utf8mb4 como hexadecimal: ni comillas ni '%' que el conector tome por un parámetro"""
+    return f"CONVERT(X'{value.encode('utf-8').hex()}' USING utf8mb4) COLLATE utf8mb4_bin"
+
+
+def write_atomic(path: str, content: str):
+    """Escribe un archivo de texto completo y lo reemplaza de una vez (los lectores nunca ven uno a medias).
+    El temporal tiene nombre único: dos procesos que escriben el mismo archivo no comparten el temporal"""
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix='.tmp', dir=directory)
+    try:
+        # mkstemp crea el temporal con 0600: se conservan los permisos del archivo (alias.json lo lee la web)
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextmanager
+def file_lock(path: str):
+    """Lock entre procesos sobre un archivo aparte (<path>.lock): write_atomic reemplaza el archivo protegido"""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
 class MySQLDBConsolidator:
 
-    def __init__(self, source_databases: List[Dict], target_config: Dict, log_file: str = "consolidation_failures.json"):
+    def __init__(self, source_databases: List[Dict], target_config: Dict, log_file: str = "consolidation_failures.db",
+                 chunk_size: int = 1000, batch_size: int = 500, bulk_load_threshold: int = 0,
+                 workers: int = 1, incremental: bool = False, watermark_columns: Dict[str, str] = None,
+                 server_hash: bool = False, diff_engine: str = 'hash', checksum_chunk: int = 1000,
+                 connections: ConnectionManager = None, pool_size: int = 0, hash_algorithm: str = HASH_VERSION,
+                 write_mode: str = 'append', metrics_prefix: str = 'consolidation_metrics',
+                 status_file: str = None, log_stream=None,
+                 binlog_checkpoint_file: str = 'consolidation_binlog.json', cdc_server_id: int = 4000,
+                 resume: bool = False, memory_budget: int = 0, throttle: Dict = None,
+                 pipeline_depth: int = 0, hash_workers: int = 2):
         self.source_databases = source_databases
         self.target_config = target_config
         self.log_file = log_file
-        self.snapshot_file = "consolidation_snapshot.json"
-        self.failed_inserts_log = []
+        self.snapshot_dir = "consolidation_snapshot"  # Un directorio por fuente con un archivo por tabla
+        self.snapshot_store = SnapshotStore(self.snapshot_dir)
+        # Snapshots de un solo archivo de versiones anteriores, solo para lectura
+        self.legacy_snapshot_file = "consolidation_snapshot.json"
+        self.schema_cache_file = "consolidation_schema_cache.json"
+        self.journals = {}  # alias -> ConsolidationJournal del cierre en curso
+        self.resume = resume  # Retomar el cierre interrumpido en lugar de empezar de nuevo
+        self.resume_state = {}  # alias -> {tabla: avance} del cierre interrumpido
+        self.journal_since = {}  # alias -> inicio del cierre de su bitácora (el primero si se retomó)
+        self.journal_binlog = {}  # alias -> posición del binlog al empezar el cierre interrumpido
+        self.schema_cache = None  # Se carga de disco al primer uso
+        self.schema_lock = threading.RLock()
+        self.run_schemas = {}  # alias -> table_info ya leído en esta ejecución
+        self.run_fingerprints = {}
+        # Inserts fallidos; un log JSON anterior con el mismo nombre se migra al abrirlo
+        self.dead_letters = DeadLetterStore(str(Path(log_file).with_suffix('.db')),
+                                            legacy_path=str(Path(log_file).with_suffix('.json')))
+        self.workers = workers  # Fuentes procesadas en paralelo
+        self.incremental = incremental  # Cierre solo lee filas más allá del watermark de apertura
+        self.watermark_columns = watermark_columns or {}  # tabla -> columna de timestamp configurada
+        self.server_hash = server_hash  # Digests calculados por MySQL en la fuente
+        self.hash_algorithm = require_hash_version(hash_algorithm)  # Versión de hash de las nuevas aperturas
+        self.diff_engine = diff_engine  # 'hash' (fila a fila) o 'checksum' (rangos de PK)
+        self.checksum_chunk = checksum_chunk  # Valores de PK por hoja de checksum
+        self.checksum_fanout = 64  # Hojas por tramo en la primera consulta agrupada
+        # 'append' (inserta todo lo nuevo respecto al snapshot) o 'idempotent' (clave única
+        # por alias + hash, duplicados ignorados y snapshot avanzado tras cada cierre)
+        self.write_mode = write_mode
+        self.metrics = ConsolidationMetrics()
+        self.metrics_prefix = metrics_prefix  # Se escriben <prefijo>_<modo>_<alias>.json y .prom ('' = desactivado)
+        self.status_file = status_file  # alias.json cuyo consolidation_status se actualiza por fuente
+        self.progress = None  # Callback que recibe los eventos de progreso (modo servicio)
+        self.snapshot_updates = {}  # (alias, tabla) -> digests y metadatos a incorporar al snapshot
+        self.snapshot_updates_lock = threading.Lock()
+        self.binlog_checkpoint = BinlogCheckpoint(binlog_checkpoint_file)  # Posición del binlog por fuente (cdc)
+        self.cdc_server_id = cdc_server_id  # server_id de réplica de la primera fuente; las demás usan los siguientes
+        # Cada worker usa una conexión de origen y una de destino, más la del hilo principal
+        self.connections = connections or ConnectionManager(pool_size or workers + 1)
+        self.chunk_size = chunk_size  # Filas por lectura del cursor server-side
+        self.memory_budget = memory_budget  # Bytes por tabla en el diff antes de volcar a disco (0 = sin límite)
+        # Lectura adaptativa de las fuentes: latency, threads_running y techos rows/bytes por alias ('*' = todas)
+        self.throttle = throttle
+        self.throttles = {}  # alias -> SourceThrottle de la ejecución en curso
+        self.throttles_lock = threading.Lock()
+        # Etapas del cierre en paralelo: bloques en cola entre lectura, hash y escritura (0 = secuencial)
+        self.pipeline_depth = pipeline_depth
+        self.hash_workers = max(hash_workers, 1)
+        self.batch_size = batch_size  # Filas por INSERT multi-fila / transacción
+        self.bulk_load_threshold = bulk_load_threshold  # Registros a partir de los cuales se usa LOAD DATA (0 = desactivado)
+        if bulk_load_threshold > 0:
+            # LOAD DATA LOCAL solo se habilita en la conexión de destino
+            self.target_config = dict(target_config, allow_local_infile=True)
         
         # Configurar logging
         logging.basicConfig(
@@ -24,71 +1594,175 @@ class MySQLDBConsolidator:
             format='%(asctime)s - %(levelname)s - %(message)s',
             handlers=[
                 logging.FileHandler('db_consolidation.log'),
-                logging.StreamHandler(sys.stdout)
+                # Con --json la salida estándar queda reservada para el resultado
+                logging.StreamHandler(log_stream or sys.stdout)
             ]
         )
         self.logger = logging.getLogger(__name__)
 
     def get_db_connection(self, db_config: Dict) -> mysql.connector.MySQLConnection:
         try:
-            conn = mysql.connector.connect(
-                host=db_config['host'],
-                user=db_config['user'],
-                password=db_config['password'],
-                database=db_config['database'],
-                port=db_config.get('port', 3306),
-                charset='utf8mb4',
-                collation='utf8mb4_unicode_ci',
-                autocommit=False
-            )
-            return conn
+            return self.connections.get_connection(db_config)
         except Error as e:
             self.logger.error(f"Error conectando a MySQL {db_config['host']}: {e}")
             raise
     
     def get_table_info(self, conn: mysql.connector.MySQLConnection, database: str) -> Dict[str, Dict]:
+        """Estructura de todas las tablas del esquema con una sola consulta a INFORMATION_SCHEMA"""
         cursor = conn.cursor(dictionary=True)
-        
-        # Obtener todas las tablas
         cursor.execute("""
-            SELECT TABLE_NAME 
-            FROM INFORMATION_SCHEMA.TABLES 
-            WHERE TABLE_SCHEMA = %s 
-            AND TABLE_TYPE = 'BASE TABLE'
+            SELECT c.TABLE_NAME, c.COLUMN_NAME, c.DATA_TYPE, c.COLUMN_TYPE, c.IS_NULLABLE, c.COLUMN_DEFAULT,
+                   c.CHARACTER_MAXIMUM_LENGTH, c.COLUMN_KEY, c.EXTRA
+            FROM INFORMATION_SCHEMA.COLUMNS c
+            JOIN INFORMATION_SCHEMA.TABLES t
+              ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+            WHERE c.TABLE_SCHEMA = %s
+            AND t.TABLE_TYPE = 'BASE TABLE'
+            ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION
         """, (database,))
-        tables = [row['TABLE_NAME'] for row in cursor.fetchall()]
         
         table_info = {}
-        for table in tables:
-            # Obtener información de columnas
-            cursor.execute("""
-                SELECT COLUMN_NAME, DATA_TYPE, IS_NULLABLE, COLUMN_DEFAULT, CHARACTER_MAXIMUM_LENGTH
-                FROM INFORMATION_SCHEMA.COLUMNS
-                WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s
-                ORDER BY ORDINAL_POSITION
-            """, (database, table))
-            columns_info = cursor.fetchall()
-            
-            all_columns = [col['COLUMN_NAME'] for col in columns_info]
-            
-            table_info[table] = {
-                'all_columns': all_columns,
-                'column_types': {col['COLUMN_NAME']: col['DATA_TYPE'] for col in columns_info},
-                'column_lengths': {col['COLUMN_NAME']: col['CHARACTER_MAXIMUM_LENGTH'] for col in columns_info}
-            }
+        for col in cursor.fetchall():
+            info = table_info.setdefault(col['TABLE_NAME'], {
+                'all_columns': [],
+                'column_types': {},
+                'column_definitions': {},  # COLUMN_TYPE completo, para el motor de tipos
+                'column_lengths': {},
+                'primary_key': [],
+                'auto_increment': None
+            })
+            info['all_columns'].append(col['COLUMN_NAME'])
+            info['column_types'][col['COLUMN_NAME']] = col['DATA_TYPE']
+            info['column_definitions'][col['COLUMN_NAME']] = col['COLUMN_TYPE']
+            info['column_lengths'][col['COLUMN_NAME']] = col['CHARACTER_MAXIMUM_LENGTH']
+            if col['COLUMN_KEY'] == 'PRI':
+                info['primary_key'].append(col['COLUMN_NAME'])
+            if 'auto_increment' in (col['EXTRA'] or '').lower():
+                info['auto_increment'] = col['COLUMN_NAME']
         
         cursor.close()
         return table_info
     
+    def get_schema_fingerprint(self, conn: mysql.connector.MySQLConnection, database: str) -> str:
+        """Huella del esquema calculada en el servidor: solo viaja un MD5"""
+        cursor = conn.cursor()
+        cursor.execute("SET SESSION group_concat_max_len = 67108864")
+        cursor.execute("""
+            SELECT COUNT(*), MD5(GROUP_CONCAT(
+                CONCAT_WS(':', c.TABLE_NAME, c.COLUMN_NAME, c.COLUMN_TYPE, c.IS_NULLABLE, c.COLUMN_KEY, c.EXTRA)
+                ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION SEPARATOR '|'))
+            FROM INFORMATION_SCHEMA.COLUMNS c
+            JOIN INFORMATION_SCHEMA.TABLES t
+              ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+            WHERE c.TABLE_SCHEMA = %s
+            AND t.TABLE_TYPE = 'BASE TABLE'
+        """, (database,))
+        column_count, digest = cursor.fetchone()
+        cursor.close()
+        return f"{column_count}:{digest}"
+    
+    def get_source_table_info(self, source_config: Dict, conn: mysql.connector.MySQLConnection = None) -> Dict[str, Dict]:
+        """Estructura de una fuente: una vez por ejecución y desde disco si la huella no cambió"""
+        alias = source_config['alias']
+        with self.schema_lock:
+            if alias in self.run_schemas:
+                return self.run_schemas[alias]
+        
+        own_conn = conn is None
+        if own_conn:
+            conn = self.get_db_connection(source_config)
+        try:
+            introspection_start = time.perf_counter()
+            fingerprint = self.get_schema_fingerprint(conn, source_config['database'])
+            cached = self.load_schema_cache()['sources'].get(alias)
+            # Los cachés de versiones anteriores no guardan COLUMN_TYPE y se releen
+            if (cached and cached['fingerprint'] == fingerprint
+                    and cached['database'] == source_config['database']
+                    and all('column_definitions' in info for info in cached['tables'].values())):
+                table_info = cached['tables']
+            else:
+                self.logger.info(f"Esquema de {alias} cambió, leyendo INFORMATION_SCHEMA")
+                table_info = self.get_table_info(conn, source_config['database'])
+                with self.schema_lock:
+                    self.schema_cache['sources'][alias] = {
+                        'database': source_config['database'],
+                        'fingerprint': fingerprint,
+                        'tables': table_info
+                    }
+                    self.save_schema_cache()
+            self.metrics.add_time(alias, None, 'introspeccion', time.perf_counter() - introspection_start)
+        finally:
+            if own_conn:
+                conn.close()
+        
+        with self.schema_lock:
+            self.run_schemas[alias] = table_info
+            self.run_fingerprints[alias] = fingerprint
+        return table_info
+    
+    def load_schema_cache(self) -> Dict:
+        """Caché de esquemas en disco: huellas por fuente y por destino"""
+        with self.schema_lock:
+            if self.schema_cache is None:
+                self.schema_cache = {'sources': {}, 'targets': {}}
+                if Path(self.schema_cache_file).exists():
+                    try:
+                        with open(self.schema_cache_file, 'r', encoding='utf-8') as f:
+                            self.schema_cache = json.load(f)
+                    except Exception as e:
+                        self.logger.warning(f"Error cargando caché de esquemas: {e}")
+            return self.schema_cache
+    
+    def save_schema_cache(self):
+        """Guarda la caché de esquemas con reemplazo atómico (llamar con schema_lock tomado)"""
+        tmp_file = f"{self.schema_cache_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.schema_cache, f, indent=2, default=str)
+        os.replace(tmp_file, self.schema_cache_file)
+    
+    def get_watermark_column(self, table_name: str, info: Dict):
+        """Columna monótona para extracción incremental: (columna, tipo) o None"""
+        if table_name in self.watermark_columns:
+            column = self.watermark_columns[table_name]
+            if column in info['all_columns']:
+                return column, 'timestamp'
+            self.logger.warning(f"Columna de watermark {column} no existe en {table_name}")
+        
+        # Solo una PK AUTO_INCREMENT de una columna garantiza que los nuevos registros quedan por encima
+        if info.get('auto_increment') and info.get('primary_key') == [info['auto_increment']]:
+            return info['auto_increment'], 'auto_increment'
+        return None
+    
     def create_target_tables(self, conn: mysql.connector.MySQLConnection):
+        # Recopilar esquemas de todas las fuentes (caché por huella)
+        source_schemas = [(source_config, self.get_source_table_info(source_config))
+                          for source_config in self.source_databases]
+        
+        # Sin cambios de esquema desde la última ejecución no hace falta DDL
+        target_key = f"{self.target_config['host']}:{self.target_config.get('port', 3306)}/{self.target_config['database']}"
+        combined_fingerprint = hashlib.sha256(json.dumps(
+            [TARGET_SCHEMA_VERSION, self.write_mode] + sorted((source_config['alias'], self.run_fingerprints[source_config['alias']])
+                                             for source_config, _ in source_schemas)
+        ).encode('utf-8')).hexdigest()
+        
+        expected_tables = {table_name for _, table_info in source_schemas for table_name in table_info}
+        cache = self.load_schema_cache()
+        if cache['targets'].get(target_key) == combined_fingerprint:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = %s
+            """, (self.target_config['database'],))
+            existing_tables = {row[0] for row in cursor.fetchall()}
+            cursor.close()
+            if expected_tables <= existing_tables:
+                self.logger.info("Esquemas de origen sin cambios, se omite la creación de tablas")
+                return
+        
         cursor = conn.cursor()
         
-        # Recopilar esquemas de todas las fuentes
         all_table_schemas = {}
         
-        for source_config in self.source_databases:
-            source_conn = self.get_db_connection(source_config)
-            table_info = self.get_table_info(source_conn, source_config['database'])
+        for source_config, table_info in source_schemas:
             
             for table_name, info in table_info.items():
                 if table_name not in all_table_schemas:
@@ -97,20 +1771,20 @@ class MySQLDBConsolidator:
                         'sources': []
                     }
                 
-                # Agregar columnas de esta fuente
-                for col_name, col_type in info['column_types'].items():
-                    if col_name not in all_table_schemas[table_name]['columns']:
-                        all_table_schemas[table_name]['columns'][col_name] = col_type
-                    # Si existe pero con tipo diferente, usar el más permisivo
-                    elif col_type == 'TEXT' or all_table_schemas[table_name]['columns'][col_name] == 'VARCHAR':
-                        all_table_schemas[table_name]['columns'][col_name] = 'TEXT'
+                # Unir el tipo de cada columna con el de las demás fuentes (el más angosto que admite a todos)
+                columns = all_table_schemas[table_name]['columns']
+                for col_name in info['all_columns']:
+                    column_type = parse_column_type(info.get('column_definitions', {}).get(col_name)
+                                                    or info['column_types'][col_name])
+                    columns[col_name] = merge_column_types(columns.get(col_name), column_type)
                 
                 all_table_schemas[table_name]['sources'].append(source_config['alias'])
-            
-            source_conn.close()
+        
+        target_columns = self.get_target_column_types(conn)
         
         # Crear tablas en destino
         for table_name, schema in all_table_schemas.items():
+            schema['columns'] = fit_row_size(schema['columns'])
             self.logger.info(f"Creando/actualizando tabla consolidada: {table_name}")
             
             # Columnas de trazabilidad
@@ -120,58 +1794,146 @@ class MySQLDBConsolidator:
             columns_sql.append("`_source_alias` VARCHAR(100) NOT NULL")
             columns_sql.append("`_sync_timestamp` DATETIME DEFAULT CURRENT_TIMESTAMP")
             columns_sql.append("`_record_hash` VARCHAR(64) NOT NULL")
+            columns_sql.append("`_source_key` VARCHAR(64) NULL")  # Hash de la PK de origen (modo changeset)
+            columns_sql.append("`_deleted_at` DATETIME NULL")  # Borrado lógico (modo changeset)
             
             # Agregar columnas originales 
             for col_name, col_type in schema['columns'].items():
-                mysql_type = self.convert_to_mysql_type(col_type)
-                columns_sql.append(f"`{col_name}` {mysql_type} NULL")
+                columns_sql.append(f"`{col_name}` {format_column_type(col_type)} NULL")
+            
+            indexes_sql = [
+                "INDEX `idx_source_alias` (`_source_alias`)",
+                "INDEX `idx_sync_timestamp` (`_sync_timestamp`)",
+                "INDEX `idx_record_hash` (`_record_hash`)"
+            ]
+            if self.write_mode == 'idempotent':
+                indexes_sql.append("UNIQUE KEY `uk_source_record` (`_source_alias`, `_record_hash`)")
+            elif self.write_mode == 'changeset':
+                indexes_sql.append("UNIQUE KEY `uk_source_key` (`_source_alias`, `_source_key`)")
             
             create_table_sql = f"""
                 CREATE TABLE IF NOT EXISTS `{table_name}` (
-                    {', '.join(columns_sql)},
-                    INDEX `idx_source_alias` (`_source_alias`),
-                    INDEX `idx_sync_timestamp` (`_sync_timestamp`),
-                    INDEX `idx_record_hash` (`_record_hash`)
+                    {', '.join(columns_sql + indexes_sql)}
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             """
             
             cursor.execute(create_table_sql)
             conn.commit()
             
+            if table_name in target_columns:
+                # Tabla existente: solo se agregan columnas nuevas y se ensanchan las que crecieron
+                self.widen_target_columns(conn, table_name, schema['columns'], target_columns[table_name])
+            
+            if self.write_mode == 'idempotent':
+                # Tablas creadas por versiones anteriores: agregar la clave única
+                self.ensure_unique_record_key(conn, table_name)
+            elif self.write_mode == 'changeset':
+                self.ensure_changeset_columns(conn, table_name)
+            
             self.logger.info(f"Tabla {table_name} lista para consolidación desde: {', '.join(schema['sources'])}")
         
         cursor.close()
+        
+        with self.schema_lock:
+            self.schema_cache['targets'][target_key] = combined_fingerprint
+            self.save_schema_cache()
     
-    def convert_to_mysql_type(self, original_type: str) -> str:
-        type_mapping = {
-            'int': 'INT',
-            'bigint': 'BIGINT',
-            'varchar': 'TEXT',  # Usar TEXT para máxima flexibilidad
-            'char': 'TEXT',
-            'text': 'TEXT',
-            'longtext': 'LONGTEXT',
-            'decimal': 'DECIMAL(15,2)',
-            'float': 'FLOAT',
-            'double': 'DOUBLE',
-            'datetime': 'DATETIME',
-            'date': 'DATE',
-            'time': 'TIME',
-            'timestamp': 'TIMESTAMP',
-            'boolean': 'BOOLEAN',
-            'tinyint': 'TINYINT',
-            'json': 'JSON'
-        }
+    def get_target_column_types(self, conn: mysql.connector.MySQLConnection) -> Dict[str, Dict[str, str]]:
+        """COLUMN_TYPE de las columnas de todas las tablas del destino, con una sola consulta"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE TABLE_SCHEMA = %s
+        """, (self.target_config['database'],))
+        target_columns = {}
+        for table_name, column_name, column_type in cursor.fetchall():
+            target_columns.setdefault(table_name, {})[column_name] = column_type
+        cursor.close()
+        return target_columns
+    
+    def widen_target_columns(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                             source_columns: Dict[str, Dict], current_columns: Dict[str, str]):
+        """Agrega las columnas que faltan y ensancha las que crecieron en alguna fuente, nunca las angosta"""
+        current = {column: parse_column_type(column_type) for column, column_type in current_columns.items()
+                   if column in source_columns}
+        widened = fit_row_size({column: merge_column_types(current.get(column), column_type)
+                                for column, column_type in source_columns.items()})
         
-        original_type_lower = original_type.lower()
-        for key, value in type_mapping.items():
-            if key in original_type_lower:
-                return value
+        operations = []
+        for column, column_type in widened.items():
+            if column not in current:
+                operations.append(f"ADD COLUMN `{column}` {format_column_type(column_type)} NULL")
+            elif column_type != current[column]:
+                operations.append(f"MODIFY COLUMN `{column}` {format_column_type(column_type)} NULL")
+                self.logger.info(f"Ensanchando {table_name}.{column}: {current_columns[column]} -> "
+                                 f"{format_column_type(column_type)}")
+        if not operations:
+            return
+        
+        cursor = conn.cursor()
+        try:
+            try:
+                # Agrandar un VARCHAR o agregar columnas suele poder hacerse sin bloquear escrituras
+                cursor.execute(f"ALTER TABLE `{table_name}` {', '.join(operations)}, ALGORITHM=INPLACE, LOCK=NONE")
+            except Error as e:
+                if e.errno not in (1845, 1846):
+                    raise
+                cursor.execute(f"ALTER TABLE `{table_name}` {', '.join(operations)}")
+            conn.commit()
+        finally:
+            cursor.close()
+    
+    def ensure_unique_record_key(self, conn: mysql.connector.MySQLConnection, table_name: str):
+        """Agrega la clave única (alias, hash) eliminando antes los duplicados ya consolidados"""
+        cursor = conn.cursor()
+        cursor.execute(f"SHOW INDEX FROM `{table_name}` WHERE Key_name = 'uk_source_record'")
+        exists = bool(cursor.fetchall())
+        if not exists:
+            # Se conserva la primera copia de cada registro
+            cursor.execute(f"""
+                DELETE duplicate FROM `{table_name}` duplicate
+                JOIN `{table_name}` original
+                  ON original.`_source_alias` = duplicate.`_source_alias`
+                 AND original.`_record_hash` = duplicate.`_record_hash`
+                 AND original.`_consolidation_id` < duplicate.`_consolidation_id`
+            """)
+            removed = cursor.rowcount
+            cursor.execute(f"ALTER TABLE `{table_name}` ADD UNIQUE KEY `uk_source_record` (`_source_alias`, `_record_hash`)")
+            conn.commit()
+            self.logger.info(f"Clave única (alias, hash) agregada a {table_name}; {removed} duplicados eliminados")
+        cursor.close()
+    
+    def ensure_changeset_columns(self, conn: mysql.connector.MySQLConnection, table_name: str):
+        """Agrega a tablas existentes las columnas y la clave única (alias, clave) del modo changeset"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME IN ('_source_key', '_deleted_at')
+        """, (self.target_config['database'], table_name))
+        existing_columns = {row[0] for row in cursor.fetchall()}
+        cursor.execute(f"SHOW INDEX FROM `{table_name}` WHERE Key_name = 'uk_source_key'")
+        has_key = bool(cursor.fetchall())
         
-        # Por defecto, usar TEXT para máxima compatibilidad
-        return 'TEXT'
+        alterations = []
+        if '_source_key' not in existing_columns:
+            alterations.append("ADD COLUMN `_source_key` VARCHAR(64) NULL")
+        if '_deleted_at' not in existing_columns:
+            alterations.append("ADD COLUMN `_deleted_at` DATETIME NULL")
+        if not has_key:
+            # Las filas anteriores tienen _source_key NULL y no chocan entre sí
+            alterations.append("ADD UNIQUE KEY `uk_source_key` (`_source_alias`, `_source_key`)")
+        if alterations:
+            cursor.execute(f"ALTER TABLE `{table_name}` {', '.join(alterations)}")
+            conn.commit()
+            self.logger.info(f"Columnas de changeset agregadas a {table_name}")
+        cursor.close()
     
     def generate_record_hash(self, record: Dict, source_alias: str) -> str:
         """Genera hash único para detectar registros duplicados"""
+        return self.generate_record_digest(record, source_alias).hex()
+    
+    def generate_record_digest(self, record: Dict, source_alias: str) -> bytes:
+        """Digest binario (32 bytes) del registro, usado en el snapshot"""
         record_string = f"{source_alias}:"
         for key in sorted(record.keys()):
             value = record[key]
@@ -180,308 +1942,2031 @@ class MySQLDBConsolidator:
             else:
                 record_string += f"{key}:{str(value)}|"
         
-        return hashlib.sha256(record_string.encode('utf-8')).hexdigest()
+        return hashlib.sha256(record_string.encode('utf-8')).digest()
+    
+    def build_row_digest_sql(self, table_info: Dict, source_alias: str) -> str:
+        """Expresión SQL que calcula en el servidor el digest (32 bytes) de cada fila"""
+        return f"UNHEX(SHA2({self.build_row_canonical_sql(table_info, source_alias)}, 256))"
+    
+    def build_row_canonical_sql(self, table_info: Dict, source_alias: str) -> str:
+        """Expresión SQL con la representación canónica de la fila (base de digests y checksums)"""
+        binary_types = ('binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob', 'bit', 'geometry')
+        numeric_types = ('tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint',
+                         'decimal', 'numeric', 'float', 'double', 'year')
+        
+        parts = [sql_text_literal(source_alias)]
+        for column in sorted(table_info['all_columns']):
+            data_type = (table_info['column_types'].get(column) or '').lower()
+            if data_type in ('datetime', 'timestamp'):
+                # %T evita '%s', que el conector interpreta como parámetro
+                expression = f"DATE_FORMAT(`{column}`, '%Y-%m-%d %T.%f')"
+            elif data_type in binary_types:
+                expression = f"HEX(`{column}`)"
+            elif data_type in numeric_types or data_type in ('date', 'time'):
+                expression = f"CAST(`{column}` AS CHAR)"
+            else:
+                expression = f"`{column}`"
+            
+            # Misma codificación y colación para todas las piezas, sin importar la columna
+            expression = f"CONVERT({expression} USING utf8mb4) COLLATE utf8mb4_bin"
+            
+            # NULL se codifica distinto de cualquier valor (incluida la cadena 'NULL')
+            parts.append(f"CONCAT({sql_text_literal(column)}, COALESCE(CONCAT(':', {expression}), '!N'))")
+        
+        return f"CONCAT_WS('|', {', '.join(parts)})"
+    
+    def iter_rows(self, conn: mysql.connector.MySQLConnection, query: str, params: Tuple = None,
+                  dictionary: bool = True) -> Iterator:
+        """Itera filas en bloques acotados usando un cursor sin buffer (server-side)"""
+        for rows in self.iter_row_chunks(conn, query, params, dictionary):
+            yield from rows
+    
+    def throttle_for(self, source_alias: str):
+        """SourceThrottle de una fuente, creado en su primera lectura; None si no se limita"""
+        if not self.throttle:
+            return None
+        with self.throttles_lock:
+            if source_alias not in self.throttles:
+                limits = self.throttle
+                self.throttles[source_alias] = SourceThrottle(
+                    self.chunk_size,
+                    target_latency=limits.get('latency', 0.25),
+                    max_threads_running=limits.get('threads_running', 0),
+                    rows_per_second=limits.get('rows_per_second', {}).get(source_alias,
+                                                                          limits.get('rows_per_second', {}).get('*', 0)),
+                    bytes_per_second=limits.get('bytes_per_second', {}).get(source_alias,
+                                                                            limits.get('bytes_per_second', {}).get('*', 0))
+                )
+            return self.throttles[source_alias]
+    
+    def threads_running(self, conn: mysql.connector.MySQLConnection):
+        """Threads_running de la fuente; None si no está disponible"""
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SHOW GLOBAL STATUS LIKE 'Threads_running'")
+            row = cursor.fetchone()
+            cursor.close()
+            return int(row[1]) if row else None
+        except Exception:
+            return None
+    
+    def scan_table(self, conn: mysql.connector.MySQLConnection, table_name: str, table_info: Dict,
+                   source_alias: str, select: str = '*', where: str = '', params: Tuple = None,
+                   dictionary: bool = True) -> Iterator[List]:
+        """Bloques de filas de una tabla; con --pipeline-depth la lectura avanza en su propio hilo mientras
+        se procesan los bloques anteriores"""
+        chunks = self._scan_chunks(conn, table_name, table_info, source_alias, select, where, params, dictionary)
+        if self.pipeline_depth:
+            return prefetch(chunks, self.pipeline_depth, f"lectura-{source_alias}")
+        return chunks
+    
+    def _scan_chunks(self, conn: mysql.connector.MySQLConnection, table_name: str, table_info: Dict,
+                     source_alias: str, select: str, where: str, params: Tuple,
+                     dictionary: bool) -> Iterator[List]:
+        """Bloques de filas de una tabla. Con throttle, una tabla con PK se lee en orden de PK con una
+        consulta corta por bloque (sin una lectura abierta durante todo el recorrido) y entre bloques se
+        mide la carga de la fuente"""
+        throttle = self.throttle_for(source_alias)
+        if throttle is None:
+            yield from self.iter_row_chunks(conn, f"SELECT {select} FROM `{table_name}`{where}", params, dictionary)
+            return
+        
+        primary_key = table_info.get('primary_key') or []
+        if not primary_key:
+            # Sin PK no hay rangos: se lee en streaming y se pausa entre bloques sin consultar la fuente
+            cursor = conn.cursor(dictionary=dictionary, buffered=False)
+            try:
+                cursor.execute(f"SELECT {select} FROM `{table_name}`{where}", params or ())
+                while True:
+                    start = time.perf_counter()
+                    rows = cursor.fetchmany(throttle.chunk_size)
+                    if not rows:
+                        break
+                    latency = time.perf_counter() - start
+                    sample = rows[0].values() if dictionary else rows[0]
+                    throttle.observe(len(rows), len(rows) * sum(sys.getsizeof(value) for value in sample), latency)
+                    yield rows
+            finally:
+                try:
+                    cursor.close()
+                except Error:
+                    conn.consume_results()
+            return
+        
+        key_columns = ', '.join(f"`{column}`" for column in primary_key)
+        key_select = ', '.join(f"`{column}` AS `_scan_key{i}`" for i, column in enumerate(primary_key))
+        if len(primary_key) == 1:
+            after_key = f"`{primary_key[0]}` > %s"
+        else:
+            after_key = f"({key_columns}) > ({', '.join(['%s'] * len(primary_key))})"
+        base_condition = where[len(' WHERE '):] if where else ''
+        last_key = None
+        bytes_sent = self.session_bytes(conn, 'Bytes_sent')
+        while True:
+            conditions = [f"({base_condition})"] if base_condition else []
+            chunk_params = list(params or ())
+            if last_key is not None:
+                conditions.append(after_key)
+                chunk_params.extend(last_key)
+            limit = throttle.chunk_size
+            query = f"SELECT {select}, {key_select} FROM `{table_name}`"
+            if conditions:
+                query += f" WHERE {' AND '.join(conditions)}"
+            query += f" ORDER BY {key_columns} LIMIT {limit}"
+            
+            start = time.perf_counter()
+            cursor = conn.cursor(dictionary=dictionary)
+            cursor.execute(query, tuple(chunk_params))
+            rows = cursor.fetchall()
+            cursor.close()
+            latency = time.perf_counter() - start
+            if not rows:
+                break
+            
+            key_count = len(primary_key)
+            if dictionary:
+                last_key = [rows[-1][f'_scan_key{i}'] for i in range(key_count)]
+                for row in rows:
+                    for i in range(key_count):
+                        del row[f'_scan_key{i}']
+            else:
+                last_key = list(rows[-1][-key_count:])
+                rows = [row[:-key_count] for row in rows]
+            
+            threads_running = self.threads_running(conn) if throttle.needs_probe() else None
+            sent = self.session_bytes(conn, 'Bytes_sent')
+            throttle.observe(len(rows), sent - bytes_sent, latency, threads_running)
+            bytes_sent = sent
+            yield rows
+            if len(rows) < limit:
+                break
     
-    def take_snapshot(self):
+    def iter_row_chunks(self, conn: mysql.connector.MySQLConnection, query: str, params: Tuple = None,
+                        dictionary: bool = True) -> Iterator[List]:
+        """Itera bloques de hasta chunk_size filas usando un cursor sin buffer (server-side)"""
+        cursor = conn.cursor(dictionary=dictionary, buffered=False)
+        try:
+            cursor.execute(query, params or ())
+            while True:
+                rows = cursor.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            try:
+                cursor.close()
+            except Error:
+                # Descartar filas pendientes si el consumidor se detuvo antes
+                conn.consume_results()
+    
+    def take_snapshot(self) -> Dict[str, Dict]:
         self.logger.info("Tomando snapshot de todas las bases de datos fuente...")
-        self.load_failed_inserts()
-        if self.failed_inserts_log:
-            self.logger.info(f"Procesando {len(self.failed_inserts_log)} inserts fallidos antes del snapshot...")
+        self.metrics = ConsolidationMetrics('apertura')
+        self.emit('inicio', modo='apertura', fuentes=[source['alias'] for source in self.source_databases])
+        due_failures = self.dead_letters.count(due_only=True)
+        if due_failures:
+            self.logger.info(f"Procesando {due_failures} inserts fallidos antes del snapshot...")
             try:
                 target_conn = self.get_db_connection(self.target_config)
                 # Crear/actualizar tablas de destino si es necesario
                 self.create_target_tables(target_conn)
                 # Deshabilitar restricciones
-                target_conn.cmd_query("SET foreign_key_checks = 0")
-                target_conn.cmd_query("SET sql_mode = ''")
+                self.prepare_target_session(target_conn)
                 
                 self.process_failed_inserts(target_conn)
-                self.save_failed_inserts()  # Guardar log actualizado
                 target_conn.close()
             except Exception as e:
                 self.logger.error(f"Error procesando inserts fallidos en apertura: {e}")
         
         
+        timestamp = datetime.now().isoformat()
+        
+        # Cada fuente reemplaza solo su parte del snapshot: las demás sucursales no se tocan
+        summary = self.run_per_source(lambda source_config: self._snapshot_source(source_config, timestamp))
+        self.report_summary("Resumen de apertura", summary)
+        self.publish_run(summary)
+        
+        failed_sources = [alias for alias, result in summary.items() if result.get('error')]
+        if failed_sources:
+            self.logger.error(f"Error tomando snapshot de: {', '.join(failed_sources)}")
+            raise RuntimeError(f"Fuentes con error en el snapshot: {', '.join(failed_sources)}")
+        
+        total_sources = len(self.source_databases)
+        self.logger.info(f"Snapshot guardado con {total_sources} fuentes de datos")
+        return summary
+    
+    def _snapshot_source(self, source_config: Dict, timestamp: str) -> Dict:
+        """Toma el snapshot de una fuente con su propia conexión; se publica solo si termina sin error"""
+        self.logger.info(f"Procesando fuente: {source_config['alias']}")
+        summary = {'tablas': 0, 'registros': 0}
+        
+        if self.server_hash:
+            hash_version, digest_size = SERVER_HASH_VERSION, DIGEST_SIZE
+        else:
+            hash_version, digest_size = self.hash_algorithm, HASH_ALGORITHMS[self.hash_algorithm][1]
+        writer = self.snapshot_store.begin_source(source_config['alias'], source_config['database'],
+                                                  hash_version, digest_size, timestamp)
+        
+        conn = self.get_db_connection(source_config)
         try:
-            snapshot = {
-                'timestamp': datetime.now().isoformat(),
-                'sources': {}
-            }
+            # Antes de leer: el modo cdc reaplica desde aquí lo que cambie durante la lectura
+            binlog_start = self.read_binlog_start(conn, source_config['alias'])
+            table_info = self.get_source_table_info(source_config, conn)
             
-            for source_config in self.source_databases:
-                self.logger.info(f"Procesando fuente: {source_config['alias']}")
+            for table_name, info in table_info.items():
+                meta = {}
+                watermark_column = self.get_watermark_column(table_name, info)
+                clock = self.metrics.clock(source_config['alias'], table_name)
+                bytes_sent = self.session_bytes(conn, 'Bytes_sent')
                 
-                conn = self.get_db_connection(source_config)
-                table_info = self.get_table_info(conn, source_config['database'])
+                # Los checksums se calculan antes de leer los digests: una fila que llegue en medio
+                # cambia el checksum de su rango y se revisa fila a fila en el cierre
+                if self.diff_engine == 'checksum' and self.get_checksum_column(info):
+                    meta['checksums'] = self._compute_leaf_checksums(conn, table_name, info, source_config['alias'])
+                    clock.lap('checksum')
                 
-                source_snapshot = {
-                    'database': source_config['database'],
-                    'alias': source_config['alias'],
-                    'tables': {}
-                }
+                # En modo changeset cada digest va precedido del hash de la PK de su fila
+                key_hasher = None
+                if self.write_mode == 'changeset' and info.get('primary_key'):
+                    key_hasher = KeyHasher(info['primary_key'], info['column_types'], source_config['alias'])
                 
-                for table_name, info in table_info.items():
-                    cursor = conn.cursor(dictionary=True)
-                    cursor.execute(f"SELECT * FROM `{table_name}`")
-                    rows = cursor.fetchall()
-                    
-                    # Convertir tipos no serializables
-                    table_data = []
-                    for row in rows:
-                        serializable_row = {}
-                        for key, value in row.items():
-                            if isinstance(value, datetime):
-                                serializable_row[key] = value.isoformat()
-                            elif value is None:
-                                serializable_row[key] = None
-                            else:
-                                serializable_row[key] = str(value) if not isinstance(value, (int, float, str, bool)) else value
-                        
-                        # Agregar hash del registro
-                        serializable_row['_record_hash'] = self.generate_record_hash(serializable_row, source_config['alias'])
-                        table_data.append(serializable_row)
-                    
-                    source_snapshot['tables'][table_name] = {
-                        'data': table_data,
-                        'all_columns': info['all_columns']
-                    }
-                    
-                    cursor.close()
+                # Solo se guardan los digests; las filas no se retienen en memoria
+                if self.server_hash:
+                    digests = self._iter_server_digests(conn, table_name, info, source_config['alias'],
+                                                        watermark_column, meta, key_hasher, clock)
+                else:
+                    digests = self._iter_snapshot_digests(conn, table_name, info, source_config['alias'],
+                                                          watermark_column, meta, key_hasher, clock)
+                row_count = writer.add_table(table_name, info['all_columns'], digests, meta,
+                                             key_size=KEY_SIZE if key_hasher else 0)
+                clock.lap('escritura_snapshot')
+                clock.rows_read = row_count
+                clock.stop()
+                self.metrics.count(source_config['alias'], table_name,
+                                   bytes_leidos=self.session_bytes(conn, 'Bytes_sent') - bytes_sent)
+                self.logger.info(f"Snapshot de {source_config['alias']}.{table_name}: {row_count} registros")
                 
-                snapshot['sources'][source_config['alias']] = source_snapshot
-                conn.close()
-            
-            # Guardar snapshot
-            with open(self.snapshot_file, 'w', encoding='utf-8') as f:
-                json.dump(snapshot, f, indent=2, default=str)
-            
-            total_sources = len(self.source_databases)
-            self.logger.info(f"Snapshot guardado con {total_sources} fuentes de datos")
-            
+                summary['tablas'] += 1
+                summary['registros'] += row_count
+                self.emit('tabla', fuente=source_config['alias'], tabla=table_name, registros=row_count,
+                          completadas=summary['tablas'], total=len(table_info))
+            writer.commit()
+        except Exception:
+            writer.abort()
+            raise
+        finally:
+            conn.close()
+        
+        if binlog_start:
+            self.binlog_checkpoint.save(source_config['alias'], binlog_start)
+        return summary
+    
+    def _iter_snapshot_digests(self, conn: mysql.connector.MySQLConnection, table_name: str, info: Dict,
+                               source_alias: str, watermark_column, meta: Dict,
+                               key_hasher: KeyHasher = None, clock: PhaseClock = None) -> Iterator[bytes]:
+        """Genera los digests de una tabla y registra en meta el máximo de la columna de watermark"""
+        hasher = RowHasher(info['all_columns'], info['column_types'], source_alias, self.hash_algorithm)
+        clock = clock or self.metrics.clock(source_alias, table_name)
+        high_water = None
+        for rows in self.scan_table(conn, table_name, info, source_alias):
+            clock.lap('extraccion')
+            if watermark_column:
+                values = [row.get(watermark_column[0]) for row in rows]
+                values = [value for value in values if value is not None]
+                if values and (high_water is None or max(values) > high_water):
+                    high_water = max(values)
+            if key_hasher:
+                digests = list(map(bytes.__add__, key_hasher.hash_rows(rows), hasher.hash_rows(rows)))
+            else:
+                digests = hasher.hash_rows(rows)
+            clock.lap('hash')
+            yield from digests
+            # Lo que tarda el escritor en consumir el bloque (runs ordenados en disco)
+            clock.lap('escritura_snapshot')
+        
+        self._store_watermark(meta, watermark_column, high_water)
+    
+    def _iter_server_digests(self, conn: mysql.connector.MySQLConnection, table_name: str, info: Dict,
+                             source_alias: str, watermark_column, meta: Dict,
+                             key_hasher: KeyHasher = None, clock: PhaseClock = None) -> Iterator[bytes]:
+        """Digests calculados por la fuente: solo viajan 32 bytes por fila (más la PK en modo changeset)"""
+        digest_sql = self.build_row_digest_sql(info, source_alias)
+        select = [digest_sql]
+        if watermark_column:
+            select.append(f"`{watermark_column[0]}`")
+        key_columns = info['primary_key'] if key_hasher else []
+        key_start = len(select)
+        select.extend(f"`{column}`" for column in key_columns)
+        high_water = None
+        rows = (row for rows in self.scan_table(conn, table_name, info, source_alias, ', '.join(select),
+                                                dictionary=False)
+                for row in rows)
+        for row in rows:
+            if watermark_column:
+                value = row[1]
+                if value is not None and (high_water is None or value > high_water):
+                    high_water = value
+            if key_hasher:
+                key = key_hasher.hash_row(dict(zip(key_columns, row[key_start:])))
+                yield key + bytes(row[0])
+            else:
+                yield bytes(row[0])
+        
+        # El hash lo calcula la fuente: todo el recorrido cuenta como extracción
+        if clock:
+            clock.lap('extraccion')
+        
+        self._store_watermark(meta, watermark_column, high_water)
+    
+    def get_checksum_column(self, info: Dict):
+        """PK entera de una columna sobre la que se pueden definir rangos de checksum"""
+        primary_key = info.get('primary_key') or []
+        if len(primary_key) != 1:
+            return None
+        data_type = (info['column_types'].get(primary_key[0]) or '').lower()
+        if data_type not in ('tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint'):
+            return None
+        return primary_key[0]
+    
+    def _compute_leaf_checksums(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                                info: Dict, source_alias: str) -> Dict:
+        """Checksum agregado (COUNT, BIT_XOR(CRC32)) por rango de PK, en una sola consulta"""
+        column = self.get_checksum_column(info)
+        canonical_sql = self.build_row_canonical_sql(info, source_alias)
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT `{column}` DIV %s AS bucket, COUNT(*), BIT_XOR(CRC32({canonical_sql}))
+            FROM `{table_name}`
+            GROUP BY bucket
+            ORDER BY bucket
+        """, (self.checksum_chunk,))
+        leaves = [[int(bucket), int(count), int(checksum)] for bucket, count, checksum in cursor.fetchall()]
+        cursor.close()
+        return {'column': column, 'chunk': self.checksum_chunk, 'leaves': leaves}
+    
+    def _checksum_changed_filters(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                                  info: Dict, source_alias: str, checksums: Dict) -> List[Tuple[str, Tuple]]:
+        """Compara checksums por rangos y baja recursivamente solo en los que cambiaron"""
+        column = checksums['column']
+        chunk = checksums['chunk']
+        leaves = checksums['leaves']
+        buckets = [leaf[0] for leaf in leaves]
+        canonical_sql = self.build_row_canonical_sql(info, source_alias)
+        aggregate_sql = f"SELECT COUNT(*), BIT_XOR(CRC32({canonical_sql})) FROM `{table_name}`"
+        
+        def expected(lo: int, hi: int) -> Tuple[int, int]:
+            count, checksum = 0, 0
+            for leaf in leaves[bisect_left(buckets, lo):bisect_right(buckets, hi)]:
+                count += leaf[1]
+                checksum ^= leaf[2]
+            return count, checksum
+        
+        def actual(lo: int, hi: int) -> Tuple[int, int]:
+            cursor = conn.cursor()
+            cursor.execute(f"{aggregate_sql} WHERE `{column}` BETWEEN %s AND %s", (lo * chunk, (hi + 1) * chunk - 1))
+            count, checksum = cursor.fetchone()
+            cursor.close()
+            return int(count), int(checksum or 0)
+        
+        changed = []
+        
+        def drill(lo: int, hi: int):
+            # Un rango vacío en la apertura es todo nuevo; una hoja distinta se revisa fila a fila
+            if lo == hi or expected(lo, hi)[0] == 0:
+                changed.append((lo, hi))
+                return
+            middle = (lo + hi) // 2
+            for half_lo, half_hi in ((lo, middle), (middle + 1, hi)):
+                if actual(half_lo, half_hi) != expected(half_lo, half_hi):
+                    drill(half_lo, half_hi)
+        
+        # Primer nivel: todos los tramos de fanout hojas en una sola consulta agrupada
+        span = chunk * self.checksum_fanout
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT `{column}` DIV %s AS span, COUNT(*), BIT_XOR(CRC32({canonical_sql}))
+            FROM `{table_name}`
+            GROUP BY span
+        """, (span,))
+        current_spans = {int(span_id): (int(count), int(checksum)) for span_id, count, checksum in cursor.fetchall()}
+        cursor.close()
+        
+        span_ids = set(current_spans) | {bucket // self.checksum_fanout for bucket in buckets}
+        for span_id in sorted(span_ids):
+            lo = span_id * self.checksum_fanout
+            hi = lo + self.checksum_fanout - 1
+            if current_spans.get(span_id, (0, 0)) != expected(lo, hi):
+                drill(lo, hi)
+        
+        self.logger.info(f"Checksum de {source_alias}.{table_name}: {len(changed)} rangos con cambios")
+        
+        # Unir rangos contiguos y agruparlos en consultas de tamaño acotado
+        merged = []
+        for lo, hi in changed:
+            if merged and merged[-1][1] + 1 == lo:
+                merged[-1] = (merged[-1][0], hi)
+            else:
+                merged.append((lo, hi))
+        
+        filters = []
+        for start in range(0, len(merged), 100):
+            group = merged[start:start + 100]
+            where = ' OR '.join(f"`{column}` BETWEEN %s AND %s" for _ in group)
+            params = tuple(value for lo, hi in group for value in (lo * chunk, (hi + 1) * chunk - 1))
+            filters.append((f" WHERE {where}", params))
+        return filters
+    
+    def _refresh_leaf_checksums(self, conn: mysql.connector.MySQLConnection, table_name: str, info: Dict,
+                                source_alias: str, checksums: Dict, filters: List[Tuple[str, Tuple]]) -> Dict:
+        """Checksums hoja actuales de los rangos cambiados, para avanzar el snapshot tras el cierre"""
+        chunk = checksums['chunk']
+        canonical_sql = self.build_row_canonical_sql(info, source_alias)
+        refreshed_ranges = []
+        current = {}
+        cursor = conn.cursor()
+        for where, params in filters:
+            refreshed_ranges.extend((params[i] // chunk, params[i + 1] // chunk) for i in range(0, len(params), 2))
+            cursor.execute(f"""
+                SELECT `{checksums['column']}` DIV %s AS bucket, COUNT(*), BIT_XOR(CRC32({canonical_sql}))
+                FROM `{table_name}`{where}
+                GROUP BY bucket
+            """, (chunk,) + params)
+            for bucket, count, checksum in cursor.fetchall():
+                current[int(bucket)] = [int(bucket), int(count), int(checksum)]
+        cursor.close()
+        
+        # Las hojas fuera de los rangos releídos se conservan; las de dentro se reemplazan
+        range_starts = [lo for lo, _ in refreshed_ranges]
+        leaves = {}
+        for leaf in checksums['leaves']:
+            position = bisect_right(range_starts, leaf[0]) - 1
+            if position < 0 or leaf[0] > refreshed_ranges[position][1]:
+                leaves[leaf[0]] = leaf
+        leaves.update(current)
+        return dict(checksums, leaves=[leaves[bucket] for bucket in sorted(leaves)])
+    
+    def _store_watermark(self, meta: Dict, watermark_column, high_water):
+        """Guarda en los metadatos de la tabla el máximo visto de la columna de watermark"""
+        if watermark_column and high_water is not None:
+            meta['watermark'] = {
+                'column': watermark_column[0],
+                'kind': watermark_column[1],
+                'value': high_water if isinstance(high_water, int) else str(high_water)
+            }
+    
+    def session_bytes(self, conn: mysql.connector.MySQLConnection, variable: str) -> int:
+        """Contador de bytes de la sesión (Bytes_sent / Bytes_received); 0 si no está disponible"""
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SHOW SESSION STATUS LIKE %s", (variable,))
+            row = cursor.fetchone()
+            cursor.close()
+            return int(row[1]) if row else 0
+        except Exception:
+            return 0
+    
+    def emit(self, event: str, **data):
+        """Notifica un evento de progreso si hay un suscriptor (modo servicio)"""
+        if self.progress is not None:
+            self.progress(dict(data, evento=event, timestamp=datetime.now().isoformat()))
+    
+    def run_per_source(self, task) -> Dict[str, Dict]:
+        """Ejecuta una tarea por fuente, en paralelo si workers > 1, y devuelve el resumen por alias"""
+        def run(source_config: Dict) -> Dict:
+            start = time.time()
+            try:
+                result = task(source_config)
+            except Exception as e:
+                self.logger.error(f"Error procesando fuente {source_config['alias']}: {e}")
+                result = {'error': str(e)}
+            throttle = self.throttles.pop(source_config['alias'], None)
+            if throttle is not None and throttle.rows:
+                # Incluida en los segundos de extracción
+                self.metrics.add_time(source_config['alias'], None, 'pausa_throttle', throttle.paused)
+                result['pausa_throttle'] = round(throttle.paused, 2)
+            result['segundos'] = round(time.time() - start, 2)
+            self.emit('fuente', fuente=source_config['alias'], resultado=result)
+            return result
+        
+        if self.workers <= 1:
+            results = [run(source_config) for source_config in self.source_databases]
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(run, self.source_databases))
+        
+        return {source_config['alias']: result for source_config, result in zip(self.source_databases, results)}
+    
+    def report_summary(self, title: str, summary: Dict[str, Dict]):
+        """Registra en el log el resumen por fuente"""
+        self.logger.info(f"{title}:")
+        for alias, result in summary.items():
+            details = ', '.join(f"{key}={value}" for key, value in result.items())
+            self.logger.info(f"  {alias}: {details}")
+    
+    def publish_run(self, summary: Dict[str, Dict]):
+        """Escribe las métricas de la ejecución (JSON y Prometheus) y el estado por fuente en alias.json"""
+        self.metrics.finished_at = datetime.now()
+        mode = self.metrics.mode
+        try:
+            if self.metrics_prefix:
+                # Un archivo por fuente: las corridas de cada sucursal no pisan las series de las demás
+                for alias in summary:
+                    path = f"{self.metrics_prefix}_{mode}_{alias_file_name(alias)}"
+                    self.metrics.write_json(f"{path}.json", alias)
+                    self.metrics.write_prometheus(f"{path}.prom", alias)
+            if self.status_file and Path(self.status_file).exists():
+                self.update_consolidation_status(summary)
         except Exception as e:
-            self.logger.error(f"Error tomando snapshot: {e}")
-            raise
+            # Las métricas nunca deben hacer fallar la consolidación
+            self.logger.warning(f"No se pudieron escribir las métricas: {e}")
+    
+    def update_consolidation_status(self, summary: Dict[str, Dict]):
+        """Actualiza el bloque consolidation_status de cada fuente procesada en alias.json. Las corridas
+        de otras sucursales también lo reescriben: la lectura y la escritura van bajo un lock entre procesos"""
+        with file_lock(self.status_file):
+            self._update_consolidation_status(summary)
+    
+    def _update_consolidation_status(self, summary: Dict[str, Dict]):
+        with open(self.status_file, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        
+        mode = self.metrics.mode
+        for origin in config.get('db_origenes', []):
+            result = summary.get(origin.get('alias'))
+            if result is None:
+                continue
+            status = origin.setdefault('consolidation_status', {})
+            status['timestamp'] = self.metrics.finished_at.isoformat()
+            status['segundos'] = result.get('segundos')
+            if result.get('error'):
+                status['status'] = 'error'
+                status['error'] = result['error']
+            else:
+                status['status'] = {'apertura': 'aperturado', 'cierre': 'cerrado'}.get(mode, mode)
+                status.pop('error', None)
+            if mode in ('cierre', 'cdc'):
+                status['latest_inserts'] = result.get('insertados', 0)
+                status['failed_inserts'] = result.get('fallidos', 0)
+            slowest = self.metrics.slowest_table(origin['alias'])
+            if slowest:
+                status['tabla_mas_lenta'] = {'tabla': slowest[0], 'segundos': slowest[1]}
+        
+        write_atomic(self.status_file, json.dumps(config, indent=4, ensure_ascii=False))
+    
+    def load_snapshot(self):
+        """Abre los manifiestos de las fuentes de esta ejecución; las tablas se mapean al consultarlas.
+        Una fuente sin snapshot propio se busca en el archivo único de versiones anteriores"""
+        self.snapshot_store = SnapshotStore(self.snapshot_dir)
+        aliases = [source_config['alias'] for source_config in self.source_databases]
+        legacy = None
+        if any(self.snapshot_store.load_manifest(alias) is None for alias in aliases):
+            if Path(self.legacy_snapshot_file).exists():
+                self.logger.info(f"Usando snapshot JSON heredado: {self.legacy_snapshot_file}")
+                legacy = LegacyJsonSnapshot(self.legacy_snapshot_file)
+        
+        snapshot = ShardedSnapshot(self.snapshot_store, aliases, legacy)
+        if not snapshot.sources:
+            snapshot.close()
+            return None
+        return snapshot
     
-    def consolidate_changes(self):
+    def consolidate_changes(self) -> Dict[str, Dict]:
         """Consolida cambios de todas las fuentes en la base de datos de destino"""
         self.logger.info("Iniciando consolidación de cambios...")
+        self.metrics = ConsolidationMetrics('cierre')
+        self.emit('inicio', modo='cierre', fuentes=[source['alias'] for source in self.source_databases])
         
         # Cargar snapshot
-        if not Path(self.snapshot_file).exists():
+        snapshot = self.load_snapshot()
+        if snapshot is None:
             self.logger.warning("No existe snapshot previo")
-            return
-        
-        with open(self.snapshot_file, 'r', encoding='utf-8') as f:
-            snapshot = json.load(f)
-        
-        # Cargar inserts fallidos previos
-        self.load_failed_inserts()
+            return {}
         
         try:
+            # Antes de escribir nada: cada fuente se compara con el hash con que se tomó su snapshot
+            for alias, source in snapshot.sources.items():
+                try:
+                    require_hash_version(source['hash_version'])
+                except ValueError as e:
+                    raise ValueError(f"Snapshot de {alias}: {e}")
+            self.resume_state = self.open_journals(snapshot)
             target_conn = self.get_db_connection(self.target_config)
             
             # Crear/actualizar tablas de destino
             self.create_target_tables(target_conn)
             
             # Deshabilitar restricciones para inserción libre
-            target_conn.cmd_query("SET foreign_key_checks = 0")
-            target_conn.cmd_query("SET sql_mode = ''")  # Modo permisivo
+            self.prepare_target_session(target_conn)
             
-            # Procesar inserts fallidos primero
-            if self.failed_inserts_log:
-                self.logger.info(f"Procesando {len(self.failed_inserts_log)} inserts fallidos previos...")
+            # Procesar inserts fallidos primero (solo los que ya cumplieron su backoff)
+            due_failures = self.dead_letters.count(due_only=True)
+            if due_failures:
+                self.logger.info(f"Procesando {due_failures} inserts fallidos previos...")
                 self.process_failed_inserts(target_conn)
             
-            # Procesar cada fuente
+            target_conn.close()
+            
+            # Procesar cada fuente (cada worker usa sus propias conexiones)
+            self.snapshot_updates = {}
+            summary = self.run_per_source(lambda source_config: self._consolidate_source(source_config, snapshot))
+            
+            pending_failures = self.dead_letters.count()
+            if pending_failures:
+                self.logger.info(f"Inserts fallidos pendientes: {pending_failures}")
+            
+            if self.write_mode != 'append' and self.snapshot_updates:
+                # El próximo cierre solo verá lo que cambie a partir de ahora
+                self.advance_snapshot(snapshot)
+                for alias in sorted({alias for alias, _ in self.snapshot_updates}):
+                    self.journals[alias].append({'paso': 'snapshot', 'fuentes': [alias]})
+            else:
+                snapshot.close()
+            
+            self.report_summary("Resumen de cierre", summary)
+            self.publish_run(summary)
+            
+            # Solo queda la bitácora de las fuentes con error
+            failed_sources = [alias for alias, result in summary.items() if result.get('error')]
+            for alias, journal in self.journals.items():
+                if alias not in failed_sources:
+                    journal.finish()
+            if failed_sources:
+                raise RuntimeError(f"Fuentes con error en la consolidación: {', '.join(failed_sources)} "
+                                   f"(--resume retoma solo lo pendiente)")
+            
+            self.logger.info("Consolidación completada")
+            return summary
+            
+        except Exception as e:
+            self.logger.error(f"Error en consolidación: {e}")
+            raise
+        finally:
+            for journal in self.journals.values():
+                journal.close()
+            self.journals = {}
+            # Los avances que no llegaron a aplicarse (error o modo append) no dejan temporales abiertos
+            close_spools(self.snapshot_updates.values())
+            self.snapshot_updates = {}
+    
+    def open_journals(self, snapshot) -> Dict[str, Dict]:
+        """Toma la bitácora de cada fuente del cierre (falla si otro cierre de la misma fuente está en curso);
+        con resume devuelve el avance del cierre interrumpido por fuente"""
+        progress = {}
+        try:
             for source_config in self.source_databases:
-                self.logger.info(f"Consolidando cambios de: {source_config['alias']}")
+                alias = source_config['alias']
+                if alias not in snapshot.sources:
+                    continue
+                journal = ConsolidationJournal(str(self.snapshot_store.journal_path(alias)), alias)
+                journal.acquire()
+                self.journals[alias] = journal
+                tables = self._open_journal(journal, snapshot.sources[alias]['timestamp'])
+                if tables:
+                    progress[alias] = tables
+        except Exception:
+            for journal in self.journals.values():
+                journal.close()
+            self.journals = {}
+            raise
+        return progress
+    
+    def _open_journal(self, journal: ConsolidationJournal, snapshot_timestamp: str) -> Dict[str, Dict]:
+        """Empieza o retoma la bitácora de una fuente; devuelve el avance por tabla a retomar"""
+        alias = journal.alias
+        state = journal.load()
+        if state is not None and not self.resume:
+            self.logger.warning(f"Se descarta la bitácora de un cierre interrumpido de {alias} "
+                                f"(use --resume para retomarlo)")
+        elif state is not None:
+            header = state['cabecera']
+            if header.get('write_mode') != self.write_mode:
+                self.logger.warning(f"La bitácora de {alias} es de un cierre con --write-mode "
+                                    f"{header.get('write_mode')}: se empieza de nuevo")
+            elif header.get('snapshot') != snapshot_timestamp:
+                # El avance solo vale si la fuente se sigue comparando con el mismo snapshot
+                self.logger.warning(f"La bitácora de {alias} es de otro snapshot: se empieza de nuevo")
+            else:
+                self.journal_since[alias] = header['inicio']
+                self.journal_binlog[alias] = state['binlog']
+                tables = state['tablas'].get(alias, {})
+                self.logger.info(f"Retomando cierre de {alias}: "
+                                 f"{sum(1 for table in tables.values() if table['estado'] == 'completa')} "
+                                 f"tablas completas")
+                return tables
+        elif self.resume:
+            self.logger.info(f"No hay un cierre interrumpido de {alias} para retomar")
+        
+        self.journal_since[alias] = datetime.now().replace(microsecond=0).isoformat()
+        self.journal_binlog.pop(alias, None)
+        journal.start({'inicio': self.journal_since[alias], 'write_mode': self.write_mode,
+                       'snapshot': snapshot_timestamp})
+        return {}
+    
+    def journal_step(self, source_alias: str, table_name: str, step: str, **data):
+        """Registra en la bitácora de la fuente un paso ya confirmado en el destino"""
+        journal = self.journals.get(source_alias)
+        if journal is not None:
+            journal.append(dict(data, paso=step, alias=source_alias, tabla=table_name))
+    
+    def written_records(self, target_conn: mysql.connector.MySQLConnection, table_name: str,
+                        source_alias: str) -> DigestMultiset:
+        """_record_hash que el cierre interrumpido ya escribió en una tabla (o mandó al log de fallos),
+        leídos en streaming y ordenados en disco dentro de --memory-budget"""
+        since = self.journal_since[source_alias]
+        rows = self.iter_rows(target_conn, f"SELECT `_record_hash` FROM `{table_name}` WHERE `_source_alias` = %s "
+                                           f"AND `_sync_timestamp` >= %s",
+                              (source_alias, datetime.fromisoformat(since)), dictionary=False)
+        hashes = (row[0] for row in rows)
+        failed = self.dead_letters.record_hashes(table_name, source_alias, since)
+        # Multiconjunto: dos filas idénticas de la fuente tienen el mismo hash
+        return DigestMultiset((bytes.fromhex(record_hash) for record_hash in chain(hashes, failed)
+                               if record_hash), self.memory_budget // 4)
+    
+    def pending_records(self, table_name: str, records: List[Dict], source_alias: str,
+                        written: DigestMultiset = None) -> List[Dict]:
+        """Quita los registros que el cierre interrumpido ya escribió"""
+        if not written or not records:
+            return records
+        pending = []
+        for record in records:
+            if not written.take(bytes.fromhex(record['_record_hash'])):
+                pending.append(record)
+        if len(pending) < len(records):
+            self.logger.info(f"{source_alias}.{table_name}: {len(records) - len(pending)} registros ya escritos "
+                             f"por el cierre interrumpido")
+        return pending
+    
+    def _consolidate_source(self, source_config: Dict, snapshot) -> Dict:
+        """Consolida los cambios de una fuente con conexiones propias de origen y destino"""
+        source_alias = source_config['alias']
+        self.logger.info(f"Consolidando cambios de: {source_alias}")
+        summary = {'tablas': 0, 'nuevos': 0, 'insertados': 0}
+        if self.write_mode == 'changeset':
+            summary.update({'actualizados': 0, 'eliminados': 0})
+        resumed = self.resume_state.get(source_alias, {})
+        if resumed:
+            summary['omitidas'] = 0  # Tablas que el cierre interrumpido ya había terminado
+        
+        if source_alias not in snapshot.sources:
+            self.logger.warning(f"Fuente {source_alias} no existe en snapshot")
+            summary['error'] = 'sin snapshot'
+            return summary
+        
+        hash_version = snapshot.sources[source_alias]['hash_version']
+        # El cierre siempre compara con el mismo método de hash que usó la apertura de la fuente
+        current_version = SERVER_HASH_VERSION if self.server_hash else self.hash_algorithm
+        if current_version != hash_version:
+            self.logger.warning(f"Se usa el método de hash del snapshot de {source_alias}: {hash_version}")
+        
+        updates = {}
+        source_conn = self.get_db_connection(source_config)
+        target_conn = self.get_db_connection(self.target_config)
+        try:
+            self.prepare_target_session(target_conn)
+            # Al retomar vale la posición del cierre interrumpido: sus tablas completas se leyeron entonces
+            if source_alias in self.journal_binlog:
+                binlog_start = self.journal_binlog[source_alias]
+            else:
+                binlog_start = self.read_binlog_start(source_conn, source_alias)
+                if binlog_start:
+                    self.journal_step(source_alias, None, 'binlog', posicion=binlog_start)
+            table_info = self.get_source_table_info(source_config, source_conn)
+            
+            for table_name, info in table_info.items():
+                progress = resumed.get(table_name)
+                if progress and progress['estado'] == 'completa':
+                    # Solo falta incorporar sus cambios al snapshot
+                    if progress.get('update'):
+                        updates[table_name] = progress['update']
+                    summary['omitidas'] += 1
+                    continue
                 
-                source_conn = self.get_db_connection(source_config)
-                source_alias = source_config['alias']
+                snapshot_table = snapshot.table(source_alias, table_name)
+                if snapshot_table is None:
+                    self.logger.warning(f"Tabla {table_name} no existe en snapshot de {source_alias}")
+                    continue
                 
-                if source_alias not in snapshot['sources']:
-                    self.logger.warning(f"Fuente {source_alias} no existe en snapshot")
+                table_meta = snapshot.table_meta(source_alias, table_name)
+                if table_meta.get('key_size'):
+                    if self.write_mode != 'changeset':
+                        raise ValueError(f"El snapshot de {source_alias}.{table_name} se tomó con --write-mode changeset")
+                    self._consolidate_changeset_table(source_conn, target_conn, table_name, snapshot_table, info,
+                                                      source_config, hash_version, summary, updates, progress)
+                    update = updates.get(table_name)
+                    self.journal_step(source_alias, table_name, 'completa',
+                                      update=ConsolidationJournal.encode_update(update) if update else None)
+                    self.emit('tabla', fuente=source_alias, tabla=table_name, completadas=summary['tablas'],
+                              total=len(table_info))
+                    snapshot.release(source_alias, table_name)
                     continue
                 
-                table_info = self.get_table_info(source_conn, source_config['database'])
+                watermark = table_meta.get('watermark') if self.incremental else None
+                checksums = table_meta.get('checksums') if self.diff_engine == 'checksum' else None
                 
-                for table_name, info in table_info.items():
-                    if table_name not in snapshot['sources'][source_alias]['tables']:
-                        self.logger.warning(f"Tabla {table_name} no existe en snapshot de {source_alias}")
-                        continue
-                    
-                    new_records = self.find_new_records(
-                        source_conn, table_name,
-                        snapshot['sources'][source_alias]['tables'][table_name],
-                        info, source_alias
-                    )
-                    
-                    if new_records:
-                        self.insert_consolidated_records(target_conn, table_name, new_records, source_config)
-                        self.logger.info(f"Consolidados {len(new_records)} nuevos registros de {source_alias}.{table_name}")
+                # Checksums de los rangos releídos, tomados antes de leer las filas
+                refreshed = {} if self.write_mode != 'append' else None
+                bytes_sent = self.session_bytes(source_conn, 'Bytes_sent')
+                written = self.written_records(target_conn, table_name, source_alias) if progress else None
+                # Con --memory-budget los digests a incorporar al snapshot se ordenan en disco
+                new_digests = SortedSpool(self.memory_budget // 4) if self.memory_budget and refreshed is not None else []
+                new_watermark = table_meta.get('watermark')
+                table_new = 0
+                # Los bloques se escriben a medida que salen del diff; con --pipeline-depth, en el hilo
+                # de escritura que usa la conexión de destino de la fuente
+                def write(records: List[Dict]) -> int:
+                    return self._write_table_records(target_conn, table_name, records, source_config)
                 
-                source_conn.close()
+                try:
+                    with BlockWriter(write, self.pipeline_depth, f"escritura-{source_alias}") as writer:
+                        for new_records in self.iter_new_records(source_conn, table_name, snapshot_table, info,
+                                                                 source_alias, watermark, hash_version=hash_version,
+                                                                 checksums=checksums, meta=refreshed):
+                            pending = self.pending_records(table_name, new_records, source_alias, written)
+                            if pending:
+                                if not table_new:
+                                    self.journal_step(source_alias, table_name, 'escribiendo')
+                                writer.put(pending)
+                                table_new += len(pending)
+                            if refreshed is not None:
+                                # El snapshot incorpora también lo que escribió el cierre interrumpido
+                                for record in new_records:
+                                    if self.memory_budget:
+                                        new_digests.add(bytes.fromhex(record['_record_hash']))
+                                    else:
+                                        new_digests.append(bytes.fromhex(record['_record_hash']))
+                                new_watermark = self._advance_watermark(new_watermark, new_records)
+                    summary['insertados'] += writer.written
+                except BaseException:
+                    # Un error a mitad de la tabla no deja abiertos los tramos en disco
+                    if isinstance(new_digests, SortedSpool):
+                        new_digests.close()
+                    raise
+                finally:
+                    if written is not None:
+                        written.close()
+                self.metrics.count(source_alias, table_name,
+                                   bytes_leidos=self.session_bytes(source_conn, 'Bytes_sent') - bytes_sent)
+                summary['tablas'] += 1
+                summary['nuevos'] += table_new
+                if table_new:
+                    self.logger.info(f"Consolidados {table_new} nuevos registros de {source_alias}.{table_name}")
+                self.emit('tabla', fuente=source_alias, tabla=table_name, nuevos=table_new,
+                          completadas=summary['tablas'], total=len(table_info))
+                
+                if refreshed is not None and (new_digests or refreshed):
+                    updates[table_name] = {
+                        'digests': new_digests if self.memory_budget else sorted(new_digests),
+                        'watermark': new_watermark,
+                        'checksums': refreshed.get('checksums')
+                    }
+                update = updates.get(table_name)
+                if update and isinstance(update['digests'], SortedSpool):
+                    # Los digests en disco no caben en la bitácora: al retomar se recalcula el diff
+                    # de la tabla, sin volver a escribir sus registros
+                    self.journal_step(source_alias, table_name, 'escrita')
+                else:
+                    self.journal_step(source_alias, table_name, 'completa',
+                                      update=ConsolidationJournal.encode_update(update) if update else None)
+                # Solo queda mapeada la tabla que se está comparando
+                snapshot.release(source_alias, table_name)
+        except BaseException:
+            # La fuente falló: los avances de sus tablas ya terminadas no se aplican
+            close_spools(updates.values())
+            raise
+        finally:
+            source_conn.close()
+            target_conn.close()
+        
+        # Solo se avanza el snapshot de las fuentes que terminaron sin error
+        with self.snapshot_updates_lock:
+            for table_name, update in updates.items():
+                self.snapshot_updates[(source_alias, table_name)] = update
+        if binlog_start:
+            # El destino ya refleja la fuente hasta el inicio de la lectura: el cdc sigue desde ahí
+            self.binlog_checkpoint.save(source_alias, binlog_start)
+        
+        summary['fallidos'] = summary['nuevos'] + summary.get('actualizados', 0) - summary['insertados']
+        return summary
+    
+    def _consolidate_changeset_table(self, source_conn: mysql.connector.MySQLConnection,
+                                     target_conn: mysql.connector.MySQLConnection, table_name: str,
+                                     snapshot_table: KeyedDigestIndex, info: Dict, source_config: Dict,
+                                     hash_version: str, summary: Dict, updates: Dict, progress: Dict = None):
+        """Aplica altas y modificaciones como upserts y las bajas como borrado lógico"""
+        source_alias = source_config['alias']
+        bytes_sent = self.session_bytes(source_conn, 'Bytes_sent')
+        inserted, updated, deleted_keys = self.find_changed_records(source_conn, table_name, snapshot_table,
+                                                                    info, source_alias, hash_version)
+        self.metrics.count(source_alias, table_name,
+                           bytes_leidos=self.session_bytes(source_conn, 'Bytes_sent') - bytes_sent)
+        summary['tablas'] += 1
+        
+        changed = inserted + updated
+        written = self.written_records(target_conn, table_name, source_alias) if progress else None
+        try:
+            pending = self.pending_records(table_name, changed, source_alias, written)
+        finally:
+            if written is not None:
+                written.close()
+        if pending or deleted_keys:
+            self.journal_step(source_alias, table_name, 'escribiendo')
+        if len(pending) < len(changed):
+            # Las bajas se vuelven a aplicar: marcar una fila ya marcada no la modifica
+            pending_ids = {id(record) for record in pending}
+            inserted = [record for record in inserted if id(record) in pending_ids]
+            updated = [record for record in updated if id(record) in pending_ids]
+        if pending:
+            summary['insertados'] += self._write_table_records(target_conn, table_name, pending, source_config)
+        if deleted_keys:
+            with self.metrics.timer(source_alias, 'bajas', table_name):
+                self.soft_delete_records(target_conn, table_name, deleted_keys, source_alias)
+        summary['nuevos'] += len(inserted)
+        summary['actualizados'] += len(updated)
+        summary['eliminados'] += len(deleted_keys)
+        
+        if changed or deleted_keys:
+            self.logger.info(f"Cambios en {source_alias}.{table_name}: {len(inserted)} altas, "
+                             f"{len(updated)} modificaciones, {len(deleted_keys)} bajas")
+            updates[table_name] = {
+                'entries': sorted(bytes.fromhex(record['_source_key']) + bytes.fromhex(record['_record_hash'])
+                                  for record in changed),
+                'deleted': set(deleted_keys),
+                'watermark': None,
+                'checksums': None
+            }
+    
+    def _write_table_records(self, target_conn: mysql.connector.MySQLConnection, table_name: str,
+                             records: List[Dict], source_config: Dict) -> int:
+        """insert_consolidated_records con tiempo, filas y bytes registrados en las métricas"""
+        source_alias = source_config['alias']
+        bytes_received = self.session_bytes(target_conn, 'Bytes_received')
+        with self.metrics.timer(source_alias, 'insercion', table_name):
+            inserted = self.insert_consolidated_records(target_conn, table_name, records, source_config)
+        self.metrics.count(source_alias, table_name, filas_escritas=inserted,
+                           bytes_escritos=self.session_bytes(target_conn, 'Bytes_received') - bytes_received)
+        return inserted
+    
+    def _advance_watermark(self, watermark: Dict, new_records: List[Dict]):
+        """Watermark que incluye los registros recién consolidados"""
+        if not watermark:
+            return None
+        values = [record[watermark['column']] for record in new_records
+                  if record.get(watermark['column']) is not None]
+        if not values:
+            return watermark
+        high_water = max(values)
+        if not isinstance(high_water, int):
+            high_water = str(high_water)
+        if isinstance(high_water, type(watermark['value'])) and high_water <= watermark['value']:
+            return watermark
+        return dict(watermark, value=high_water)
+    
+    def advance_snapshot(self, snapshot):
+        """Reescribe solo las tablas con cambios consolidados (digests, watermark y checksums nuevos)
+        y publica el manifiesto de cada fuente afectada"""
+        advanced = 0
+        try:
+            for alias in sorted({alias for alias, _ in self.snapshot_updates}):
+                source = snapshot.sources[alias]
+                # Una fuente que venía del snapshot de un solo archivo se migra completa
+                legacy = source.get('legacy', False)
+                writer = self.snapshot_store.begin_source(alias, source.get('database', ''), source['hash_version'],
+                                                          source['digest_size'], source['timestamp'],
+                                                          base=None if legacy else source)
+                try:
+                    for table_name, table in source['tables'].items():
+                        update = self.snapshot_updates.get((alias, table_name))
+                        if update is None and not legacy:
+                            continue
+                        meta = {key: value for key, value in snapshot.table_meta(alias, table_name).items()
+                                if key in ('watermark', 'checksums')}
+                        existing = snapshot.table(alias, table_name)
+                        if isinstance(existing, set):
+                            existing = sorted(existing)
+                        
+                        digests = existing
+                        if update and table.get('key_size'):
+                            digests = merge_keyed_records(existing, update['entries'], update['deleted'],
+                                                          table['key_size'])
+                            advanced += len(update['entries']) + len(update['deleted'])
+                        elif update:
+                            new_digests = update['digests']
+                            if isinstance(new_digests, SortedSpool):
+                                new_digests = new_digests.digests()
+                            digests = heapq.merge(existing, new_digests)
+                            advanced += len(update['digests'])
+                            if update['watermark']:
+                                meta['watermark'] = update['watermark']
+                            if update['checksums']:
+                                meta['checksums'] = update['checksums']
+                        
+                        writer.add_table(table_name, table.get('all_columns', []), digests, meta,
+                                         presorted=True, key_size=table.get('key_size', 0))
+                        if update and isinstance(update.get('digests'), SortedSpool):
+                            update['digests'].close()
+                        snapshot.release(alias, table_name)
+                    writer.commit()
+                except Exception:
+                    writer.abort()
+                    raise
+            self.logger.info(f"Snapshot avanzado con {advanced} cambios consolidados")
+        finally:
+            snapshot.close()
+    
+    def capture_changes(self) -> Dict[str, Dict]:
+        """Modo cdc: aplica los eventos de fila del binlog de cada fuente desde su checkpoint"""
+        if BinLogStreamReader is None:
+            raise RuntimeError("El modo cdc requiere el paquete mysql-replication (pip install mysql-replication)")
+        if self.write_mode != 'changeset':
+            # Los eventos se reaplican tras un corte: solo los upserts y bajas por PK son idempotentes
+            raise ValueError("El modo cdc requiere --write-mode changeset")
+        
+        self.logger.info("Iniciando captura de cambios del binlog...")
+        self.metrics = ConsolidationMetrics('cdc')
+        self.emit('inicio', modo='cdc', fuentes=[source['alias'] for source in self.source_databases])
+        
+        target_conn = self.get_db_connection(self.target_config)
+        self.create_target_tables(target_conn)
+        self.prepare_target_session(target_conn)
+        due_failures = self.dead_letters.count(due_only=True)
+        if due_failures:
+            self.logger.info(f"Procesando {due_failures} inserts fallidos previos...")
+            self.process_failed_inserts(target_conn)
+        target_conn.close()
+        
+        summary = self.run_per_source(self._capture_source)
+        
+        self.report_summary("Resumen de cdc", summary)
+        self.publish_run(summary)
+        failed_sources = [alias for alias, result in summary.items() if result.get('error')]
+        if failed_sources:
+            raise RuntimeError(f"Fuentes con error en la captura de cambios: {', '.join(failed_sources)}")
+        
+        self.logger.info("Captura de cambios completada")
+        return summary
+    
+    def check_binlog_settings(self, conn: mysql.connector.MySQLConnection) -> Dict:
+        """Verifica que la fuente escriba un binlog por filas con la imagen completa"""
+        cursor = conn.cursor()
+        cursor.execute("SELECT @@GLOBAL.log_bin, @@GLOBAL.binlog_format, @@GLOBAL.binlog_row_image, "
+                       "@@GLOBAL.gtid_mode")
+        log_bin, binlog_format, row_image, gtid_mode = cursor.fetchone()
+        cursor.close()
+        if not int(log_bin):
+            raise ValueError("La fuente no tiene el binlog habilitado (log_bin)")
+        if str(binlog_format).upper() != 'ROW' or str(row_image).upper() != 'FULL':
+            raise ValueError(f"El modo cdc requiere binlog_format=ROW y binlog_row_image=FULL "
+                             f"(la fuente usa {binlog_format}/{row_image})")
+        return {'gtid_mode': str(gtid_mode).upper()}
+    
+    def get_binlog_position(self, conn: mysql.connector.MySQLConnection) -> Dict:
+        """Posición actual del binlog de la fuente (archivo, posición y GTID ejecutados)"""
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute("SHOW BINARY LOG STATUS")  # MySQL 8.2+
+        except Error:
+            cursor.execute("SHOW MASTER STATUS")
+        row = cursor.fetchone()
+        cursor.close()
+        if not row:
+            raise ValueError("La fuente no tiene el binlog habilitado")
+        return {
+            'log_file': row['File'],
+            'log_pos': int(row['Position']),
+            'gtid_set': (row.get('Executed_Gtid_Set') or '').replace('\n', '') or None
+        }
+    
+    def read_binlog_start(self, conn: mysql.connector.MySQLConnection, source_alias: str):
+        """Posición del binlog desde la que el modo cdc puede seguir a la apertura o el cierre (solo changeset)"""
+        if self.write_mode != 'changeset':
+            return None
+        try:
+            return self.get_binlog_position(conn)
+        except (Error, ValueError) as e:
+            self.logger.warning(f"No se pudo leer la posición del binlog de {source_alias}: "
+                                f"el modo cdc no podrá continuar desde esta corrida ({e})")
+            return None
+    
+    def _capture_source(self, source_config: Dict) -> Dict:
+        """Lee el binlog de una fuente desde su checkpoint hasta la posición actual y escribe los cambios"""
+        source_alias = source_config['alias']
+        self.logger.info(f"Leyendo binlog de: {source_alias}")
+        summary = {'eventos': 0, 'tablas': 0, 'nuevos': 0, 'actualizados': 0, 'eliminados': 0,
+                   'insertados': 0, 'fallidos': 0}
+        
+        source_conn = self.get_db_connection(source_config)
+        target_conn = self.get_db_connection(self.target_config)
+        stream = None
+        try:
+            self.prepare_target_session(target_conn)
+            # _record_hash con la misma versión que usa el cierre changeset de la fuente
+            manifest = self.snapshot_store.load_manifest(source_alias)
+            if manifest is None:
+                raise ValueError(f"{source_alias} no tiene snapshot: el modo cdc requiere una apertura y un cierre "
+                                 f"con --write-mode changeset")
+            hash_version = manifest['hash_version']
+            if hash_version == SERVER_HASH_VERSION:
+                raise ValueError(f"El snapshot de {source_alias} se tomó con --server-hash: el hash del servidor "
+                                 f"no se puede calcular sobre los eventos del binlog")
+            require_hash_version(hash_version)
+            settings = self.check_binlog_settings(source_conn)
+            # Solo se leen los eventos escritos hasta ahora: la corrida termina aunque la fuente siga escribiendo
+            end = self.get_binlog_position(source_conn)
+            start = self.binlog_checkpoint.get(source_alias)
+            if start is None:
+                # Sin posición registrada no se sabe qué cambios faltan desde el último cierre
+                raise ValueError(f"{source_alias} no tiene posición de binlog registrada: el modo cdc continúa "
+                                 f"desde una apertura o un cierre con --write-mode changeset")
             
-            # Guardar inserts fallidos
-            self.save_failed_inserts()
+            table_info = {}
+            for table_name, info in self.get_source_table_info(source_config, source_conn).items():
+                if info['primary_key']:
+                    table_info[table_name] = info
+                else:
+                    self.logger.warning(f"Tabla {source_alias}.{table_name} sin PK: se omite en el modo cdc")
             
-            target_conn.close()
+            stream_options = {}
+            if start.get('gtid_set') and settings['gtid_mode'] == 'ON':
+                stream_options['auto_position'] = start['gtid_set']
+            else:
+                cursor = source_conn.cursor()
+                cursor.execute("SHOW BINARY LOGS")
+                available = {row[0] for row in cursor.fetchall()}
+                cursor.close()
+                if start['log_file'] not in available:
+                    raise ValueError(f"El binlog {start['log_file']} ya fue purgado en la fuente: "
+                                     f"se requiere una nueva apertura y cierre")
+                stream_options.update(log_file=start['log_file'], log_pos=start['log_pos'], resume_stream=True)
             
-            self.logger.info("Consolidación completada")
+            stream = BinLogStreamReader(
+                connection_settings={'host': source_config['host'], 'port': source_config.get('port', 3306),
+                                     'user': source_config['user'], 'passwd': source_config['password']},
+                server_id=self.cdc_server_id + self.source_databases.index(source_config),
+                only_schemas=[source_config['database']],
+                only_tables=list(table_info),
+                only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent],
+                blocking=False,
+                **stream_options
+            )
             
-        except Exception as e:
-            self.logger.error(f"Error en consolidación: {e}")
-            raise
+            end_coordinates = binlog_coordinates(end)
+            hashers = {}  # tabla -> (KeyHasher, RowHasher, miembros de sus columnas SET)
+            pending = {}  # tabla -> {hash de PK: registro, o None si es una baja}; el último evento gana
+            pending_rows = 0
+            read_seconds = 0.0
+            last = time.perf_counter()
+            for event in stream:
+                read_seconds += time.perf_counter() - last
+                if binlog_coordinates({'log_file': stream.log_file, 'log_pos': stream.log_pos}) > end_coordinates:
+                    break
+                info = table_info.get(event.table)
+                if info is None:
+                    last = time.perf_counter()
+                    continue
+                if event.table not in hashers:
+                    hashers[event.table] = (
+                        KeyHasher(info['primary_key'], info['column_types'], source_alias),
+                        RowHasher(info['all_columns'], info['column_types'], source_alias, hash_version),
+                        set_members(info.get('column_definitions', {}))
+                    )
+                key_hasher, hasher, members = hashers[event.table]
+                changes = pending.setdefault(event.table, {})
+                
+                for row in event.rows:
+                    if isinstance(event, UpdateRowsEvent):
+                        before = binlog_record(row['before_values'], info['all_columns'], members)
+                        record = binlog_record(row['after_values'], info['all_columns'], members)
+                        before_key = key_hasher.hash_row(before)
+                        key = key_hasher.hash_row(record)
+                        if before_key != key:
+                            # Cambió la PK: la clave anterior se da de baja
+                            changes[before_key] = None
+                        summary['actualizados'] += 1
+                    else:
+                        record = binlog_record(row['values'], info['all_columns'], members)
+                        key = key_hasher.hash_row(record)
+                        if isinstance(event, DeleteRowsEvent):
+                            changes[key] = None
+                            summary['eliminados'] += 1
+                            continue
+                        summary['nuevos'] += 1
+                    record['_record_hash'] = hasher.hash_row(record).hex()
+                    record['_source_key'] = key.hex()
+                    changes[key] = record
+                summary['eventos'] += len(event.rows)
+                pending_rows += len(event.rows)
+                self.metrics.count(source_alias, event.table, filas_leidas=len(event.rows))
+                
+                if pending_rows >= self.chunk_size:
+                    # Memoria acotada: los cambios acumulados se escriben antes de seguir leyendo
+                    for table_name, table_changes in pending.items():
+                        self._apply_binlog_changes(target_conn, table_name, table_changes, source_config, summary)
+                    pending, pending_rows = {}, 0
+                    self.emit('binlog', fuente=source_alias, eventos=summary['eventos'],
+                              posicion=f"{stream.log_file}:{stream.log_pos}")
+                last = time.perf_counter()
+            
+            for table_name, table_changes in pending.items():
+                self._apply_binlog_changes(target_conn, table_name, table_changes, source_config, summary)
+            self.metrics.add_time(source_alias, None, 'binlog', read_seconds)
+            summary['tablas'] = len(hashers)
+            
+            # Recién con todo escrito se avanza el checkpoint; tras un corte los eventos se reaplican
+            self.binlog_checkpoint.save(source_alias, end)
+            summary['posicion'] = f"{end['log_file']}:{end['log_pos']}"
+            self.logger.info(f"Binlog de {source_alias} consolidado hasta {summary['posicion']}: "
+                             f"{summary['eventos']} eventos de fila")
+        finally:
+            if stream is not None:
+                stream.close()
+            source_conn.close()
+            target_conn.close()
+        
+        return summary
     
-    def find_new_records(self, conn: mysql.connector.MySQLConnection, table_name: str,
-                        snapshot_table: Dict, table_info: Dict, source_alias: str) -> List[Dict]:
-        """Encuentra registros nuevos comparando con snapshot"""
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(f"SELECT * FROM `{table_name}`")
-        current_rows = cursor.fetchall()
-        
-        # Crear set de hashes del snapshot
-        snapshot_hashes = set()
-        for row in snapshot_table['data']:
-            if '_record_hash' in row:
-                snapshot_hashes.add(row['_record_hash'])
-        
-        # Encontrar registros nuevos
-        new_records = []
-        for row in current_rows:
-            # Convertir tipos para comparación y hash
-            processed_row = {}
-            for column in table_info['all_columns']:
-                value = row.get(column)
-                if isinstance(value, datetime):
-                    processed_row[column] = value.isoformat()
-                elif value is None:
-                    processed_row[column] = None
+    def _apply_binlog_changes(self, target_conn: mysql.connector.MySQLConnection, table_name: str,
+                              changes: Dict[bytes, Dict], source_config: Dict, summary: Dict):
+        """Escribe las altas y modificaciones como upserts y las bajas como borrado lógico"""
+        records = [record for record in changes.values() if record is not None]
+        deleted_keys = [key for key, record in changes.items() if record is None]
+        if records:
+            inserted = self._write_table_records(target_conn, table_name, records, source_config)
+            summary['insertados'] += inserted
+            summary['fallidos'] += len(records) - inserted
+        if deleted_keys:
+            with self.metrics.timer(source_config['alias'], 'bajas', table_name):
+                self.soft_delete_records(target_conn, table_name, deleted_keys, source_config['alias'])
+    
+    def prepare_target_session(self, conn: mysql.connector.MySQLConnection):
+        """Deshabilita restricciones en la sesión de destino para inserción libre"""
+        conn.cmd_query("SET foreign_key_checks = 0")
+        conn.cmd_query("SET sql_mode = ''")  # Modo permisivo
+    
+    def iter_new_records(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                         snapshot_table, table_info: Dict, source_alias: str, watermark: Dict = None,
+                         hash_version: str = HASH_VERSION, checksums: Dict = None,
+                         meta: Dict = None) -> Iterator[List[Dict]]:
+        """Registros nuevos por bloques. Sin --memory-budget ni --pipeline-depth sale un único bloque; con
+        presupuesto los bloques no lo superan y una tabla cuyo snapshot no entra se compara con un merge
+        externo"""
+        clock = self.metrics.clock(source_alias, table_name)
+        if checksums and checksums['column'] in table_info['all_columns']:
+            # Solo se leen fila a fila los rangos de PK cuyo checksum cambió
+            filters = self._checksum_changed_filters(conn, table_name, table_info, source_alias, checksums)
+            if meta is not None and filters:
+                meta['checksums'] = self._refresh_leaf_checksums(conn, table_name, table_info, source_alias,
+                                                                 checksums, filters)
+            clock.lap('checksum')
+        else:
+            filters = [self._watermark_filter(watermark)]
+        
+        # Recorrido completo de una tabla grande: búsquedas binarias al azar sobre un snapshot que no
+        # entra en memoria leerían el disco por cada fila; el merge lo lee una sola vez en orden
+        merge = (self.memory_budget and filters == [('', None)] and table_info.get('primary_key')
+                 and isinstance(snapshot_table, DigestIndex)
+                 and len(snapshot_table) * snapshot_table.digest_size > self.memory_budget)
+        if merge:
+            self.logger.info(f"{source_alias}.{table_name}: el snapshot supera --memory-budget, "
+                             f"se compara con un merge externo")
+        
+        def chunks() -> Iterator[List[Dict]]:
+            for where, params in filters:
+                if hash_version == SERVER_HASH_VERSION:
+                    yield from self._find_new_records_server_hashed(conn, table_name, snapshot_table, table_info,
+                                                                    source_alias, where, params, clock, merge)
                 else:
-                    processed_row[column] = str(value) if not isinstance(value, (int, float, str, bool)) else value
+                    hasher = RowHasher(table_info['all_columns'], table_info['column_types'], source_alias,
+                                       hash_version)
+                    if merge:
+                        yield from self._find_new_records_merged(conn, table_name, snapshot_table, table_info,
+                                                                 source_alias, hasher, clock)
+                    else:
+                        yield from self._find_new_records_client_hashed(conn, table_name, snapshot_table,
+                                                                        table_info, source_alias, hasher,
+                                                                        where, params, clock)
+        
+        pending, pending_bytes = [], 0
+        for records in chunks():
+            pending.extend(records)
+            if self.memory_budget and records:
+                pending_bytes += len(records) * (sys.getsizeof(records[0]) +
+                                                 sum(sys.getsizeof(value) for value in records[0].values()))
+            # Con etapas en paralelo cada lote pasa al escritor apenas se completa
+            if ((self.memory_budget and pending_bytes >= self.memory_budget // 4)
+                    or (self.pipeline_depth and len(pending) >= self.batch_size)):
+                yield pending
+                pending, pending_bytes = [], 0
+                clock.last = time.perf_counter()  # La escritura del bloque se mide aparte
+        clock.stop()
+        if pending or not (self.memory_budget or self.pipeline_depth):
+            yield pending
+    
+    def _find_new_records_client_hashed(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                                        snapshot_table, table_info: Dict, source_alias: str, hasher: RowHasher,
+                                        where: str, params: Tuple, clock: PhaseClock) -> Iterator[List[Dict]]:
+        """Diff con hash en Python sobre las filas completas, por bloques"""
+        columns = table_info['all_columns']
+        chunks = self.scan_table(conn, table_name, table_info, source_alias, where=where, params=params)
+        if self.pipeline_depth:
+            yield from self._diff_chunks_pooled(chunks, snapshot_table, columns, hasher, clock)
+            return
+        for rows in chunks:
+            clock.lap('extraccion')
+            clock.rows_read += len(rows)
+            digests = list(hasher.hash_rows(rows))
+            clock.lap('hash')
+            new_records = []
+            for row, record_digest in zip(rows, digests):
+                # Búsqueda binaria sobre el snapshot mapeado en memoria
+                if record_digest not in snapshot_table:
+                    # Mantener valores originales para inserción
+                    original_row = {column: row.get(column) for column in columns}
+                    original_row['_record_hash'] = record_digest.hex()
+                    new_records.append(original_row)
+            clock.lap('diff')
+            yield new_records
+    
+    def _diff_chunks_pooled(self, chunks: Iterator[List[Dict]], snapshot_table, columns: List[str],
+                            hasher: RowHasher, clock: PhaseClock) -> Iterator[List[Dict]]:
+        """Hash y diff de varios bloques a la vez en un pool, mientras la lectura sigue en su hilo"""
+        def diff_chunk(rows: List[Dict]) -> List[Dict]:
+            new_records = []
+            for row, record_digest in zip(rows, hasher.hash_rows(rows)):
+                if record_digest not in snapshot_table:
+                    original_row = {column: row.get(column) for column in columns}
+                    original_row['_record_hash'] = record_digest.hex()
+                    new_records.append(original_row)
+            return new_records
+        
+        with ThreadPoolExecutor(max_workers=self.hash_workers) as executor:
+            depth = max(self.pipeline_depth, self.hash_workers)
+            for rows, new_records in ordered_map(executor, diff_chunk, chunks, depth):
+                clock.rows_read += len(rows)
+                # Las etapas se solapan: cuenta la espera por el siguiente bloque ya comparado
+                clock.lap('hash')
+                yield new_records
+    
+    def _find_new_records_merged(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                                 snapshot_table: DigestIndex, table_info: Dict, source_alias: str,
+                                 hasher: RowHasher, clock: PhaseClock) -> Iterator[List[Dict]]:
+        """Diff por merge externo: (digest, PK) de todas las filas en tramos ordenados en disco, merge
+        contra los digests ordenados del snapshot y lectura por PK de las filas nuevas"""
+        primary_key = table_info['primary_key']
+        with SortedSpool(self.memory_budget // 2) as spool:
+            for rows in self.scan_table(conn, table_name, table_info, source_alias):
+                clock.lap('extraccion')
+                clock.rows_read += len(rows)
+                digests = hasher.hash_rows(rows)
+                clock.lap('hash')
+                for row, record_digest in zip(rows, digests):
+                    spool.add(record_digest, record_key(row, primary_key))
+                clock.lap('diff')
+            yield from self._fetch_new_rows(conn, table_name, table_info,
+                                            merge_new_entries(spool, snapshot_table), clock)
+    
+    def _fetch_new_rows(self, conn: mysql.connector.MySQLConnection, table_name: str, table_info: Dict,
+                        entries: Iterable[Tuple[bytes, str]], clock: PhaseClock) -> Iterator[List[Dict]]:
+        """Filas completas de las entradas (digest, PK) nuevas, pedidas por lotes de chunk_size claves"""
+        primary_key = table_info['primary_key']
+        entries = iter(entries)
+        while True:
+            batch = {}
+            for record_digest, key in entries:
+                batch[key] = record_digest
+                if len(batch) >= self.chunk_size:
+                    break
+            clock.lap('diff')
+            if not batch:
+                return
+            keys = [tuple(json.loads(key, object_hook=decode_record_object)) for key in batch]
+            new_records = []
+            for row in self._iter_rows_by_key(conn, table_name, primary_key, keys):
+                record_digest = batch.get(record_key(row, primary_key))
+                if record_digest is None:
+                    continue
+                record = {column: row.get(column) for column in table_info['all_columns']}
+                record['_record_hash'] = record_digest.hex()
+                new_records.append(record)
+            clock.lap('extraccion')
+            yield new_records
+    
+    def _watermark_filter(self, watermark: Dict) -> Tuple[str, Tuple]:
+        """Cláusula WHERE para leer solo filas más allá del watermark"""
+        if not watermark:
+            return '', None
+        # Con timestamp se incluye el límite y el hash descarta repetidos
+        operator = '>' if watermark['kind'] == 'auto_increment' else '>='
+        return f" WHERE `{watermark['column']}` {operator} %s", (watermark['value'],)
+    
+    def _find_new_records_server_hashed(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                                        snapshot_table, table_info: Dict, source_alias: str,
+                                        where: str, params: Tuple, clock: PhaseClock = None,
+                                        merge: bool = False) -> Iterator[List[Dict]]:
+        """Diff con hash en el servidor: solo viajan (PK, digest) y luego las filas nuevas por lotes"""
+        digest_sql = self.build_row_digest_sql(table_info, source_alias)
+        primary_key = table_info.get('primary_key') or []
+        clock = clock or self.metrics.clock(source_alias, table_name)
+        
+        # El servidor calcula los digests mientras se leen: el recorrido completo cuenta como extracción
+        if not primary_key:
+            # Sin PK no hay forma de pedir filas sueltas: viajan completas junto a su digest
+            for rows in self.scan_table(conn, table_name, table_info, source_alias,
+                                        f"*, {digest_sql} AS `_row_digest`", where, params):
+                clock.rows_read += len(rows)
+                new_records = []
+                for row in rows:
+                    record_digest = bytes(row.pop('_row_digest'))
+                    if record_digest not in snapshot_table:
+                        record = {column: row.get(column) for column in table_info['all_columns']}
+                        record['_record_hash'] = record_digest.hex()
+                        new_records.append(record)
+                clock.lap('extraccion')
+                yield new_records
+            return
+        
+        # Claves nuevas (o todas, si se compara por merge) en tramos acotados por --memory-budget
+        key_columns = ', '.join(f"`{column}`" for column in primary_key)
+        with SortedSpool(self.memory_budget // 2) as spool:
+            rows = (row for rows in self.scan_table(conn, table_name, table_info, source_alias,
+                                                    f"{key_columns}, {digest_sql}", where, params, dictionary=False)
+                    for row in rows)
+            for row in rows:
+                clock.rows_read += 1
+                record_digest = bytes(row[-1])
+                if merge or record_digest not in snapshot_table:
+                    spool.add(record_digest, record_key(dict(zip(primary_key, row[:-1])), primary_key))
+            clock.lap('extraccion')
+            
+            # Traer las filas completas solo de las claves nuevas
+            entries = merge_new_entries(spool, snapshot_table) if merge else spool
+            yield from self._fetch_new_rows(conn, table_name, table_info, entries, clock)
+    
+    def _iter_rows_by_key(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                          primary_key: List[str], keys: List[Tuple]) -> Iterator[Dict]:
+        """Filas completas de una lista de valores de PK, pedidas por lotes"""
+        key_columns = ', '.join(f"`{column}`" for column in primary_key)
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            if len(primary_key) == 1:
+                condition = f"{key_columns} IN ({', '.join(['%s'] * len(batch))})"
+                batch_params = tuple(key[0] for key in batch)
+            else:
+                row_placeholder = '(' + ', '.join(['%s'] * len(primary_key)) + ')'
+                condition = f"({key_columns}) IN ({', '.join([row_placeholder] * len(batch))})"
+                batch_params = tuple(value for key in batch for value in key)
             
-            record_hash = self.generate_record_hash(processed_row, source_alias)
+            yield from self.iter_rows(conn, f"SELECT * FROM `{table_name}` WHERE {condition}", batch_params)
+    
+    def find_changed_records(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                             snapshot_table: KeyedDigestIndex, table_info: Dict, source_alias: str,
+                             hash_version: str = HASH_VERSION) -> Tuple[List[Dict], List[Dict], List[bytes]]:
+        """Clasifica por hash de PK las filas en altas y modificaciones, y devuelve las claves dadas de baja"""
+        primary_key = table_info['primary_key']
+        columns = table_info['all_columns']
+        key_hasher = KeyHasher(primary_key, table_info['column_types'], source_alias)
+        clock = self.metrics.clock(source_alias, table_name)
+        seen = bytearray(len(snapshot_table))  # 1 = la clave del snapshot sigue existiendo
+        inserted, updated = [], []
+        
+        def classify(key: bytes, record_digest: bytes) -> int:
+            """-1 si es alta, posición en el snapshot si cambió, None si no cambió"""
+            position = snapshot_table.find(key)
+            if position < 0:
+                return -1
+            seen[position] = 1
+            return None if snapshot_table.digest(position) == record_digest else position
+        
+        if hash_version == SERVER_HASH_VERSION:
+            # Solo viajan (PK, digest); las filas completas se piden por lotes para las claves cambiadas
+            digest_sql = self.build_row_digest_sql(table_info, source_alias)
+            key_columns = ', '.join(f"`{column}`" for column in primary_key)
+            changed = {}
+            rows = (row for rows in self.scan_table(conn, table_name, table_info, source_alias,
+                                                    f"{key_columns}, {digest_sql}", dictionary=False)
+                    for row in rows)
+            for row in rows:
+                clock.rows_read += 1
+                key = key_hasher.hash_row(dict(zip(primary_key, row[:-1])))
+                record_digest = bytes(row[-1])
+                position = classify(key, record_digest)
+                if position is not None:
+                    changed[tuple(row[:-1])] = (key, record_digest, position >= 0)
             
-            if record_hash not in snapshot_hashes:
-                # Mantener valores originales para inserción
-                original_row = {}
-                for column in table_info['all_columns']:
-                    original_row[column] = row.get(column)
-                
-                original_row['_record_hash'] = record_hash
-                new_records.append(original_row)
+            for row in self._iter_rows_by_key(conn, table_name, primary_key, list(changed)):
+                key, record_digest, is_update = changed[tuple(row.get(column) for column in primary_key)]
+                record = {column: row.get(column) for column in columns}
+                record['_record_hash'] = record_digest.hex()
+                record['_source_key'] = key.hex()
+                (updated if is_update else inserted).append(record)
+            clock.lap('extraccion')
+        else:
+            hasher = RowHasher(columns, table_info['column_types'], source_alias, hash_version)
+            for rows in self.scan_table(conn, table_name, table_info, source_alias):
+                clock.lap('extraccion')
+                clock.rows_read += len(rows)
+                hashed = list(zip(rows, key_hasher.hash_rows(rows), hasher.hash_rows(rows)))
+                clock.lap('hash')
+                for row, key, record_digest in hashed:
+                    position = classify(key, record_digest)
+                    if position is None:
+                        continue
+                    record = {column: row.get(column) for column in columns}
+                    record['_record_hash'] = record_digest.hex()
+                    record['_source_key'] = key.hex()
+                    (updated if position >= 0 else inserted).append(record)
+                clock.lap('diff')
         
+        # Las claves del snapshot que no aparecieron en la lectura se eliminaron en la fuente
+        deleted_keys = []
+        position = seen.find(0)
+        while position >= 0:
+            deleted_keys.append(snapshot_table.key(position))
+            position = seen.find(0, position + 1)
+        clock.lap('diff')
+        clock.stop()
+        
+        return inserted, updated, deleted_keys
+    
+    def soft_delete_records(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                            keys: List[bytes], source_alias: str) -> int:
+        """Marca con _deleted_at los registros consolidados cuyas claves desaparecieron de la fuente"""
+        deleted_at = datetime.now().replace(microsecond=0)
+        marked = 0
+        cursor = conn.cursor()
+        for start in range(0, len(keys), self.batch_size):
+            batch = [key.hex() for key in keys[start:start + self.batch_size]]
+            cursor.execute(
+                f"UPDATE `{table_name}` SET `_deleted_at` = %s "
+                f"WHERE `_source_alias` = %s AND `_deleted_at` IS NULL "
+                f"AND `_source_key` IN ({', '.join(['%s'] * len(batch))})",
+                (deleted_at, source_alias) + tuple(batch)
+            )
+            marked += cursor.rowcount
+            conn.commit()
         cursor.close()
-        return new_records
+        self.logger.info(f"Marcados {marked} registros eliminados en {table_name}")
+        return marked
     
     def insert_consolidated_records(self, conn: mysql.connector.MySQLConnection, 
-                                   table_name: str, records: List[Dict], source_config: Dict):
-        """Inserta registros en la tabla consolidada"""
+                                   table_name: str, records: List[Dict], source_config: Dict) -> int:
+        """Inserta registros en la tabla consolidada por lotes multi-fila"""
         if not records:
-            return
+            return 0
         
         successful_inserts = 0
+        sync_timestamp = datetime.now().replace(microsecond=0)  # DATETIME sin fracción, igual al almacenado
         
-        for record in records:
-            try:
-                # Preparar datos de inserción
-                insert_data = record.copy()
-                insert_data['_source_database'] = source_config['database']
-                insert_data['_source_alias'] = source_config['alias']
-                insert_data['_sync_timestamp'] = datetime.now()
-                
-                # Crear query de inserción
-                columns = list(insert_data.keys())
-                placeholders = ','.join(['%s' for _ in columns])
-                values = [insert_data[col] for col in columns]
-                
-                query = f"INSERT INTO `{table_name}` (`{'`, `'.join(columns)}`) VALUES ({placeholders})"
-                
-                cursor = conn.cursor()
-                cursor.execute(query, values)
-                conn.commit()
-                cursor.close()
-                
-                successful_inserts += 1
-                
-            except Exception as e:
-                self.logger.warning(f"Error insertando registro en {table_name}: {e}")
-                conn.rollback()
-                
-                # Agregar a log de fallos
-                failed_insert = {
-                    'table': table_name,
-                    'record': record,
-                    'source_config': source_config,
-                    'timestamp': datetime.now().isoformat(),
-                    'error': str(e)
-                }
-                self.failed_inserts_log.append(failed_insert)
+        # LOAD DATA no puede actualizar filas existentes: el modo changeset usa siempre upserts por lotes
+        if (self.bulk_load_threshold > 0 and len(records) >= self.bulk_load_threshold
+                and self.write_mode != 'changeset'):
+            loaded = self._bulk_load_records(conn, table_name, records, source_config, sync_timestamp)
+            if loaded is not None:
+                self.journal_step(source_config['alias'], table_name, 'lote', filas=loaded)
+                self.logger.info(f"Cargados {loaded} registros consolidados en {table_name} con LOAD DATA")
+                return loaded
+        
+        # Un lote solo agrupa registros con las mismas columnas
+        for _, group in groupby(records, key=lambda record: tuple(record.keys())):
+            group = list(group)
+            for start in range(0, len(group), self.batch_size):
+                batch = group[start:start + self.batch_size]
+                written = self._insert_batch(conn, table_name, batch, source_config, sync_timestamp)
+                self.journal_step(source_config['alias'], table_name, 'lote', filas=written)
+                successful_inserts += written
         
         if successful_inserts > 0:
             self.logger.info(f"Insertados {successful_inserts} registros consolidados en {table_name}")
+        return successful_inserts
     
-    def process_failed_inserts(self, conn: mysql.connector.MySQLConnection):
-        """Procesa inserts fallidos del log"""
-        if not self.failed_inserts_log:
-            return
-        
-        successful_retries = []
+    def _insert_batch(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                      records: List[Dict], source_config: Dict, sync_timestamp: datetime, on_error=None) -> int:
+        """Inserta un lote en una sola transacción; si falla, lo bisecta para aislar los registros defectuosos"""
+        try:
+            columns = list(records[0].keys()) + ['_source_database', '_source_alias', '_sync_timestamp']
+            placeholders = ','.join(['%s' for _ in columns])
+            values = [
+                [record[col] for col in records[0].keys()] +
+                [source_config['database'], source_config['alias'], sync_timestamp]
+                for record in records
+            ]
+            
+            query = f"INSERT INTO `{table_name}` (`{'`, `'.join(columns)}`) VALUES ({placeholders})"
+            if self.write_mode == 'idempotent':
+                # Un registro ya consolidado choca con la clave única y se deja como está
+                query += " ON DUPLICATE KEY UPDATE `_record_hash` = `_record_hash`"
+            elif self.write_mode == 'changeset':
+                # Misma clave de origen: se actualiza la fila consolidada y se revierte un borrado lógico
+                assignments = [f"`{column}` = VALUES(`{column}`)" for column in columns
+                               if column not in ('_source_alias', '_source_key')]
+                query += f" ON DUPLICATE KEY UPDATE {', '.join(assignments)}, `_deleted_at` = NULL"
+            
+            # executemany genera un único INSERT ... VALUES (...),(...)
+            start = time.perf_counter()
+            cursor = conn.cursor()
+            cursor.executemany(query, values)
+            conn.commit()
+            cursor.close()
+            self.metrics.observe_batch(source_config['alias'], table_name, time.perf_counter() - start)
+            return len(records)
+            
+        except Exception as e:
+            conn.rollback()
+            
+            if len(records) > 1:
+                middle = len(records) // 2
+                return (self._insert_batch(conn, table_name, records[:middle], source_config, sync_timestamp, on_error) +
+                        self._insert_batch(conn, table_name, records[middle:], source_config, sync_timestamp, on_error))
+            
+            self.logger.warning(f"Error insertando registro en {table_name}: {e}")
+            
+            # Agregar a log de fallos (o dejar que el llamador lo registre)
+            if on_error is not None:
+                on_error(records[0], str(e))
+            else:
+                self.add_failed_insert(table_name, records[0], source_config, str(e))
+            return 0
+    
+    def _bulk_load_records(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                           records: List[Dict], source_config: Dict, sync_timestamp: datetime):
+        """Carga masiva con LOAD DATA LOCAL INFILE; devuelve None si hay que usar el camino por lotes"""
+        columns = list(records[0].keys())
+        if any(tuple(record.keys()) != tuple(columns) for record in records):
+            return None
         
-        for failed_insert in self.failed_inserts_log:
-            table_name = failed_insert['table']
-            record = failed_insert['record']
-            source_config = failed_insert['source_config']
+        tsv = tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='\n', suffix='.tsv', delete=False)
+        try:
+            try:
+                with tsv:
+                    for record in records:
+                        tsv.write('\t'.join(self._tsv_value(record[col]) for col in columns))
+                        tsv.write('\n')
+            except TypeError as e:
+                self.logger.info(f"LOAD DATA no disponible para {table_name} ({e}), usando inserts por lotes")
+                return None
+            
+            query = (
+                f"LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE `{table_name}` CHARACTER SET utf8mb4 "
+                f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+                f"(`{'`, `'.join(columns)}`) "
+                f"SET `_source_database` = %s, `_source_alias` = %s, `_sync_timestamp` = %s"
+            )
             
+            cursor = conn.cursor()
             try:
-                insert_data = record.copy()
-                insert_data['_source_database'] = source_config['database']
-                insert_data['_source_alias'] = source_config['alias']
-                insert_data['_sync_timestamp'] = datetime.now()
-                
-                columns = list(insert_data.keys())
-                placeholders = ','.join(['%s' for _ in columns])
-                values = [insert_data[col] for col in columns]
-                
-                query = f"INSERT INTO `{table_name}` (`{'`, `'.join(columns)}`) VALUES ({placeholders})"
-                
-                cursor = conn.cursor()
-                cursor.execute(query, values)
+                # Marca de la carga: cada fuente tiene un solo escritor por tabla, así que sus filas con
+                # id mayor al último actual son las de esta carga
+                cursor.execute(f"SELECT COALESCE(MAX(`_consolidation_id`), 0) FROM `{table_name}`")
+                last_id = cursor.fetchone()[0]
+                start = time.perf_counter()
+                cursor.execute(query, (tsv.name, source_config['database'], source_config['alias'], sync_timestamp))
+                loaded = cursor.rowcount
                 conn.commit()
+                self.metrics.observe_batch(source_config['alias'], table_name, time.perf_counter() - start)
+            except Error as e:
+                conn.rollback()
+                self.logger.warning(f"LOAD DATA falló en {table_name}: {e}. Usando inserts por lotes")
+                return None
+            finally:
                 cursor.close()
+        finally:
+            os.remove(tsv.name)
+        
+        if loaded < len(records):
+            self._route_rejected_rows(conn, table_name, records, source_config, last_id)
+        return loaded
+    
+    def _route_rejected_rows(self, conn: mysql.connector.MySQLConnection, table_name: str,
+                             records: List[Dict], source_config: Dict, last_id: int):
+        """Envía al log de fallos los registros que el servidor descartó durante LOAD DATA
+        (last_id: último _consolidation_id de la tabla antes de la carga)"""
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT `_record_hash` FROM `{table_name}` WHERE `_consolidation_id` > %s AND `_source_alias` = %s",
+            (last_id, source_config['alias'])
+        )
+        # Multiconjunto: dos filas idénticas de la fuente tienen el mismo hash y cada una cuenta
+        loaded_hashes = Counter(row[0] for row in cursor.fetchall())
+        missing = []
+        for record in records:
+            if loaded_hashes[record['_record_hash']]:
+                loaded_hashes[record['_record_hash']] -= 1
+            else:
+                missing.append(record)
+        
+        existing = set()
+        if self.write_mode == 'idempotent':
+            # Los que ya estaban consolidados los descartó la clave única, no son fallos
+            missing_hashes = list(dict.fromkeys(record['_record_hash'] for record in missing))
+            for start in range(0, len(missing_hashes), self.batch_size):
+                batch_hashes = missing_hashes[start:start + self.batch_size]
+                cursor.execute(
+                    f"SELECT `_record_hash` FROM `{table_name}` WHERE `_source_alias` = %s "
+                    f"AND `_record_hash` IN ({', '.join(['%s'] * len(batch_hashes))})",
+                    (source_config['alias'],) + tuple(batch_hashes)
+                )
+                existing.update(row[0] for row in cursor.fetchall())
+        cursor.close()
+        
+        for record in missing:
+            if record['_record_hash'] not in existing:
+                self.logger.warning(f"Registro descartado por LOAD DATA en {table_name}")
+                self.add_failed_insert(table_name, record, source_config, 'Registro descartado por LOAD DATA')
+    
+    def _tsv_value(self, value: Any) -> str:
+        """Formatea un valor para el archivo TSV de LOAD DATA"""
+        if value is None:
+            return '\\N'
+        if isinstance(value, (bytes, bytearray)):
+            raise TypeError("columna binaria")
+        if isinstance(value, bool):
+            value = int(value)
+        elif isinstance(value, timedelta):
+            # Las columnas TIME llegan como timedelta
+            total_seconds = int(value.total_seconds())
+            sign = '-' if total_seconds < 0 else ''
+            hours, remainder = divmod(abs(total_seconds), 3600)
+            minutes, seconds = divmod(remainder, 60)
+            value = f"{sign}{hours:02d}:{minutes:02d}:{seconds:02d}"
+        
+        text = str(value)
+        return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    
+    def add_failed_insert(self, table_name: str, record: Dict, source_config: Dict, error: str):
+        """Agrega un registro al log de fallos (seguro entre workers)"""
+        self.dead_letters.add(table_name, record, source_config, error)
+    
+    def process_failed_inserts(self, conn: mysql.connector.MySQLConnection):
+        """Reintenta por lotes los inserts fallidos vencidos, agrupados por tabla y fuente"""
+        retried = 0
+        recovered = 0
+        exhausted = 0
+        for table_name, source_alias, source_database in self.dead_letters.due_groups():
+            # Solo alias y base de datos: las credenciales no se guardan en el log
+            source_config = {'alias': source_alias, 'database': source_database}
+            for entries in self.dead_letters.iter_due(table_name, source_alias, self.batch_size):
+                entry_ids = {id(record): entry_id for entry_id, record in entries}
+                failures = []
+                sync_timestamp = datetime.now().replace(microsecond=0)
                 
-                successful_retries.append(failed_insert)
-                self.logger.info(f"Retry exitoso para {table_name} desde {source_config['alias']}")
+                def on_error(record: Dict, error: str):
+                    failures.append((entry_ids[id(record)], error))
                 
-            except Exception as e:
-                self.logger.warning(f"Retry fallido para {table_name}: {e}")
-                conn.rollback()
+                records = [record for _, record in entries]
+                for _, group in groupby(records, key=lambda record: tuple(record.keys())):
+                    self._insert_batch(conn, table_name, list(group), source_config, sync_timestamp, on_error)
+                
+                failed_ids = {entry_id for entry_id, _ in failures}
+                self.dead_letters.resolve([entry_id for entry_id, _ in entries if entry_id not in failed_ids])
+                exhausted += self.dead_letters.reschedule(failures)
+                retried += len(entries)
+                recovered += len(entries) - len(failures)
+        
+        self.logger.info(f"Reintentos: {recovered} de {retried} inserts fallidos recuperados")
+        if exhausted:
+            self.logger.warning(f"{exhausted} inserts fallidos agotaron sus {self.dead_letters.max_attempts} "
+                                f"reintentos: quedan en failed_inserts_exhausted para revisarlos a mano")
+        self.dead_letters.compact()
+
+
+class ConsolidationService:
+    """Servicio residente: cola de aperturas/cierres con conexiones y esquemas en caliente"""
+    
+    MAX_FINISHED_JOBS = 200  # Trabajos terminados que se conservan para consulta
+    
+    def __init__(self, options: Dict, connections: ConnectionManager):
+        self.options = options  # Argumentos de MySQLDBConsolidator comunes a todos los trabajos
+        self.connections = connections  # Pool compartido: las conexiones sobreviven entre trabajos
+        self.schema_cache = None  # Caché de esquemas en memoria tras el primer trabajo
+        self.jobs = {}  # id -> trabajo, en orden de llegada
+        self.pending = queue.Queue()
+        self.condition = threading.Condition()
+        self.logger = logging.getLogger(__name__)
+        # Los trabajos se ejecutan de a uno: todos comparten el snapshot y el log de fallos
+        self.worker = threading.Thread(target=self._run_jobs, name='consolidation-jobs', daemon=True)
+    
+    def start(self):
+        self.worker.start()
+    
+    def submit(self, payload: Dict) -> Dict:
+        """Encola un trabajo y devuelve su estado inicial sin esperar a que corra"""
+        modo = payload.get('modo')
+        if modo not in ('apertura', 'cierre', 'cdc'):
+            raise ValueError('El campo "modo" es requerido. Use "apertura", "cierre" o "cdc"')
+        if not payload.get('target') or not payload.get('sources'):
+            raise ValueError('Se requieren los campos "target" y "sources"')
+        target_config = config_from_payload(payload['target'], 'target')
+        source_databases = [config_from_payload(source) for source in payload['sources']]
         
-        # Remover retries exitosos del log
-        for retry in successful_retries:
-            self.failed_inserts_log.remove(retry)
+        job = {
+            'id': uuid.uuid4().hex,
+            'modo': modo,
+            'fuentes': [source['alias'] for source in source_databases],
+            'estado': 'en_cola',
+            'creado': datetime.now().isoformat(),
+            'inicio': None,
+            'fin': None,
+            'resumen': None,
+            'error': None,
+            'eventos': []
+        }
+        with self.condition:
+            self.jobs[job['id']] = job
+            self._trim_jobs()
+        self.pending.put((job, target_config, source_databases))
+        self.logger.info(f"Trabajo {job['id']} en cola: {modo} de {', '.join(job['fuentes'])}")
+        return self.describe(job)
+    
+    def _trim_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job['fin']]
+        for job_id in finished[:max(len(finished) - self.MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
+    
+    def describe(self, job: Dict, since: int = None) -> Dict:
+        """Estado público de un trabajo; con since incluye los eventos a partir de esa posición"""
+        result = {key: value for key, value in job.items() if key != 'eventos'}
+        result['total_eventos'] = len(job['eventos'])
+        if since is not None:
+            result['eventos'] = job['eventos'][since:]
+        return result
+    
+    def get(self, job_id: str, since: int = None, wait: float = 0) -> Dict:
+        """Estado de un trabajo; con wait espera hasta ese tiempo a que haya eventos nuevos (long polling)"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if wait > 0 and since is not None:
+                self.condition.wait_for(lambda: len(job['eventos']) > since or job['fin'], timeout=wait)
+            return json.loads(json.dumps(self.describe(job, since), default=str))
     
-    def load_failed_inserts(self):
-        """Carga inserts fallidos del archivo de log"""
-        if Path(self.log_file).exists():
+    def list_jobs(self) -> List[Dict]:
+        with self.condition:
+            return json.loads(json.dumps([self.describe(job) for job in self.jobs.values()], default=str))
+    
+    def wait_events(self, job_id: str, since: int, timeout: float) -> Tuple[List[Dict], bool]:
+        """Eventos posteriores a since (esperando hasta timeout) y si el trabajo ya terminó"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return [], True
+            self.condition.wait_for(lambda: len(job['eventos']) > since or job['fin'], timeout=timeout)
+            events = json.loads(json.dumps(job['eventos'][since:], default=str))
+            return events, bool(job['fin']) and since + len(events) >= len(job['eventos'])
+    
+    def _record_event(self, job: Dict, event: Dict):
+        with self.condition:
+            job['eventos'].append(event)
+            self.condition.notify_all()
+    
+    def _run_jobs(self):
+        while True:
+            job, target_config, source_databases = self.pending.get()
+            with self.condition:
+                job['estado'] = 'ejecutando'
+                job['inicio'] = datetime.now().isoformat()
+                self.condition.notify_all()
+            
+            consolidator = None
             try:
-                with open(self.log_file, 'r', encoding='utf-8') as f:
-                    self.failed_inserts_log = json.load(f)
-                self.logger.info(f"Cargados {len(self.failed_inserts_log)} inserts fallidos")
+                consolidator = MySQLDBConsolidator(source_databases, target_config,
+                                                   connections=self.connections, **self.options)
+                if self.schema_cache is not None:
+                    consolidator.schema_cache = self.schema_cache
+                consolidator.progress = lambda event: self._record_event(job, event)
+                if job['modo'] == 'apertura':
+                    summary = consolidator.take_snapshot()
+                elif job['modo'] == 'cdc':
+                    summary = consolidator.capture_changes()
+                else:
+                    summary = consolidator.consolidate_changes()
+                state, error = 'completado', None
             except Exception as e:
-                self.logger.error(f"Error cargando log de fallos: {e}")
-                self.failed_inserts_log = []
+                self.logger.error(f"Trabajo {job['id']} falló: {e}")
+                summary, state, error = None, 'error', str(e)
+            finally:
+                if consolidator is not None:
+                    self.schema_cache = consolidator.schema_cache
+                    consolidator.dead_letters.close()
+            
+            with self.condition:
+                job.update(estado=state, resumen=summary, error=error, fin=datetime.now().isoformat())
+                job['eventos'].append({'evento': 'fin', 'estado': state, 'error': error,
+                                       'timestamp': job['fin']})
+                self.condition.notify_all()
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """API HTTP del servicio: POST /jobs, GET /jobs, GET /jobs/<id>[?desde=N&espera=S],
+    GET /jobs/<id>/events (Server-Sent Events) y GET /health"""
+    
+    protocol_version = 'HTTP/1.1'
+    
+    @property
+    def service(self) -> ConsolidationService:
+        return self.server.service
+    
+    def send_json(self, status: int, body):
+        data = json.dumps(body, default=str, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') != '/jobs':
+            self.send_json(404, {'status': 'error', 'message': 'Ruta no encontrada'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            job = self.service.submit(payload)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'status': 'error', 'message': str(e)})
+            return
+        self.send_json(202, dict(job, status='ok', job_id=job['id']))
+    
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = parse_qs(url.query)
+        try:
+            since = int(query['desde'][0]) if 'desde' in query else None
+            wait = min(float(query.get('espera', ['0'])[0]), 30.0)
+        except ValueError:
+            self.send_json(400, {'status': 'error', 'message': 'Parámetros desde/espera inválidos'})
+            return
+        
+        if parts == ['health']:
+            self.send_json(200, {'status': 'ok', 'trabajos_en_cola': self.service.pending.qsize()})
+        elif parts == ['jobs']:
+            self.send_json(200, {'status': 'ok', 'trabajos': self.service.list_jobs()})
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = self.service.get(parts[1], since, wait)
+            if job is None:
+                self.send_json(404, {'status': 'error', 'message': 'Trabajo no encontrado'})
+            else:
+                self.send_json(200, dict(job, status='ok'))
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+            self.stream_events(parts[1], since or 0)
         else:
-            self.failed_inserts_log = []
+            self.send_json(404, {'status': 'error', 'message': 'Ruta no encontrada'})
     
-    def save_failed_inserts(self):
-        """Guarda inserts fallidos al archivo de log"""
+    def stream_events(self, job_id: str, since: int):
+        """Envía los eventos del trabajo como Server-Sent Events hasta que termine"""
+        if self.service.get(job_id) is None:
+            self.send_json(404, {'status': 'error', 'message': 'Trabajo no encontrado'})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
         try:
-            with open(self.log_file, 'w', encoding='utf-8') as f:
-                json.dump(self.failed_inserts_log, f, indent=2, default=str)
-            self.logger.info(f"Guardados {len(self.failed_inserts_log)} inserts fallidos")
-        except Exception as e:
-            self.logger.error(f"Error guardando log de fallos: {e}")
+            finished = False
+            while not finished:
+                events, finished = self.service.wait_events(job_id, since, timeout=15.0)
+                for event in events:
+                    self.wfile.write(f"id: {since}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+                    since += 1
+                if not events:
+                    self.wfile.write(b": sin cambios\n\n")  # Mantiene viva la conexión
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+    
+    def log_message(self, format: str, *args):
+        logging.getLogger(__name__).debug(f"HTTP {format % args}")
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """Servidor HTTP sobre un socket Unix (solo accesible localmente)"""
+    daemon_threads = True
+
+
+def serve(service: ConsolidationService, listen: str):
+    """Atiende la API del servicio en host:puerto o en unix:/ruta/al/socket"""
+    if listen.startswith('unix:'):
+        socket_path = listen[len('unix:'):]
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, ServiceRequestHandler)
+    else:
+        host, _, port = listen.rpartition(':')
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), ServiceRequestHandler)
+        server.daemon_threads = True
+    server.service = service
+    service.start()
+    service.logger.info(f"Servicio de consolidación escuchando en {listen}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        service.logger.info("Servicio detenido")
+    finally:
+        server.server_close()
+        service.connections.close_all()
+
 
 def parse_mysql_config(config_string: str, alias: str = None) -> Dict:
     """Parsea string de configuración MySQL formato: host:user:password:database[:port]"""
@@ -502,48 +3987,191 @@ def parse_mysql_config(config_string: str, alias: str = None) -> Dict:
     
     return config
 
+def parse_rate_limits(specs: List[str]) -> Dict[str, float]:
+    """Techos 'N' (todas las fuentes) o 'alias=N' por fuente"""
+    limits = {}
+    for spec in specs:
+        alias, _, value = spec.rpartition('=')
+        limits[alias or '*'] = float(value)
+    return limits
+
+
+def parse_source_spec(source_spec: str) -> Dict:
+    """Fuente en formato alias=host:user:password:database[:port] (el alias es opcional)"""
+    if '=' in source_spec:
+        alias, config_string = source_spec.split('=', 1)
+        return parse_mysql_config(config_string, alias)
+    return parse_mysql_config(source_spec)
+
+def config_from_payload(value, alias: str = None) -> Dict:
+    """Configuración de conexión recibida por la API: cadena como en la CLI u objeto con host, user, ..."""
+    if isinstance(value, str):
+        return parse_source_spec(value) if alias is None else parse_mysql_config(value, alias)
+    missing = [key for key in ('host', 'user', 'password', 'database') if key not in value]
+    if missing:
+        raise ValueError(f"Faltan campos de conexión: {', '.join(missing)}")
+    config = {key: value[key] for key in ('host', 'user', 'password', 'database')}
+    config['alias'] = alias or value.get('alias') or f"{value['host']}_{value['database']}"
+    if value.get('port'):
+        config['port'] = int(value['port'])
+    return config
+
 def main():
     parser = argparse.ArgumentParser(description='Consolidador de múltiples bases de datos MySQL')
-    parser.add_argument('target', help='Base de datos de destino: host:user:password:database[:port]')
-    parser.add_argument('--sources', nargs='+', required=True,
+    parser.add_argument('target', nargs='?', help='Base de datos de destino: host:user:password:database[:port]')
+    parser.add_argument('--sources', nargs='+',
                        help='Bases de datos fuente: alias1=host:user:password:database[:port]')
-    parser.add_argument('--modo', choices=['apertura', 'cierre'], required=True,
-                       help='Modo de operación: apertura (snapshot) o cierre (consolidation)')
-    parser.add_argument('--log-file', default='consolidation_failures.json',
-                       help='Archivo de log para inserts fallidos')
+    parser.add_argument('--modo', choices=['apertura', 'cierre', 'cdc', 'servicio'], required=True,
+                       help='Modo de operación: apertura (snapshot), cierre (consolidation), cdc (cambios leídos '
+                            'del binlog desde el último checkpoint) o servicio (API residente con cola de trabajos)')
+    parser.add_argument('--listen', default='127.0.0.1:8765',
+                       help='Modo servicio: host:puerto o unix:/ruta/al/socket donde atender la API')
+    parser.add_argument('--json', action='store_true',
+                       help='Imprimir el resultado como JSON en la salida estándar (el log va a stderr)')
+    parser.add_argument('--log-file', default='consolidation_failures.db',
+                       help='Archivo SQLite de inserts fallidos (un .json anterior con el mismo nombre se migra)')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                       help='Filas leídas por bloque desde las fuentes (memoria acotada)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                       help='Registros por INSERT multi-fila en la base de destino')
+    parser.add_argument('--bulk-load-threshold', type=int, default=0,
+                       help='Usar LOAD DATA LOCAL INFILE cuando una tabla tenga al menos N registros nuevos (0 = desactivado)')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Fuentes procesadas en paralelo, cada una con sus propias conexiones')
+    parser.add_argument('--incremental', action='store_true',
+                       help='Cierre incremental: solo lee filas por encima del watermark guardado en apertura')
+    parser.add_argument('--watermark-column', action='append', default=[], metavar='TABLA=COLUMNA',
+                       help='Columna de timestamp monótona para una tabla (por defecto se usa la PK AUTO_INCREMENT)')
+    parser.add_argument('--server-hash', action='store_true',
+                       help='Apertura: calcular los digests en la fuente (el cierre usa el método del snapshot)')
+    parser.add_argument('--hash-algorithm', choices=HASH_VERSIONS, default=HASH_VERSION,
+                       help='Apertura: algoritmo de hash en Python (xxh3-v2 requiere xxhash también en el cierre)')
+    parser.add_argument('--diff-engine', choices=['hash', 'checksum'], default='hash',
+                       help='checksum: comparar checksums por rangos de PK y leer fila a fila solo los rangos cambiados')
+    parser.add_argument('--checksum-chunk', type=int, default=1000,
+                       help='Valores de PK por rango hoja del motor de checksum')
+    parser.add_argument('--pool-size', type=int, default=0,
+                       help='Conexiones por endpoint en el pool (0 = workers + 1)')
+    parser.add_argument('--write-mode', choices=['append', 'idempotent', 'changeset'], default='append',
+                       help='idempotent: clave única (alias, hash) y snapshot avanzado tras el cierre; '
+                            'changeset: altas, modificaciones y bajas por PK como upserts y borrado lógico')
+    parser.add_argument('--metrics-prefix', default='consolidation_metrics',
+                       help='Prefijo de los archivos de métricas <prefijo>_<modo>_<alias>.json y .prom (vacío = no escribir)')
+    parser.add_argument('--status-file', default=str(Path(__file__).resolve().parent / 'assets' / 'alias.json'),
+                       help='alias.json cuyo consolidation_status se actualiza al terminar cada corrida')
+    parser.add_argument('--memory-budget', type=int, default=0, metavar='MB',
+                       help='Memoria por tabla en el diff del cierre: los registros nuevos se escriben en bloques '
+                            'y las tablas cuyo snapshot no entra se comparan con un merge externo en disco (0 = sin límite)')
+    parser.add_argument('--resume', action='store_true',
+                       help='Cierre: retomar un cierre interrumpido desde la bitácora, sin repetir lo ya escrito')
+    parser.add_argument('--binlog-checkpoint', default='consolidation_binlog.json',
+                       help='Modo cdc: archivo con la posición del binlog consolidada por fuente')
+    parser.add_argument('--cdc-server-id', type=int, default=4000,
+                       help='Modo cdc: server_id de réplica de la primera fuente (las siguientes usan los consecutivos)')
+    parser.add_argument('--pipeline-depth', type=int, default=0, metavar='N',
+                       help='Lectura, hash y escritura de cada tabla en hilos con N bloques en cola entre etapas (0 = secuencial)')
+    parser.add_argument('--hash-workers', type=int, default=2,
+                       help='Cierre con --pipeline-depth: hilos que calculan hash y diff de los bloques')
+    parser.add_argument('--throttle', action='store_true',
+                       help='Leer las fuentes por rangos de PK adaptando bloque y pausa a la latencia y a Threads_running')
+    parser.add_argument('--throttle-latency', type=float, default=0.25, metavar='SEGUNDOS',
+                       help='Latencia por bloque a partir de la cual se reduce el ritmo de lectura')
+    parser.add_argument('--throttle-threads-running', type=int, default=0, metavar='N',
+                       help='Reducir el ritmo cuando Threads_running de la fuente supere N (0 = no consultar)')
+    parser.add_argument('--max-rows-per-second', action='append', default=[], metavar='[ALIAS=]N',
+                       help='Techo de filas/s leídas por fuente (activa el throttle; repetible por alias)')
+    parser.add_argument('--max-bytes-per-second', action='append', default=[], metavar='[ALIAS=]N',
+                       help='Techo de bytes/s leídos por fuente (activa el throttle; repetible por alias)')
     
     args = parser.parse_args()
+    if args.modo != 'servicio' and (not args.target or not args.sources):
+        parser.error('apertura, cierre y cdc requieren el destino y --sources')
 
     try:
-        # Parsear configuración de destino
-        target_config = parse_mysql_config(args.target, 'target')
+        watermark_columns = {}
+        for spec in args.watermark_column:
+            if '=' not in spec:
+                raise ValueError("Formato de --watermark-column debe ser: tabla=columna")
+            table_name, column = spec.split('=', 1)
+            watermark_columns[table_name] = column
         
-        # Parsear configuraciones de fuentes
-        source_databases = []
-        for source_spec in args.sources:
-            if '=' in source_spec:
-                alias, config_string = source_spec.split('=', 1)
-                source_config = parse_mysql_config(config_string, alias)
-            else:
-                source_config = parse_mysql_config(source_spec)
-            
-            source_databases.append(source_config)
+        throttle = None
+        if args.throttle or args.max_rows_per_second or args.max_bytes_per_second:
+            throttle = {
+                'latency': args.throttle_latency,
+                'threads_running': args.throttle_threads_running,
+                'rows_per_second': parse_rate_limits(args.max_rows_per_second),
+                'bytes_per_second': parse_rate_limits(args.max_bytes_per_second)
+            }
+        
+        options = {
+            'log_file': args.log_file,
+            'chunk_size': args.chunk_size,
+            'batch_size': args.batch_size,
+            'bulk_load_threshold': args.bulk_load_threshold,
+            'workers': args.workers,
+            'incremental': args.incremental,
+            'watermark_columns': watermark_columns,
+            'server_hash': args.server_hash,
+            'diff_engine': args.diff_engine,
+            'checksum_chunk': args.checksum_chunk,
+            'hash_algorithm': args.hash_algorithm,
+            'write_mode': args.write_mode,
+            'metrics_prefix': args.metrics_prefix,
+            'status_file': args.status_file,
+            'log_stream': sys.stderr if args.json else None,
+            'binlog_checkpoint_file': args.binlog_checkpoint,
+            'cdc_server_id': args.cdc_server_id,
+            'resume': args.resume,
+            'memory_budget': args.memory_budget * 1024 * 1024,
+            'throttle': throttle,
+            'pipeline_depth': args.pipeline_depth,
+            'hash_workers': args.hash_workers
+        }
         
-        consolidator = MySQLDBConsolidator(source_databases, target_config, args.log_file)
+        if args.modo == 'servicio':
+            # Un solo pool para todos los trabajos: las conexiones quedan abiertas entre ejecuciones
+            connections = ConnectionManager(args.pool_size or args.workers + 1)
+            serve(ConsolidationService(options, connections), args.listen)
+            return
+        
+        # Parsear configuración de destino y de fuentes
+        target_config = parse_mysql_config(args.target, 'target')
+        source_databases = [parse_source_spec(source_spec) for source_spec in args.sources]
+        
+        consolidator = MySQLDBConsolidator(source_databases, target_config, pool_size=args.pool_size, **options)
         
         if args.modo == 'apertura':
-            print("Ejecutando modo APERTURA - Tomando snapshot de todas las fuentes...")
-            
-            consolidator.take_snapshot()
-            print("Snapshot completado exitosamente")
+            if not args.json:
+                print("Ejecutando modo APERTURA - Tomando snapshot de todas las fuentes...")
+            summary = consolidator.take_snapshot()
+            if not args.json:
+                print("Snapshot completado exitosamente")
             
         elif args.modo == 'cierre':
-            print("Ejecutando modo CIERRE - Consolidando cambios...")
-            consolidator.consolidate_changes()
-            print("Consolidación completada exitosamente")
+            if not args.json:
+                print("Ejecutando modo CIERRE - Consolidando cambios...")
+            summary = consolidator.consolidate_changes()
+            if not args.json:
+                print("Consolidación completada exitosamente")
+        
+        elif args.modo == 'cdc':
+            if not args.json:
+                print("Ejecutando modo CDC - Aplicando cambios del binlog...")
+            summary = consolidator.capture_changes()
+            if not args.json:
+                print("Captura de cambios completada exitosamente")
+        
+        consolidator.connections.close_all()
+        consolidator.dead_letters.close()
+        if args.json:
+            print(json.dumps({'status': 'ok', 'modo': args.modo, 'resumen': summary}, default=str, ensure_ascii=False))
             
     except Exception as e:
-        print(f"Error durante la ejecución: {e}")
+        if args.json:
+            print(json.dumps({'status': 'error', 'modo': args.modo, 'message': str(e)}, ensure_ascii=False))
+        else:
+            print(f"Error durante la ejecución: {e}")
         sys.exit(1)
 
 if __name__ == "__main__":
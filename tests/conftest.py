@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Los scripts se ejecutan desde la raíz del repositorio, sin instalarse como paquete
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,120 @@
+"""Modo changeset: clasificación en altas, modificaciones y bajas, y clave única (alias, clave de origen)"""
+
+import re
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from sync import KEY_SIZE, KeyedDigestIndex, KeyHasher, MySQLDBConsolidator, RowHasher, merge_keyed_records
+
+INFO = {
+    'all_columns': ['id', 'total'],
+    'column_types': {'id': 'int', 'total': 'decimal'},
+    'primary_key': ['id'],
+}
+
+
+def entry(key: int, digest: int) -> bytes:
+    return bytes([key]) * KEY_SIZE + bytes([digest]) * 32
+
+
+def keyed_index(entries):
+    entries = sorted(entries)
+    return KeyedDigestIndex(b''.join(entries), 0, len(entries))
+
+
+@pytest.fixture
+def consolidator(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # El log y el log de fallos quedan en el directorio temporal
+    return MySQLDBConsolidator([], {}, log_file=str(tmp_path / 'fallos.db'), write_mode='changeset')
+
+
+def test_merge_replaces_changed_and_drops_deleted_keys():
+    existing = [entry(1, 1), entry(2, 2), entry(3, 3)]
+    changed = [entry(2, 20), entry(4, 4)]
+    merged = list(merge_keyed_records(existing, changed, {bytes([3]) * KEY_SIZE}))
+    assert merged == [entry(1, 1), entry(2, 20), entry(4, 4)]
+
+
+def test_merge_drops_deleted_key_even_if_changed():
+    merged = list(merge_keyed_records([entry(1, 1)], [entry(2, 2)], {bytes([2]) * KEY_SIZE}))
+    assert merged == [entry(1, 1)]
+
+
+def test_rows_are_classified_by_primary_key(consolidator):
+    key_hasher = KeyHasher(INFO['primary_key'], INFO['column_types'], 'S0')
+    hasher = RowHasher(INFO['all_columns'], INFO['column_types'], 'S0')
+    before = [{'id': 1, 'total': '10.00'}, {'id': 2, 'total': '20.00'}, {'id': 3, 'total': '30.00'}]
+    snapshot_table = keyed_index([key_hasher.hash_row(row) + hasher.hash_row(row) for row in before])
+    current = [{'id': 1, 'total': '10.00'}, {'id': 2, 'total': '25.00'}, {'id': 4, 'total': '40.00'}]
+    consolidator.scan_table = lambda *args, **kwargs: iter([current])
+
+    inserted, updated, deleted_keys = consolidator.find_changed_records(None, 'ventas', snapshot_table, INFO, 'S0')
+
+    assert [record['id'] for record in inserted] == [4]
+    assert [(record['id'], record['total']) for record in updated] == [(2, '25.00')]
+    assert deleted_keys == [key_hasher.hash_row(before[2])]
+    assert updated[0]['_source_key'] == key_hasher.hash_row(current[1]).hex()
+    assert updated[0]['_record_hash'] == hasher.hash_row(current[1]).hex()
+
+
+def test_source_key_ignores_non_key_columns_and_depends_on_alias():
+    key_hasher = KeyHasher(['id'], INFO['column_types'], 'S0')
+    assert key_hasher.hash_row({'id': 7, 'total': '1'}) == key_hasher.hash_row({'id': 7, 'total': '2'})
+    assert key_hasher.hash_row({'id': 7}) != KeyHasher(['id'], INFO['column_types'], 'S1').hash_row({'id': 7})
+
+
+class SqliteConnection:
+    """Destino en SQLite: la clave única (alias, clave) se emula con ON CONFLICT"""
+
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute("CREATE TABLE ventas (_consolidation_id INTEGER PRIMARY KEY, _source_database TEXT, "
+                        "_source_alias TEXT, _sync_timestamp TEXT, _record_hash TEXT, _source_key TEXT, "
+                        "_deleted_at TEXT, id INTEGER, total TEXT, UNIQUE (_source_alias, _source_key))")
+
+    def cursor(self):
+        return SqliteCursor(self.db)
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+
+class SqliteCursor:
+    def __init__(self, db):
+        self.db = db
+
+    def executemany(self, query, values):
+        head, assignments = query.split(' ON DUPLICATE KEY UPDATE ')
+        assignments = re.sub(r'VALUES\((`\w+`)\)', r'excluded.\1', assignments)
+        query = f"{head} ON CONFLICT (_source_alias, _source_key) DO UPDATE SET {assignments}"
+        self.db.executemany(query.replace('%s', '?'), [tuple(map(str, row)) for row in values])
+
+    def close(self):
+        pass
+
+
+def changeset_record(record_id: int, total: str, alias: str = 'S0') -> dict:
+    key_hasher = KeyHasher(['id'], INFO['column_types'], alias)
+    row = {'id': record_id, 'total': total}
+    return dict(row, _record_hash=RowHasher(INFO['all_columns'], INFO['column_types'], alias).hash_row(row).hex(),
+                _source_key=key_hasher.hash_row(row).hex())
+
+
+def test_upsert_updates_by_alias_and_source_key(consolidator):
+    conn = SqliteConnection()
+    now = datetime(2025, 9, 1, 8, 0)
+    for alias in ('S0', 'S1'):
+        consolidator._insert_batch(conn, 'ventas', [changeset_record(1, '10.00', alias)],
+                                   {'alias': alias, 'database': 'ventas'}, now)
+    conn.db.execute("UPDATE ventas SET _deleted_at = 'ayer' WHERE _source_alias = 'S0'")
+
+    consolidator._insert_batch(conn, 'ventas', [changeset_record(1, '15.00')], {'alias': 'S0', 'database': 'ventas'}, now)
+
+    rows = conn.db.execute("SELECT _source_alias, id, total, _deleted_at FROM ventas ORDER BY _source_alias").fetchall()
+    # La misma PK en otra sucursal es otra fila; en la misma, se actualiza y se revierte el borrado lógico
+    assert rows == [('S0', 1, '15.00', None), ('S1', 1, '10.00', None)]
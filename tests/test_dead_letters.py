@@ -0,0 +1,96 @@
+"""Log de inserts fallidos en SQLite: altas, backoff de reintentos y registros que agotan sus reintentos"""
+
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+import sync
+from sync import DeadLetterStore
+
+SOURCE = {'alias': 'S0', 'database': 'ventas', 'host': 'db', 'user': 'root', 'password': 'secreta'}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(sync.time, 'time', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = DeadLetterStore(str(tmp_path / 'fallos.db'), base_delay=60.0, max_delay=300.0, max_attempts=3)
+    yield store
+    store.close()
+
+
+def record(record_hash: str) -> dict:
+    return {'id': 1, 'total': '12.50', 'creado': '2025-09-01T08:00:00', 'foto': b'\x89PNG\x00',
+            '_record_hash': record_hash}
+
+
+def test_added_records_are_due_by_table_and_source(store, clock):
+    store.add('ventas', record('a'), SOURCE, 'Duplicate entry')
+    store.add('clientes', record('b'), SOURCE, 'Data too long')
+    assert store.count() == 2
+    assert sorted(store.due_groups()) == [('clientes', 'S0', 'ventas'), ('ventas', 'S0', 'ventas')]
+    [[(_, due)]] = list(store.iter_due('ventas', 'S0', 10))
+    assert due == record('a')
+    # Los valores que no son JSON se guardan como texto; los binarios vuelven como bytes
+    store.add('ventas', {'total': Decimal('1.10'), 'creado': datetime(2025, 9, 1, 8, 0)}, SOURCE, 'error')
+    [[_, (_, due)]] = list(store.iter_due('ventas', 'S0', 10))
+    assert due == {'total': '1.10', 'creado': '2025-09-01 08:00:00'}
+    # Solo alias y base de datos: nunca las credenciales
+    raw = store.connect().execute("SELECT record FROM failed_inserts").fetchall()
+    assert not any('secreta' in row[0] for row in raw)
+
+
+def test_retry_in_blocks_and_resolve(store, clock):
+    for i in range(5):
+        store.add('ventas', record(str(i)), SOURCE, 'error')
+    blocks = list(store.iter_due('ventas', 'S0', 2))
+    assert [len(block) for block in blocks] == [2, 2, 1]
+    store.resolve([entry_id for entry_id, _ in blocks[0]])
+    assert store.count() == 3
+
+
+def test_failed_retry_backs_off_exponentially(store, clock):
+    store.add('ventas', record('a'), SOURCE, 'error')
+    [[(entry_id, _)]] = list(store.iter_due('ventas', 'S0', 10))
+    store.reschedule([(entry_id, 'sigue fallando')])
+    assert store.count(due_only=True) == 0
+    clock[0] = 1059.0
+    assert store.count(due_only=True) == 0
+    clock[0] = 1060.0
+    assert store.count(due_only=True) == 1
+    store.reschedule([(entry_id, 'sigue fallando')])
+    next_retry = store.connect().execute("SELECT next_retry_at, attempts, error FROM failed_inserts").fetchone()
+    assert next_retry == (1060.0 + 120.0, 2, 'sigue fallando')
+
+
+def test_backoff_is_capped(tmp_path, clock):
+    store = DeadLetterStore(str(tmp_path / 'fallos.db'), base_delay=60.0, max_delay=300.0, max_attempts=10)
+    store.add('ventas', record('a'), SOURCE, 'error')
+    [[(entry_id, _)]] = list(store.iter_due('ventas', 'S0', 10))
+    for _ in range(6):
+        store.reschedule([(entry_id, 'error')])
+    assert store.connect().execute("SELECT next_retry_at FROM failed_inserts").fetchone()[0] == 1000.0 + 300.0
+    store.close()
+
+
+def test_exhausted_records_are_moved_aside(store, clock):
+    store.add('ventas', record('a'), SOURCE, 'error')
+    store.add('ventas', record('b'), SOURCE, 'error')
+    entry_ids = [entry_id for entry_id, _ in next(store.iter_due('ventas', 'S0', 10))]
+    assert store.reschedule([(entry_ids[0], 'error'), (entry_ids[1], 'error')]) == 0
+    assert store.reschedule([(entry_ids[0], 'error')]) == 0
+    assert store.reschedule([(entry_ids[0], 'error final')]) == 1
+    assert store.count() == 1
+    assert store.count(exhausted=True) == 1
+    clock[0] = 10 ** 9
+    assert [[entry_id for entry_id, _ in block] for block in store.iter_due('ventas', 'S0', 10)] == [[entry_ids[1]]]
+    exhausted = store.connect().execute("SELECT id, attempts, error FROM failed_inserts_exhausted").fetchone()
+    assert exhausted == (entry_ids[0], 3, 'error final')
+    # Un cierre retomado sigue viéndolos como ya enviados al log
+    assert sorted(store.record_hashes('ventas', 'S0', '2000-01-01')) == ['a', 'b']
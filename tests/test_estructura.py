@@ -0,0 +1,20 @@
+"""db/estructura.py se importa como módulo del repositorio y también corre como script"""
+
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def test_import_as_module():
+    from db import estructura
+    assert estructura.merge_column_types is not None
+    assert estructura.parse_mysql_config('localhost:root:clave:ventas:3307') == {
+        'host': 'localhost', 'user': 'root', 'password': 'clave', 'database': 'ventas', 'port': 3307}
+
+
+def test_run_as_script():
+    result = subprocess.run([sys.executable, str(ROOT / 'db' / 'estructura.py'), '--help'],
+                            capture_output=True, text=True, cwd=str(ROOT))
+    assert result.returncode == 0, result.stderr
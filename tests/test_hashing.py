@@ -0,0 +1,60 @@
+"""sha256-v1 debe reproducir el hash de versiones anteriores: los snapshots y _record_hash ya guardados siguen valiendo"""
+
+import hashlib
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from sync import RowHasher
+
+COLUMN_TYPES = {
+    'id': 'int',
+    'precio': 'decimal',
+    'peso': 'double',
+    'creado': 'datetime',
+    'modificado': 'timestamp',
+    'fecha': 'date',
+    'hora': 'time',
+    'nombre': 'varchar',
+    'notas': 'text',
+}
+
+ROWS = [
+    {'id': 1, 'precio': Decimal('12.50'), 'peso': 0.25, 'creado': datetime(2025, 9, 1, 8, 0, 0),
+     'modificado': datetime(2025, 9, 1, 8, 0, 0, 123456), 'fecha': date(2025, 9, 1), 'hora': timedelta(hours=13),
+     'nombre': 'Ñandú', 'notas': 'sin cebolla | extra:queso'},
+    {'id': 2, 'precio': Decimal('0.00'), 'peso': None, 'creado': datetime(2025, 9, 2, 23, 59, 59),
+     'modificado': None, 'fecha': None, 'hora': timedelta(hours=-1, minutes=30), 'nombre': '', 'notas': None},
+]
+
+
+def generate_record_hash(record, source_alias):
+    """Copia del cálculo original (conversión por valor + cadena "alias:col:valor|...")"""
+    processed = {}
+    for column, value in record.items():
+        if isinstance(value, datetime):
+            processed[column] = value.isoformat()
+        elif value is None:
+            processed[column] = None
+        else:
+            processed[column] = str(value) if not isinstance(value, (int, float, str, bool)) else value
+    record_string = f"{source_alias}:"
+    for key in sorted(processed.keys()):
+        value = processed[key]
+        if value is None:
+            record_string += f"{key}:NULL|"
+        else:
+            record_string += f"{key}:{str(value)}|"
+    return hashlib.sha256(record_string.encode('utf-8')).hexdigest()
+
+
+def test_sha256_v1_matches_original_hash():
+    hasher = RowHasher(list(COLUMN_TYPES), COLUMN_TYPES, 'Sucursal 0', 'sha256-v1')
+    assert [digest.hex() for digest in hasher.hash_rows(ROWS)] == \
+        [generate_record_hash(row, 'Sucursal 0') for row in ROWS]
+    assert hasher.hash_row(ROWS[0]).hex() == generate_record_hash(ROWS[0], 'Sucursal 0')
+
+
+def test_alias_is_part_of_the_hash():
+    first = RowHasher(list(COLUMN_TYPES), COLUMN_TYPES, 'S0', 'sha256-v1').hash_row(ROWS[0])
+    second = RowHasher(list(COLUMN_TYPES), COLUMN_TYPES, 'S1', 'sha256-v1').hash_row(ROWS[0])
+    assert first != second
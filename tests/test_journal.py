@@ -0,0 +1,81 @@
+"""Bitácora del cierre: lectura tras un corte y lock por fuente"""
+
+import json
+
+import pytest
+
+import sync
+from sync import ConsolidationJournal
+
+
+def write_lines(path, entries, tail: str = ''):
+    with open(path, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+        f.write(tail)
+
+
+def test_missing_journal_loads_none(tmp_path):
+    assert ConsolidationJournal(str(tmp_path / 'S0.journal.jsonl'), 'S0').load() is None
+
+
+def test_truncated_last_line_is_ignored(tmp_path):
+    path = tmp_path / 'S0.journal.jsonl'
+    write_lines(path, [
+        {'inicio': '2026-01-01T00:00:00', 'write_mode': 'idempotent', 'snapshot': 't'},
+        {'paso': 'escribiendo', 'alias': 'S0', 'tabla': 'ventas'},
+        {'paso': 'lote', 'alias': 'S0', 'tabla': 'ventas', 'filas': 500},
+        {'paso': 'completa', 'alias': 'S0', 'tabla': 'clientes', 'update': None},
+    ], tail='{"paso": "lote", "alias": "S0", "tab')
+    state = ConsolidationJournal(str(path), 'S0').load()
+    assert state['cabecera']['write_mode'] == 'idempotent'
+    assert state['tablas']['S0']['ventas'] == {'filas': 500, 'estado': 'lote'}
+    assert state['tablas']['S0']['clientes']['estado'] == 'completa'
+
+
+def test_snapshot_step_drops_applied_updates(tmp_path):
+    path = tmp_path / 'S0.journal.jsonl'
+    update = ConsolidationJournal.encode_update({'digests': [b'\x01' * 32], 'watermark': None})
+    write_lines(path, [
+        {'inicio': '2026-01-01T00:00:00', 'write_mode': 'idempotent', 'snapshot': 't'},
+        {'paso': 'completa', 'alias': 'S0', 'tabla': 'ventas', 'update': update},
+        {'paso': 'snapshot', 'fuentes': ['S0']},
+    ])
+    state = ConsolidationJournal(str(path), 'S0').load()
+    assert 'update' not in state['tablas']['S0']['ventas']
+
+
+def test_binlog_step_keeps_start_position(tmp_path):
+    path = tmp_path / 'S0.journal.jsonl'
+    position = {'log_file': 'binlog.000007', 'log_pos': 4711, 'gtid_set': None}
+    write_lines(path, [
+        {'inicio': '2026-01-01T00:00:00', 'write_mode': 'changeset', 'snapshot': 't'},
+        {'paso': 'binlog', 'alias': 'S0', 'tabla': None, 'posicion': position},
+        {'paso': 'completa', 'alias': 'S0', 'tabla': 'ventas', 'update': None},
+    ])
+    state = ConsolidationJournal(str(path), 'S0').load()
+    assert state['binlog'] == position
+    assert list(state['tablas']['S0']) == ['ventas']
+
+
+def test_update_round_trip():
+    update = {'entries': [b'\x02' * 48], 'deleted': {b'\x03' * 16}, 'watermark': {'value': 5}}
+    assert ConsolidationJournal.decode_update(ConsolidationJournal.encode_update(update)) == update
+
+
+@pytest.mark.skipif(sync.fcntl is None, reason='requiere fcntl')
+def test_second_run_of_same_source_is_refused(tmp_path):
+    path = str(tmp_path / 'S0.journal.jsonl')
+    first = ConsolidationJournal(path, 'S0')
+    first.acquire()
+    first.start({'inicio': '2026-01-01T00:00:00'})
+    second = ConsolidationJournal(path, 'S0')
+    try:
+        with pytest.raises(RuntimeError):
+            second.acquire()
+        # El intento fallido no trunca la bitácora en uso
+        assert ConsolidationJournal(path, 'S0').load()['cabecera'] == {'inicio': '2026-01-01T00:00:00'}
+    finally:
+        first.finish()
+    second.acquire()
+    second.close()
@@ -0,0 +1,36 @@
+"""Métricas por fuente y escritura atómica de los archivos compartidos"""
+
+import json
+import os
+
+from sync import ConsolidationMetrics, write_atomic
+
+
+def test_metrics_of_one_source_leave_out_the_others():
+    metrics = ConsolidationMetrics('cierre')
+    metrics.add_time('S0', 'ventas', 'diff', 0.5)
+    metrics.add_time('S1', 'ventas', 'diff', 1.5)
+    assert list(metrics.to_dict('S1')['fuentes']) == ['S1']
+    assert list(metrics.to_dict()['fuentes']) == ['S0', 'S1']
+
+
+def test_prometheus_file_of_one_source(tmp_path):
+    metrics = ConsolidationMetrics('cierre')
+    metrics.count('S0', 'ventas', filas_leidas=10)
+    metrics.count('S1', 'ventas', filas_leidas=20)
+    path = tmp_path / 'm.prom'
+    metrics.write_prometheus(str(path), 'S1')
+    content = path.read_text(encoding='utf-8')
+    assert 'source="S1"' in content
+    assert 'source="S0"' not in content
+    assert 'consolidation_last_run_timestamp_seconds{mode="cierre",source="S1"}' in content
+
+
+def test_write_atomic_keeps_mode_and_leaves_no_temporary(tmp_path):
+    path = tmp_path / 'alias.json'
+    path.write_text('{}', encoding='utf-8')
+    os.chmod(path, 0o664)
+    write_atomic(str(path), json.dumps({'db_origenes': []}))
+    assert json.loads(path.read_text(encoding='utf-8')) == {'db_origenes': []}
+    assert os.stat(path).st_mode & 0o777 == 0o664
+    assert os.listdir(tmp_path) == ['alias.json']
@@ -0,0 +1,124 @@
+"""Orden externo del diff con --memory-budget: tramos en disco, merge y multiconjunto de reanudación"""
+
+import hashlib
+import os
+
+from sync import DigestMultiset, SortedSpool, merge_new_entries
+
+
+def digest(i: int) -> bytes:
+    return hashlib.sha256(str(i).encode()).digest()
+
+
+def open_files() -> int:
+    return len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else 0
+
+
+def test_spool_without_budget_sorts_in_memory():
+    spool = SortedSpool()
+    entries = [(digest(i), str(i)) for i in range(100)]
+    for record_digest, key in entries:
+        spool.add(record_digest, key)
+    try:
+        assert not spool.runs
+        assert list(spool) == sorted(entries)
+    finally:
+        spool.close()
+
+
+def test_spool_merges_many_runs_in_order():
+    spool = SortedSpool(200)  # Un tramo cada una o dos entradas
+    entries = [(digest(i), str(i)) for i in range(5000)]
+    for record_digest, key in entries:
+        spool.add(record_digest, key)
+    try:
+        assert len(spool) == 5000
+        assert list(spool) == sorted(entries)
+        assert list(spool.digests()) == sorted(record_digest for record_digest, _ in entries)
+    finally:
+        spool.close()
+
+
+def test_spool_bounds_open_files():
+    before = open_files()
+    spool = SortedSpool(200)
+    for i in range(5000):
+        spool.add(digest(i), str(i))
+    try:
+        assert len(spool.runs) < 4 * SortedSpool.MERGE_FAN_IN
+        if before:
+            assert open_files() - before == len(spool.runs)
+    finally:
+        spool.close()
+
+
+def test_spool_keeps_duplicates():
+    spool = SortedSpool(100)
+    for key in ('a', 'b', 'c'):
+        spool.add(digest(1), key)
+    try:
+        assert list(spool) == [(digest(1), 'a'), (digest(1), 'b'), (digest(1), 'c')]
+    finally:
+        spool.close()
+
+
+def test_merge_new_entries_skips_snapshot_digests():
+    spool = SortedSpool(300)
+    for i in range(1000):
+        spool.add(digest(i), str(i))
+    snapshot = sorted(digest(i) for i in range(0, 1000, 3))
+    try:
+        new = list(merge_new_entries(spool, snapshot))
+    finally:
+        spool.close()
+    assert new == sorted((digest(i), str(i)) for i in range(1000) if i % 3)
+
+
+def test_merge_new_entries_with_empty_snapshot():
+    entries = sorted((digest(i), str(i)) for i in range(10))
+    assert list(merge_new_entries(entries, [])) == entries
+
+
+def test_digest_multiset_consumes_each_occurrence_once():
+    written = DigestMultiset([digest(2), digest(1), digest(2)], budget=100)
+    try:
+        assert len(written) == 3
+        assert written.take(digest(2))
+        assert written.take(digest(2))
+        assert not written.take(digest(2))
+        assert written.take(digest(1))
+        assert not written.take(digest(3))
+    finally:
+        written.close()
+
+
+def test_empty_digest_multiset():
+    written = DigestMultiset([])
+    try:
+        assert not written
+        assert not written.take(digest(1))
+    finally:
+        written.close()
+
+
+def test_spool_context_closes_runs_on_error():
+    before = open_files()
+    try:
+        with SortedSpool(200) as spool:
+            for i in range(5000):
+                spool.add(digest(i), str(i))
+            raise RuntimeError('falla la tabla')
+    except RuntimeError:
+        pass
+    assert all(run.closed for run in spool.runs)
+    if before:
+        assert open_files() == before
+
+
+def test_digest_multiset_context():
+    before = open_files()
+    with DigestMultiset((digest(i) for i in range(2000)), budget=200) as written:
+        assert len(written) == 2000
+        assert written.take(digest(7))
+    if before:
+        assert open_files() == before
@@ -0,0 +1,108 @@
+"""Ritmo adaptativo de extracción: bloque y pausa AIMD y techos de filas/s y bytes/s, con reloj simulado"""
+
+import pytest
+
+from sync import SourceThrottle
+
+
+class FakeClock:
+    """Reloj que solo avanza al dormir (o a mano)"""
+
+    def __init__(self, now: float = 100.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def throttle(clock: FakeClock, chunk_size: int = 1000, **options) -> SourceThrottle:
+    return SourceThrottle(chunk_size, clock=clock, sleep=clock.sleep, **options)
+
+
+def test_fast_blocks_grow_the_chunk_up_to_the_ceiling():
+    clock = FakeClock()
+    source = throttle(clock)
+    source.observe(1000, 0, latency=0.01)
+    assert source.chunk_size == 1250
+    for _ in range(30):
+        source.observe(1000, 0, latency=0.01)
+    assert source.chunk_size == 10000
+    assert clock.sleeps == []
+
+
+def test_slow_blocks_halve_the_chunk_and_back_off():
+    clock = FakeClock()
+    source = throttle(clock, target_latency=0.25)
+    source.observe(1000, 0, latency=0.5)
+    assert source.chunk_size == 500
+    assert clock.sleeps == [0.05]
+    source.observe(500, 0, latency=0.5)
+    source.observe(250, 0, latency=0.5)
+    assert source.chunk_size == 125
+    assert clock.sleeps == [0.05, 0.1, 0.2]
+    for _ in range(10):
+        source.observe(50, 0, latency=0.5)
+    assert source.chunk_size == source.min_chunk == 50
+    assert source.pause == SourceThrottle.MAX_PAUSE
+    assert source.paused == pytest.approx(sum(clock.sleeps))
+
+
+def test_pause_halves_when_the_source_recovers():
+    clock = FakeClock()
+    source = throttle(clock)
+    source.observe(1000, 0, latency=1.0)
+    source.observe(500, 0, latency=1.0)
+    assert source.pause == 0.1
+    source.observe(500, 0, latency=0.01)
+    assert source.pause == 0.05
+    for _ in range(3):
+        source.observe(500, 0, latency=0.01)
+    assert clock.sleeps[-3:] == [0.025, 0.0125, 0.00625]
+    # Por debajo de 10 ms ya no se pausa
+    source.observe(500, 0, latency=0.01)
+    assert source.pause == 0.0
+    assert len(clock.sleeps) == 6
+
+
+def test_threads_running_above_limit_counts_as_busy():
+    clock = FakeClock()
+    source = throttle(clock, max_threads_running=8)
+    assert source.needs_probe()
+    source.observe(1000, 0, latency=0.01, threads_running=20)
+    assert source.chunk_size == 500
+    assert not source.needs_probe()
+    clock.now += SourceThrottle.PROBE_INTERVAL
+    assert source.needs_probe()
+    source.observe(500, 0, latency=0.01, threads_running=2)
+    assert source.chunk_size == 625
+
+
+def test_probe_is_skipped_without_a_limit():
+    assert not throttle(FakeClock()).needs_probe()
+
+
+def test_rows_per_second_ceiling():
+    clock = FakeClock()
+    source = throttle(clock, rows_per_second=1000)
+    source.observe(500, 0, latency=0.01)
+    assert clock.sleeps == [0.5]
+    # Si leer llevó más que el techo, no se espera
+    clock.now += 2.0
+    source.observe(500, 0, latency=0.01)
+    assert clock.sleeps == [0.5]
+    source.observe(3000, 0, latency=0.01)
+    assert clock.sleeps == [0.5, pytest.approx(1.5)]
+    assert clock.now - 100.0 == pytest.approx(source.rows / 1000)
+
+
+def test_bytes_per_second_ceiling():
+    clock = FakeClock()
+    source = throttle(clock, rows_per_second=1000, bytes_per_second=1024 * 1024)
+    source.observe(100, 4 * 1024 * 1024, latency=0.01)
+    # El techo más restrictivo decide: 4 MB a 1 MB/s
+    assert clock.sleeps == [4.0]
@@ -0,0 +1,61 @@
+"""Motor de tipos: unión de COLUMN_TYPE entre fuentes y límite de tamaño de fila"""
+
+from db.tipos import fit_row_size, format_column_type, merge_column_types, parse_column_type
+
+
+def merged(*column_types: str) -> str:
+    column = None
+    for column_type in column_types:
+        column = merge_column_types(column, parse_column_type(column_type))
+    return format_column_type(column)
+
+
+def test_same_integer_type_is_kept():
+    assert merged('int(11)', 'int') == 'INT'
+    assert merged('int(10) unsigned', 'int unsigned') == 'INT UNSIGNED'
+
+
+def test_unsigned_mixed_with_signed_moves_to_next_size():
+    assert merged('tinyint unsigned', 'tinyint') == 'SMALLINT'
+    assert merged('int(10) unsigned', 'int(11)') == 'BIGINT'
+    assert merged('smallint unsigned', 'int') == 'INT'
+
+
+def test_bigint_unsigned_mixed_with_signed_becomes_decimal():
+    assert merged('bigint unsigned', 'int') == 'DECIMAL(20,0)'
+
+
+def test_decimal_keeps_widest_integer_part_and_scale():
+    assert merged('decimal(10,2)', 'decimal(8,4)') == 'DECIMAL(12,4)'
+    assert merged('decimal(5,0)', 'int') == 'DECIMAL(10,0)'
+
+
+def test_string_mixed_with_number_widens_to_fit_both():
+    assert merged('varchar(10)', 'int') == 'VARCHAR(11)'
+    assert merged('varchar(20)', 'varchar(80)') == 'VARCHAR(80)'
+    assert merged('date', 'int') == 'VARCHAR(26)'
+
+
+def test_incompatible_types_fall_back_to_text():
+    assert merged('text', 'int') == 'TEXT'
+    assert merged('int', 'text') == 'TEXT'
+    assert merged('mediumtext', 'int') == 'MEDIUMTEXT'
+    # JSON admite documentos de hasta 4 GB: solo LONGTEXT los contiene
+    assert merged('json', 'varchar(20)') == 'LONGTEXT'
+    assert merged('varchar(20)', 'json') == 'LONGTEXT'
+    assert merged('blob', 'int') == 'LONGTEXT'
+
+
+def test_wide_rows_move_longest_varchars_to_text():
+    columns = {f"c{i}": parse_column_type('varchar(255)') for i in range(70)}
+    columns['corta'] = parse_column_type('varchar(10)')
+    fitted = fit_row_size(columns)
+    row_bytes = sum(column['size'] * 4 for column in fitted.values() if column['kind'] == 'string')
+    assert row_bytes <= 60000
+    assert any(format_column_type(column) == 'TEXT' for column in fitted.values())
+    assert format_column_type(fitted['corta']) == 'VARCHAR(10)'
+
+
+def test_row_within_limit_is_unchanged():
+    columns = {'a': parse_column_type('varchar(100)'), 'b': parse_column_type('int')}
+    assert fit_row_size(columns) == columns